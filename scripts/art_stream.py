@@ -0,0 +1,477 @@
+###
+# Streaming artifact detection - scores the volumes of a functional run
+# while they are written
+#
+# ArtifactDetect loads the whole run into memory, computes the global
+# intensity volume by volume and the motion norm scan by scan.
+# FastArtifactDetect reads the run through a memory map, one block of volumes
+# at a time, and computes the global intensity of all volumes in a block and
+# the motion norms of all scans at once with array operations. Its outputs
+# are the same as the ones of ArtifactDetect:
+#
+#   art = Node(FastArtifactDetect(norm_threshold=1,
+#                                 zintensity_threshold=3,
+#                                 mask_type='file',
+#                                 parameter_source='SPM',
+#                                 use_differences=[True, False],
+#                                 chunk_mb=256),
+#              name="art")
+#
+# Both use an ArtScorer, which takes the volumes and motion parameters in any
+# number of steps and returns the outliers found so far after each of them.
+# The watch command uses it to score a realigned run while SPM is still
+# writing it. The outlier file is updated after every new block of volumes,
+# and all output files are written as soon as the last volume is in:
+#
+#   python art_stream.py watch rasub-01_task.nii rp_asub-01_task.txt \
+#       --out_dir art --mask_type spm_global
+#
+# Motion norms with use_differences[0] and the global intensity of mask types
+# 'file' and 'thresh' don't change once a volume is scored. The intensity
+# z-scores (and the intersection mask of 'spm_global') depend on the whole
+# run, so their outliers are provisional until the last volume is in.
+
+import os
+import time
+from os.path import exists, abspath
+
+import numpy as np
+import nibabel as nb
+from scipy import signal
+from nipype import config
+from nipype.algorithms.rapidart import ArtifactDetect, ArtifactDetectInputSpec
+from nipype.interfaces.base import traits, isdefined
+from nipype.utils.filemanip import save_json
+from nipype.utils.misc import find_indices
+
+
+# Returns the 4x4 affines of all rows of motion parameters at once (same as
+# _get_affine_matrix of rapidart, which supports one row at a time)
+def motion_affines(mc, source):
+    params = np.atleast_2d(np.asarray(mc, dtype=np.float64))
+    if source.upper() == 'FSL':
+        params = params[:, [3, 4, 5, 0, 1, 2]]
+    elif source.upper() in ('AFNI', 'FSFAST'):
+        params = params[:, np.asarray([4, 5, 3, 1, 2, 0]) +
+                        (params.shape[1] > 6)]
+        params[:, 3:] *= np.pi / 180.
+    q = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0], dtype=np.float64)
+    if params.shape[1] < 12:
+        params = np.hstack((params, np.tile(q[params.shape[1]:],
+                                            (len(params), 1))))
+
+    eye = np.tile(np.eye(4), (len(params), 1, 1))
+    T, Rx, Ry, Rz, S, Sh = [eye.copy() for _ in range(6)]
+    T[:, 0:3, 3] = params[:, 0:3]
+    c, s = np.cos(params[:, 3:6]), np.sin(params[:, 3:6])
+    for R, (i, j), k in [(Rx, (1, 2), 0), (Ry, (0, 2), 1), (Rz, (0, 1), 2)]:
+        R[:, i, i], R[:, i, j] = c[:, k], s[:, k]
+        R[:, j, i], R[:, j, j] = -s[:, k], c[:, k]
+    for i in range(3):
+        S[:, i, i] = params[:, 6 + i]
+    Sh[:, 0, 1], Sh[:, 0, 2], Sh[:, 1, 2] = params[:, 9:12].T
+    if source.upper() in ('AFNI', 'FSFAST'):
+        rotation = np.matmul(Ry, np.matmul(Rx, Rz))
+    else:
+        rotation = np.matmul(Rx, np.matmul(Ry, Rz))
+    return np.matmul(T, np.matmul(rotation, np.matmul(S, Sh)))
+
+
+# Returns the composite motion norm of all scans (maximal displacement of
+# the face centers of a cube around the head, same as _calc_norm)
+def motion_norm(mc, use_differences, source):
+    if len(mc) == 0:
+        return np.zeros(0)
+    respos = np.diag([70, 70, 75])
+    resneg = np.diag([-70, -110, -45])
+    all_pts = np.vstack((np.hstack((respos, resneg)), np.ones((1, 6))))
+    newpos = np.matmul(motion_affines(mc, source), all_pts)[:, 0:3, :]
+    if use_differences:
+        newpos = np.concatenate((np.zeros((1, 3, 6)),
+                                 np.diff(newpos, n=1, axis=0)), axis=0)
+        return np.sqrt(np.sum(newpos ** 2, axis=1)).max(axis=1)
+    newpos = newpos.reshape((len(newpos), -1))
+    newpos = np.abs(newpos - newpos.mean(axis=0))
+    return np.sqrt(np.mean(newpos ** 2, axis=1))
+
+
+# Returns the z-scores of the detrended global intensity
+def intensity_z(g, use_differences):
+    gz = signal.detrend(g, axis=0)
+    if use_differences:
+        gz = np.concatenate((np.zeros((1, 1)), np.diff(gz, n=1, axis=0)),
+                            axis=0)
+    return (gz - np.mean(gz)) / np.std(gz)
+
+
+# Returns the blocks of volumes (start, stop) that fit into max_bytes
+def volume_blocks(shape, max_bytes):
+    # The block, its masks and one masked copy are kept in memory
+    volume_bytes = int(np.prod(shape[:3])) * (4 + 1 + 4)
+    n_vols = max(int(max_bytes // volume_bytes), 1)
+    return [(t, min(t + n_vols, shape[3]))
+            for t in range(0, shape[3], n_vols)]
+
+
+# Returns the volumes start to stop of an image as (voxels, volumes) array
+def read_volumes(img, start, stop):
+    data = np.asarray(img.dataobj[..., start:stop], dtype=np.float32)
+    return data.reshape((-1, stop - start), order='F')
+
+
+# ArtScorer - global intensity and motion outliers of a run that is scored
+# step by step
+class ArtScorer(object):
+
+    def __init__(self, shape, mask_type='spm_global', mask=None,
+                 global_threshold=8., mask_threshold=None, intersect_mask=True,
+                 zintensity_threshold=3., use_differences=(True, False),
+                 parameter_source='SPM', use_norm=True, norm_threshold=None,
+                 translation_threshold=None, rotation_threshold=None):
+        self.shape = tuple(shape[:3])
+        self.mask_type = mask_type
+        self.global_threshold = global_threshold
+        self.mask_threshold = mask_threshold
+        self.intersect_mask = intersect_mask
+        self.zintensity_threshold = zintensity_threshold
+        self.use_differences = use_differences
+        self.parameter_source = parameter_source
+        self.use_norm = use_norm
+        self.norm_threshold = norm_threshold
+        self.translation_threshold = translation_threshold
+        self.rotation_threshold = rotation_threshold
+
+        # Global intensity of every volume, the mean used for its
+        # 'spm_global' mask, the intensity within its own mask and the size
+        # of the intersection mask it was scored with
+        self.g = []
+        self.means = []
+        self.own_g = []
+        self.mask_sizes = []
+        self.mc = np.zeros((0, 6))
+        if mask_type == 'file':
+            self.mask = np.asarray(mask).ravel(order='F') > 0.5
+        else:
+            self.mask = np.ones(int(np.prod(self.shape)), dtype=bool)
+
+    # Number of volumes scored so far
+    def __len__(self):
+        return len(self.g)
+
+    # Scores the next volumes, given as (voxels, volumes) array
+    def add_volumes(self, vols):
+        if self.mask_type == 'file':
+            g = np.nanmean(vols[self.mask], axis=0, dtype=np.float64)
+        elif self.mask_type == 'thresh':
+            masks = vols > self.mask_threshold
+            g = (np.where(masks, vols, 0).sum(axis=0, dtype=np.float64) /
+                 masks.sum(axis=0))
+            self.mask = masks[:, -1]
+        else:
+            means = np.nanmean(vols, axis=0, dtype=np.float64)
+            masks = vols > (means / self.global_threshold)
+            self.means.extend(means)
+            self.own_g.extend(np.where(masks, vols, 0).sum(
+                axis=0, dtype=np.float64) / masks.sum(axis=0))
+            if self.intersect_mask:
+                self.mask &= masks.all(axis=1)
+                g = np.nanmean(vols[self.mask], axis=0, dtype=np.float64)
+                self.mask_sizes.extend([self.mask.sum()] * vols.shape[1])
+            else:
+                g = self.own_g[-vols.shape[1]:]
+        self.g.extend(g)
+
+    # Adds the motion parameters of the next scans
+    def add_motion(self, mc):
+        mc = np.atleast_2d(mc)
+        if len(self.mc) == 0:
+            self.mc = mc
+        else:
+            self.mc = np.vstack((self.mc, mc))
+
+    # Whether the intersection mask is used (SPM falls back to the mask of
+    # each volume if the intersection is smaller than a tenth of the image)
+    def intersecting(self):
+        return (self.mask_type == 'spm_global' and self.intersect_mask and
+                self.mask.sum() >= np.prod(self.shape) / 10.)
+
+    # Rescores the volumes that were scored with a larger intersection mask
+    # and returns the mask image (4D, if every volume has its own mask).
+    # read(start, stop) returns the volumes of the given block.
+    def finish(self, read, blocks):
+        per_volume = (self.mask_type == 'spm_global' and
+                      not self.intersecting())
+        if per_volume:
+            mask = np.zeros(self.shape + (len(self),), dtype=np.uint8)
+        stale = np.asarray(self.mask_sizes) > self.mask.sum()
+        for start, stop in blocks:
+            if per_volume:
+                vols = read(start, stop)
+                means = np.asarray(self.means[start:stop])
+                mask[..., start:stop] = (
+                    vols > (means / self.global_threshold)).reshape(
+                        self.shape + (stop - start,), order='F')
+            elif self.intersecting() and stale[start:stop].any():
+                vols = read(start, stop)
+                self.g[start:stop] = np.nanmean(vols[self.mask], axis=0,
+                                                dtype=np.float64)
+                self.mask_sizes[start:stop] = [self.mask.sum()] * (stop -
+                                                                   start)
+        if per_volume:
+            return mask
+        return self.mask.reshape(self.shape, order='F').astype(np.uint8)
+
+    # Returns the outliers of all volumes and scans scored so far, together
+    # with the signals they were detected in
+    def results(self):
+        if self.intersecting() or self.mask_type != 'spm_global':
+            g = np.asarray(self.g, dtype=np.float64).reshape((-1, 1))
+        else:
+            g = np.asarray(self.own_g, dtype=np.float64).reshape((-1, 1))
+        if len(g) > 2:
+            gz = intensity_z(g, self.use_differences[1])
+            iidx = find_indices(abs(gz) > self.zintensity_threshold)
+        else:
+            gz = np.zeros_like(g)
+            iidx = np.zeros(0, dtype=int)
+
+        mc = self.mc
+        normval = traval = rotval = None
+        if self.use_norm:
+            normval = motion_norm(mc, self.use_differences[0],
+                                  self.parameter_source)
+            tidx = find_indices(normval > self.norm_threshold)
+            ridx = find_indices(normval < 0)
+        else:
+            if self.use_differences[0] and len(mc):
+                mc = np.concatenate((np.zeros((1, mc.shape[1])),
+                                     np.diff(mc, n=1, axis=0)), axis=0)
+            traval = mc[:, 0:3]
+            rotval = mc[:, 3:6]
+            tidx = find_indices(
+                np.sum(abs(traval) > self.translation_threshold, 1) > 0)
+            ridx = find_indices(
+                np.sum(abs(rotval) > self.rotation_threshold, 1) > 0)
+
+        return dict(g=g, gz=gz, iidx=iidx, tidx=tidx, ridx=ridx,
+                    normval=normval, traval=traval, rotval=rotval,
+                    outliers=np.unique(np.union1d(iidx,
+                                                  np.union1d(tidx, ridx))))
+
+
+# Writes a text file of values, replacing the previous file in one step
+def save_txt(filename, values, fmt):
+    np.savetxt(filename + '.part', values, fmt=fmt, delimiter=' ')
+    os.rename(filename + '.part', filename)
+
+
+# FastArtifactDetect - ArtifactDetect over memory-mapped blocks of volumes
+class FastArtifactDetectInputSpec(ArtifactDetectInputSpec):
+    chunk_mb = traits.Float(256., usedefault=True,
+                            desc='memory per block of volumes in MB')
+
+
+class FastArtifactDetect(ArtifactDetect):
+    input_spec = FastArtifactDetectInputSpec
+
+    # Returns a scorer with the settings of the inputs
+    def _scorer(self, shape):
+        inputs = self.inputs
+        mask = None
+        if inputs.mask_type == 'file':
+            mask = nb.load(inputs.mask_file).get_fdata(dtype=np.float32)
+        settings = dict((name, getattr(inputs, name)) for name in [
+            'global_threshold', 'mask_threshold', 'intersect_mask',
+            'zintensity_threshold', 'parameter_source', 'use_norm',
+            'norm_threshold', 'translation_threshold', 'rotation_threshold'])
+        settings = dict((k, v) for k, v in settings.items() if isdefined(v))
+        settings['use_norm'] = settings.get('use_norm', False)
+        return ArtScorer(shape, mask_type=inputs.mask_type, mask=mask,
+                         use_differences=inputs.use_differences, **settings)
+
+    # Writes the outputs of ArtifactDetect for a finished scorer
+    def _write_outputs(self, scorer, mask, affine, imgfile, motionfile, cwd):
+        res = scorer.results()
+        if self.inputs.mask_type == 'file':
+            affine = nb.load(self.inputs.mask_file).affine
+        (artifactfile, intensityfile, statsfile, normfile, plotfile,
+         displacementfile, maskfile) = self._get_output_filenames(imgfile,
+                                                                  cwd)
+        nb.Nifti1Image(mask, affine).to_filename(maskfile)
+        save_txt(artifactfile, res['outliers'], '%d')
+        save_txt(intensityfile, res['g'], '%.2f')
+        if scorer.use_norm:
+            save_txt(normfile, res['normval'], '%.4f')
+
+        gz, iidx, tidx, ridx = res['gz'], res['iidx'], res['tidx'], res['ridx']
+        if isdefined(self.inputs.save_plot) and self.inputs.save_plot:
+            import matplotlib
+            matplotlib.use(config.get('execution', 'matplotlib_backend'))
+            import matplotlib.pyplot as plt
+
+            fig = plt.figure()
+            plt.subplot(211 if scorer.use_norm else 311)
+            self._plot_outliers_with_wave(gz, iidx, 'Intensity')
+            if scorer.use_norm:
+                plt.subplot(212)
+                self._plot_outliers_with_wave(res['normval'],
+                                              np.union1d(tidx, ridx),
+                                              'Norm (mm)')
+            else:
+                diff = 'diff' if self.inputs.use_differences[0] else ''
+                plt.subplot(312)
+                self._plot_outliers_with_wave(res['traval'], tidx,
+                                              'Translation (mm)' + diff)
+                plt.subplot(313)
+                self._plot_outliers_with_wave(res['rotval'], ridx,
+                                              'Rotation (rad)' + diff)
+            plt.savefig(plotfile)
+            plt.close(fig)
+
+        mc_in = scorer.mc
+        motion_outliers = np.union1d(tidx, ridx)
+        summary = lambda x: {'mean': np.mean(x, axis=0).tolist(),
+                             'min': np.min(x, axis=0).tolist(),
+                             'max': np.max(x, axis=0).tolist(),
+                             'std': np.std(x, axis=0).tolist()}
+        stats = [
+            {'motion_file': motionfile, 'functional_file': imgfile},
+            {'common_outliers': len(np.intersect1d(iidx, motion_outliers)),
+             'intensity_outliers': len(np.setdiff1d(iidx, motion_outliers)),
+             'motion_outliers': len(np.setdiff1d(motion_outliers, iidx))},
+            {'motion': [{'using differences': self.inputs.use_differences[0]},
+                        summary(mc_in)]},
+            {'intensity': [{'using differences':
+                            self.inputs.use_differences[1]},
+                           summary(gz)]}]
+        if scorer.use_norm:
+            stats.insert(3, {'motion_norm': summary(res['normval'])})
+        save_json(statsfile, stats)
+
+    def _detect_outliers_core(self, imgfile, motionfile, runidx, cwd=None):
+        if isinstance(imgfile, list) and len(imgfile) == 1:
+            imgfile = imgfile[0]
+        # Runs split into several files, displacement maps and NIPY motion
+        # parameters are left to ArtifactDetect
+        if isinstance(imgfile, list) or self.inputs.bound_by_brainmask or \
+                self.inputs.parameter_source == 'NIPY':
+            return super(FastArtifactDetect, self)._detect_outliers_core(
+                imgfile, motionfile, runidx, cwd=cwd)
+        if not cwd:
+            cwd = os.getcwd()
+
+        img = nb.load(imgfile, mmap=True)
+        scorer = self._scorer(img.shape)
+        scorer.add_motion(np.loadtxt(motionfile))
+        blocks = volume_blocks(img.shape, self.inputs.chunk_mb * 1024. ** 2)
+        for start, stop in blocks:
+            scorer.add_volumes(read_volumes(img, start, stop))
+        mask = scorer.finish(lambda a, b: read_volumes(img, a, b), blocks)
+        self._write_outputs(scorer, mask, img.affine, imgfile, motionfile,
+                            cwd)
+
+
+# Scores a run while it is written, and writes the outputs of
+# FastArtifactDetect into out_dir as soon as all volumes are in. SPM writes
+# the volumes one after the other, so the size of the file tells how many of
+# them are complete. The motion parameters are written before the volumes.
+def watch(realigned_file, motion_file, out_dir, interval=2., timeout=3600.,
+          **inputs):
+    realigned_file, motion_file = abspath(realigned_file), abspath(motion_file)
+    if not exists(out_dir):
+        os.makedirs(out_dir)
+    iface = FastArtifactDetect(**inputs)
+    start_time = time.time()
+
+    def waiting():
+        if time.time() - start_time > timeout:
+            raise RuntimeError('%s was not completed within %d s'
+                               % (realigned_file, timeout))
+        time.sleep(interval)
+        return True
+
+    img = None
+    while img is None and waiting():
+        try:
+            # Reads the file only where volumes are requested
+            img = nb.load(realigned_file, mmap=False)
+        except Exception:
+            # Not yet there, or the header isn't complete
+            img = None
+    scorer = iface._scorer(img.shape)
+    volume_bytes = int(np.prod(img.shape[:3])) * img.get_data_dtype().itemsize
+    n_vols = img.shape[3]
+    artifactfile = iface._get_output_filenames(realigned_file, out_dir)[0]
+
+    motion = False
+    while len(scorer) < n_vols and waiting():
+        if not motion and exists(motion_file):
+            try:
+                scorer.add_motion(np.loadtxt(motion_file))
+                motion = True
+            except ValueError:
+                # The file isn't complete yet
+                pass
+        written = (os.path.getsize(realigned_file) -
+                   img.dataobj.offset) // volume_bytes
+        written = min(int(written), n_vols)
+        if written > len(scorer):
+            scorer.add_volumes(read_volumes(img, len(scorer), written))
+            save_txt(artifactfile, scorer.results()['outliers'], '%d')
+
+    while not motion and waiting():
+        if exists(motion_file):
+            scorer.add_motion(np.loadtxt(motion_file))
+            motion = True
+    blocks = volume_blocks(img.shape, iface.inputs.chunk_mb * 1024. ** 2)
+    mask = scorer.finish(lambda a, b: read_volumes(img, a, b), blocks)
+    iface._write_outputs(scorer, mask, img.affine, realigned_file,
+                         motion_file, out_dir)
+    return artifactfile
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Artifact detection of a '
+                                                 'run while it is written')
+    parser.add_argument('action', choices=['watch'])
+    parser.add_argument('realigned_file', help='realigned functional run')
+    parser.add_argument('motion_file', help='realignment parameters')
+    parser.add_argument('--out_dir', default='.',
+                        help='folder of the output files')
+    parser.add_argument('--mask_type', default='spm_global',
+                        choices=['spm_global', 'file', 'thresh'])
+    parser.add_argument('--mask_file', default=None,
+                        help='mask image (mask_type file)')
+    parser.add_argument('--mask_threshold', type=float, default=None,
+                        help='intensity threshold (mask_type thresh)')
+    parser.add_argument('--norm_threshold', type=float, default=1.,
+                        help='threshold of the motion norm in mm')
+    parser.add_argument('--zintensity_threshold', type=float, default=3.,
+                        help='threshold of the intensity z-score')
+    parser.add_argument('--parameter_source', default='SPM',
+                        choices=['SPM', 'FSL', 'AFNI', 'FSFAST'])
+    parser.add_argument('--no_motion_differences', action='store_true',
+                        help='use the motion parameters, not their changes')
+    parser.add_argument('--intensity_differences', action='store_true',
+                        help='use the changes of the global intensity')
+    parser.add_argument('--interval', type=float, default=2.,
+                        help='seconds between checks of the file')
+    parser.add_argument('--timeout', type=float, default=3600.,
+                        help='seconds to wait for the complete run')
+    args = parser.parse_args()
+
+    inputs = dict(mask_type=args.mask_type, use_norm=True,
+                  norm_threshold=args.norm_threshold,
+                  zintensity_threshold=args.zintensity_threshold,
+                  parameter_source=args.parameter_source,
+                  use_differences=[not args.no_motion_differences,
+                                   args.intensity_differences])
+    if args.mask_file:
+        inputs['mask_file'] = args.mask_file
+    if args.mask_threshold is not None:
+        inputs['mask_threshold'] = args.mask_threshold
+    print('Outliers written to %s'
+          % watch(args.realigned_file, args.motion_file, args.out_dir,
+                  args.interval, args.timeout, **inputs))
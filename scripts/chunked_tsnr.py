@@ -0,0 +1,139 @@
+###
+# Chunked TSNR - computes the temporal SNR and removes polynomial trends
+# slab by slab, with bounded memory
+#
+# nipype's TSNR loads the whole 4D run into memory. ChunkedTSNR reads the run
+# through nibabel's memory map in blocks of voxels (a few slices, or parts of
+# a slice for very long runs), so that no block is larger than chunk_mb. The
+# polynomial regression of all blocks uses the same precomputed
+# pseudo-inverse of the design, and the detrended data is written directly
+# into a memory-mapped output file:
+#
+#   tsnr = MapNode(ChunkedTSNR(regress_poly=2, detrended_file='detrend.nii',
+#                              chunk_mb=256),
+#                  name='tsnr', iterfield=['in_file'])
+#
+# The outputs are the same as the ones of TSNR, but computed and stored as
+# float32. They differ from TSNR by float32 rounding, i.e. by up to about
+# 1e-5 relative (a few 1e-3 absolute for int16 runs with values around
+# 1000), and are not bit-identical.
+
+import os
+import gzip
+import shutil
+
+import numpy as np
+import nibabel as nb
+from numpy.polynomial import Legendre
+from nipype.algorithms.confounds import TSNR, TSNRInputSpec
+from nipype.interfaces.base import traits, isdefined
+
+
+# Returns the polynomial design of regress_poly and its pseudo-inverse
+def poly_design(degree, timepoints):
+    X = np.ones((timepoints, 1))
+    for i in range(degree):
+        polynomial_func = Legendre.basis(i + 1)
+        value_array = np.linspace(-1, 1, timepoints)
+        X = np.hstack((X, polynomial_func(value_array)[:, np.newaxis]))
+    return X, np.linalg.pinv(X)
+
+
+# Returns the blocks of voxels (slices in y and z) that fit into max_bytes
+def voxel_blocks(shape, timepoints, max_bytes):
+    # Data, fitted trend and detrended data of a block are kept in memory
+    voxel_bytes = timepoints * 4 * 3
+    slice_bytes = shape[0] * shape[1] * voxel_bytes
+    if slice_bytes <= max_bytes:
+        n_z = max(int(max_bytes // slice_bytes), 1)
+        return [(slice(0, shape[1]), slice(z, min(z + n_z, shape[2])))
+                for z in range(0, shape[2], n_z)]
+    n_y = max(int(max_bytes // (shape[0] * voxel_bytes)), 1)
+    return [(slice(y, min(y + n_y, shape[1])), slice(z, z + 1))
+            for z in range(shape[2]) for y in range(0, shape[1], n_y)]
+
+
+# Creates an uncompressed float32 NIfTI file and returns its data memory map
+def create_memmap(filename, shape, affine, header):
+    # The image sets affine and qform/sform codes of the header
+    header = nb.Nifti1Image(np.zeros((1,) * len(shape), np.float32), affine,
+                            header).header
+    header.extensions[:] = []
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(1, 0)
+    header.set_data_offset(352)
+    with open(filename, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\0' * (352 - f.tell()))
+        f.truncate(352 + int(np.prod(shape)) * 4)
+    return np.memmap(filename, dtype=header.get_data_dtype(), mode='r+',
+                     offset=352, shape=shape, order='F')
+
+
+# ChunkedTSNR - TSNR computed block by block over memory-mapped data
+class ChunkedTSNRInputSpec(TSNRInputSpec):
+    chunk_mb = traits.Float(256., usedefault=True,
+                            desc='memory per block of voxels in MB')
+
+
+class ChunkedTSNR(TSNR):
+    input_spec = ChunkedTSNRInputSpec
+
+    def _run_interface(self, runtime):
+        images = [nb.load(f, mmap=True) for f in self.inputs.in_file]
+        img = images[0]
+        shape = img.shape[:3]
+        timepoints = sum(int(np.prod(i.shape[3:])) for i in images)
+        header = img.header.copy()
+        header.set_data_dtype(np.float32)
+
+        regress = isdefined(self.inputs.regress_poly)
+        if regress:
+            X, X_pinv = poly_design(self.inputs.regress_poly, timepoints)
+            detrended_file = os.path.abspath(self.inputs.detrended_file)
+            compress = detrended_file.endswith('.gz')
+            map_file = detrended_file[:-3] if compress else detrended_file
+            detrended = create_memmap(map_file, shape + (timepoints,),
+                                      img.affine, header)
+
+        meanimg = np.zeros(shape, np.float32)
+        stddevimg = np.zeros(shape, np.float32)
+        for ys, zs in voxel_blocks(shape, timepoints,
+                                   self.inputs.chunk_mb * 1024. ** 2):
+            data = np.concatenate(
+                [np.asarray(i.dataobj[:, ys, zs], dtype=np.float32).reshape(
+                    (shape[0], ys.stop - ys.start, zs.stop - zs.start, -1))
+                 for i in images], axis=3)
+            data = np.nan_to_num(data)
+            block_shape = data.shape
+            data = data.reshape((-1, timepoints))
+
+            if regress:
+                # Same as regress_poly(..., remove_mean=False)
+                betas = data.dot(X_pinv.T)
+                data -= betas[:, 1:].dot(X[:, 1:].T)
+                detrended[:, ys, zs] = data.reshape(block_shape)
+
+            meanimg[:, ys, zs] = data.mean(axis=1).reshape(block_shape[:3])
+            stddevimg[:, ys, zs] = data.std(axis=1).reshape(block_shape[:3])
+
+        if regress:
+            detrended.flush()
+            del detrended
+            if compress:
+                with open(map_file, 'rb') as f_in:
+                    with gzip.open(detrended_file, 'wb') as f_out:
+                        shutil.copyfileobj(f_in, f_out, 1 << 24)
+                os.remove(map_file)
+
+        tsnr = np.zeros_like(meanimg)
+        stddevimg_nonzero = stddevimg > 1.0e-3
+        tsnr[stddevimg_nonzero] = (meanimg[stddevimg_nonzero] /
+                                   stddevimg[stddevimg_nonzero])
+        for data, filename in [(tsnr, self.inputs.tsnr_file),
+                               (meanimg, self.inputs.mean_file),
+                               (stddevimg, self.inputs.stddev_file)]:
+            nb.save(nb.Nifti1Image(data, img.affine, header),
+                    os.path.abspath(filename))
+        return runtime
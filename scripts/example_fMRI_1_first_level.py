@@ -1,22 +1,34 @@
 ###
 # Import modules
 from os.path import join as opj
-from nipype.interfaces.afni import Despike
 from nipype.interfaces.freesurfer import (BBRegister, ApplyVolTransform,
                                           Binarize, MRIConvert, FSCommand)
-from nipype.interfaces.spm import (SliceTiming, Realign, Smooth, Level1Design,
-                                   EstimateModel, EstimateContrast)
+from nipype.interfaces.spm import (Smooth, Level1Design, EstimateModel,
+                                   EstimateContrast)
 from nipype.interfaces.utility import Function, IdentityInterface
-from nipype.interfaces.io import FreeSurferSource, SelectFiles, DataSink
-from nipype.algorithms.rapidart import ArtifactDetect
-from nipype.algorithms.misc import TSNR, Gunzip
+from nipype.interfaces.io import FreeSurferSource, DataSink
 from nipype.algorithms.modelgen import SpecifySPMModel
 from nipype.pipeline.engine import Workflow, Node, MapNode
+from onset_cache import load_onsets, get_subject_info
+from subject_index import build_index, SubjectFiles
+from fused_preproc import FusedPreproc
+from slice_timing import timing_table, slice_timing_inputs
+from parallel_despike import ParallelDespike
+from chunked_tsnr import ChunkedTSNR
+from art_stream import FastArtifactDetect
+from glm import NumpyGLM
+from multiproc_plugins import CriticalPathMultiProcPlugin
 
 # MATLAB - Specify path to current SPM and the MATLAB's default mode
 from nipype.interfaces.matlab import MatlabCommand
 MatlabCommand.set_default_paths('/usr/local/MATLAB/R2014a/toolbox/spm12')
-MatlabCommand.set_default_matlab_cmd("matlab -nodesktop -nosplash")
+
+# MATLAB - Send the m-code of all SPM nodes to the MATLAB pool if one is
+#   running (see matlab_pool.py), otherwise start MATLAB for every node
+from matlab_pool import pool_matlab_cmd
+MatlabCommand.set_default_matlab_cmd(
+    pool_matlab_cmd('~/nipype_tutorial/matlab_pool',
+                    "matlab -nodesktop -nosplash"))
 
 # FreeSurfer - Specify the location of the freesurfer folder
 fs_dir = '~/nipype_tutorial/freesurfer'
@@ -35,45 +47,51 @@ working_dir = 'workingdir_fMRI_example_1st'   # name of 1st-level working direct
 
 number_of_slices = 40                         # number of slices in volume
 TR = 2.0                                      # time repetition of volume
+slice_scheme = 'interleaved'                  # order of slice acquisition
+multiband_factor = 1                          # slices acquired at the same time
 fwhm_size = 6                                 # size of FWHM in mm
+glm_backend = 'spm'                           # 'spm' or 'numpy' (see glm.py)
 
 
 ###
 # Specify Preprocessing Nodes
 
-# Despike - Removes 'spikes' from the 3D+time input dataset
-despike = MapNode(Despike(outputtype='NIFTI'),
+# Despike - Removes 'spikes' from the 3D+time input dataset. Slabs of at
+#   most chunk_mb are despiked by num_threads 3dDespike processes at once
+despike = MapNode(ParallelDespike(outputtype='NIFTI', num_threads=4,
+                                  chunk_mb=256),
                   name="despike", iterfield=['in_file'])
 
-# Slicetiming - correct for slice wise acquisition
-interleaved_order = range(1,number_of_slices+1,2) + range(2,number_of_slices+1,2)
-sliceTiming = Node(SliceTiming(num_slices=number_of_slices,
-                               time_repetition=TR,
-                               time_acquisition=TR-TR/number_of_slices,
-                               slice_order=interleaved_order,
-                               ref_slice=2),
-                   name="sliceTiming")
-
-# Realign - correct for motion
-realign = Node(Realign(register_to_mean=True),
-               name="realign")
-
-# TSNR - remove polynomials 2nd order
-tsnr = MapNode(TSNR(regress_poly=2),
+# Slicetiming & Realign - correct for slice wise acquisition and for motion,
+#   in one MATLAB session. The slice time corrected images are deleted
+#   afterwards. Smoothing is done later on the detrended images.
+#   The slice order (slice times with multiband) comes from the cached
+#   timing table of the protocol (see slice_timing.py and prepare_inputs
+#   below).
+sliceTimingRealign = Node(FusedPreproc(register_to_mean=True),
+                          name="sliceTimingRealign")
+
+# TSNR - remove polynomials 2nd order. The detrended file is written
+#   uncompressed, so that SPM can read it without unzipping it first. The
+#   run is processed in blocks of voxels of at most chunk_mb, so that long
+#   runs don't need more memory.
+tsnr = MapNode(ChunkedTSNR(regress_poly=2,
+                           detrended_file='detrend.nii',
+                           chunk_mb=256),
                name='tsnr', iterfield=['in_file'])
 
 # Artifact Detection - determine which of the images in the functional series
 #   are outliers. This is based on deviation in intensity or movement.
-art = Node(ArtifactDetect(norm_threshold=1,
-                          zintensity_threshold=3,
-                          mask_type='file',
-                          parameter_source='SPM',
-                          use_differences=[True, False]),
+#   The volumes are read in blocks of chunk_mb through a memory map and
+#   scored with array operations (see art_stream.py)
+art = Node(FastArtifactDetect(norm_threshold=1,
+                              zintensity_threshold=3,
+                              mask_type='file',
+                              parameter_source='SPM',
+                              use_differences=[True, False],
+                              chunk_mb=256),
            name="art")
 
-# Gunzip - unzip functional
-gunzip = MapNode(Gunzip(), name="gunzip", iterfield=['in_file'])
-
 # Smooth - to smooth the images with a given kernel
 smooth = Node(Smooth(fwhm=fwhm_size),
               name="smooth")
@@ -107,19 +125,19 @@ binarize = Node(Binarize(min=0.5,
 preproc = Workflow(name='preproc')
 
 # Connect all components of the preprocessing workflow
-preproc.connect([(despike, sliceTiming, [('out_file', 'in_files')]),
-                 (sliceTiming, realign, [('timecorrected_files', 'in_files')]),
-                 (realign, tsnr, [('realigned_files', 'in_file')]),
+preproc.connect([(despike, sliceTimingRealign, [('out_file', 'in_files')]),
+                 (sliceTimingRealign, tsnr, [('realigned_files', 'in_file')]),
                  (tsnr, art, [('detrended_file', 'realigned_files')]),
-                 (realign, art, [('mean_image', 'mask_file'),
-                                 ('realignment_parameters',
-                                  'realignment_parameters')]),
-                 (tsnr, gunzip, [('detrended_file', 'in_file')]),
-                 (gunzip, smooth, [('out_file', 'in_files')]),
-                 (realign, bbregister, [('mean_image', 'source_file')]),
+                 (sliceTimingRealign, art, [('mean_image', 'mask_file'),
+                                            ('realignment_parameters',
+                                             'realignment_parameters')]),
+                 (tsnr, smooth, [('detrended_file', 'in_files')]),
+                 (sliceTimingRealign, bbregister, [('mean_image',
+                                                    'source_file')]),
                  (fssource, applyVolTrans, [('brainmask', 'target_file')]),
                  (bbregister, applyVolTrans, [('out_reg_file', 'reg_file')]),
-                 (realign, applyVolTrans, [('mean_image', 'source_file')]),
+                 (sliceTimingRealign, applyVolTrans, [('mean_image',
+                                                       'source_file')]),
                  (applyVolTrans, binarize, [('transformed_file', 'in_file')]),
                  ])
 
@@ -149,6 +167,17 @@ level1estimate = Node(EstimateModel(estimation_method={'Classical': 1}),
 # EstimateContrast - estimates contrasts
 conestimate = Node(EstimateContrast(), name="conestimate")
 
+# NumpyGLM - the same design, estimation and contrasts without MATLAB. The
+#   voxels are fitted in blocks of chunk_mb by num_threads threads. Subjects
+#   and reruns with the same timing share the convolved conditions of the
+#   design cache.
+glm = Node(NumpyGLM(interscan_interval=TR,
+                    model_serial_correlations='AR(1)',
+                    num_threads=4,
+                    chunk_mb=256,
+                    design_cache=opj(experiment_dir, 'design_cache')),
+           name="glm")
+
 # Volume Transformation - transform contrasts into anatomical space
 applyVolReg = MapNode(ApplyVolTransform(fs_target=True),
                       name='applyVolReg',
@@ -167,19 +196,27 @@ mriconvert = MapNode(MRIConvert(out_type='niigz'),
 l1analysis = Workflow(name='l1analysis')
 
 # Connect up the 1st-level analysis components
-l1analysis.connect([(modelspec, level1design, [('session_info',
-                                                'session_info')]),
-                    (level1design, level1estimate, [('spm_mat_file',
-                                                     'spm_mat_file')]),
-                    (level1estimate, conestimate, [('spm_mat_file',
-                                                    'spm_mat_file'),
-                                                   ('beta_images',
-                                                    'beta_images'),
-                                                   ('residual_image',
-                                                    'residual_image')]),
-                    (conestimate, applyVolReg, [('con_images',
-                                                 'source_file')]),
-                    (applyVolReg, mriconvert, [('transformed_file',
+if glm_backend == 'spm':
+    l1analysis.connect([(modelspec, level1design, [('session_info',
+                                                    'session_info')]),
+                        (level1design, level1estimate, [('spm_mat_file',
+                                                         'spm_mat_file')]),
+                        (level1estimate, conestimate, [('spm_mat_file',
+                                                        'spm_mat_file'),
+                                                       ('beta_images',
+                                                        'beta_images'),
+                                                       ('residual_image',
+                                                        'residual_image')]),
+                        (conestimate, applyVolReg, [('con_images',
+                                                     'source_file')]),
+                        ])
+    model, glm_outputs = 'level1design', 'conestimate'
+else:
+    l1analysis.connect([(modelspec, glm, [('session_info', 'session_info')]),
+                        (glm, applyVolReg, [('con_images', 'source_file')]),
+                        ])
+    model, glm_outputs = 'glm', 'glm'
+l1analysis.connect([(applyVolReg, mriconvert, [('transformed_file',
                                                 'in_file')]),
                     ])
 
@@ -189,14 +226,14 @@ l1analysis.connect([(modelspec, level1design, [('session_info',
 metaflow = Workflow(name='metaflow')
 metaflow.base_dir = opj(experiment_dir, working_dir)
 
-metaflow.connect([(preproc, l1analysis, [('realign.realignment_parameters',
+metaflow.connect([(preproc, l1analysis, [('sliceTimingRealign.realignment_parameters',
                                           'modelspec.realignment_parameters'),
                                          ('smooth.smoothed_files',
                                           'modelspec.functional_runs'),
                                          ('art.outlier_files',
                                           'modelspec.outlier_files'),
                                          ('binarize.binary_file',
-                                          'level1design.mask_image'),
+                                          model + '.mask_image'),
                                          ('bbregister.out_reg_file',
                                           'applyVolReg.reg_file'),
                                          ]),
@@ -219,60 +256,9 @@ cont06 = ['Diff vs zero', 'F', [cont03, cont04]]
 
 contrast_list = [cont01, cont02, cont03, cont04, cont05, cont06]
 
-# Function to get Subject specific condition information
-def get_subject_info(subject_id):
-    from os.path import join as opj
-    path = '~/nipype_tutorial/data/%s' % subject_id
-    onset_info = []
-    for run in ['01', '02']:
-        for cond in ['01', '02', '03', '04']:
-            onset_file = opj(path, 'onset_run0%s_cond0%s.txt'%(run, cond))
-            with open(onset_file, 'rt') as f:
-                for line in f:
-                    info = line.strip().split()
-                    if info[1] != '0.00':
-                        onset_info.append(['cond0%s'%cond,
-                                           'run0%s'%run,
-                                           float(info[0])])
-    onset_run1_congruent = []
-    onset_run1_incongruent = []
-    onset_run2_congruent = []
-    onset_run2_incongruent = []
-
-    for info in onset_info:
-        if info[1] == 'run001':
-            if info[0] == 'cond001' or info[0] == 'cond002':
-                onset_run1_congruent.append(info[2])
-            elif info[0] == 'cond003' or info[0] == 'cond004':
-                onset_run1_incongruent.append(info[2])
-        if info[1] == 'run002':
-            if info[0] == 'cond001' or info[0] == 'cond002':
-                onset_run2_congruent.append(info[2])
-            elif info[0] == 'cond003' or info[0] == 'cond004':
-                onset_run2_incongruent.append(info[2])
-
-    onset_list = [sorted(onset_run1_congruent), sorted(onset_run1_incongruent),
-                  sorted(onset_run2_congruent), sorted(onset_run2_incongruent)]
-
-    from nipype.interfaces.base import Bunch
-    condition_names = ['congruent', 'incongruent']
-
-    subjectinfo = []
-    for r in range(2):
-        onsets = [onset_list[r*2], onset_list[r*2+1]]
-        subjectinfo.insert(r,
-                           Bunch(conditions=condition_names,
-                                 onsets=onsets,
-                                 durations=[[0], [0]],
-                                 amplitudes=None,
-                                 tmod=None,
-                                 pmod=None,
-                                 regressor_names=None,
-                                 regressors=None))
-    return subjectinfo
-
-# Get Subject Info - get subject specific condition information
-getsubjectinfo = Node(Function(input_names=['subject_id'],
+# Get Subject Info - get subject specific condition information from the
+#   onset cache (see prepare_inputs below)
+getsubjectinfo = Node(Function(input_names=['subject_id', 'onset_cache'],
                                output_names=['subject_info'],
                                function=get_subject_info),
                       name='getsubjectinfo')
@@ -288,12 +274,33 @@ infosource = Node(IdentityInterface(fields=['subject_id',
                   name="infosource")
 infosource.iterables = [('subject_id', subject_list)]
 
-# SelectFiles - to grab the data (alternativ to DataGrabber)
-templates = {'func': 'data/{subject_id}/run*.nii.gz'}
-selectfiles = Node(SelectFiles(templates,
-                               base_directory=experiment_dir),
+# SubjectFiles - to grab the data from the subject index (alternative to
+#   SelectFiles, but without globbing the data folder for every subject)
+selectfiles = Node(SubjectFiles(),
+                   run_without_submitting=True,
                    name="selectfiles")
 
+
+# Prepare Inputs - reads the slice timing of the protocol from its cache,
+#   parses the onset files of all subjects once into a cache file, from
+#   which getsubjectinfo creates the subject specific Bunch, and indexes the
+#   data folder for selectfiles. All of them write into the experiment
+#   folder, so they only run right before the workflow and not on import.
+def prepare_inputs():
+    slice_timing = timing_table('stroop',
+                                opj(experiment_dir, 'slice_timing_cache.json'),
+                                num_slices=number_of_slices,
+                                time_repetition=TR, scheme=slice_scheme,
+                                multiband=multiband_factor)
+    for name, value in slice_timing_inputs(slice_timing,
+                                           ref_slice=2).items():
+        setattr(sliceTimingRealign.inputs, name, value)
+    getsubjectinfo.inputs.onset_cache = load_onsets(opj(experiment_dir,
+                                                        'data'),
+                                                    subject_list)
+    index = build_index(opj(experiment_dir, 'data'))
+    selectfiles.inputs.index_file = index['index_file']
+
 # Datasink - creates output folder for important outputs
 datasink = Node(DataSink(base_directory=experiment_dir,
                          container=output_dir),
@@ -317,10 +324,10 @@ metaflow.connect([(infosource, selectfiles, [('subject_id', 'subject_id')]),
                   (getsubjectinfo, l1analysis, [('subject_info',
                                                  'modelspec.subject_info')]),
                   (infosource, l1analysis, [('contrasts',
-                                             'conestimate.contrasts')]),
-                  (preproc, datasink, [('realign.mean_image',
+                                             glm_outputs + '.contrasts')]),
+                  (preproc, datasink, [('sliceTimingRealign.mean_image',
                                         'preprocout.@mean'),
-                                       ('realign.realignment_parameters',
+                                       ('sliceTimingRealign.realignment_parameters',
                                         'preprocout.@parameters'),
                                        ('art.outlier_files',
                                         'preprocout.@outliers'),
@@ -337,17 +344,31 @@ metaflow.connect([(infosource, selectfiles, [('subject_id', 'subject_id')]),
                                        ]),
                   (l1analysis, datasink, [('mriconvert.out_file',
                                            'contrasts.@contrasts'),
-                                          ('conestimate.spm_mat_file',
-                                           'contrasts.@spm_mat'),
-                                          ('conestimate.spmT_images',
+                                          (glm_outputs + '.spmT_images',
                                            'contrasts.@T'),
-                                          ('conestimate.con_images',
+                                          (glm_outputs + '.con_images',
                                            'contrasts.@con'),
                                           ]),
                   ])
+if glm_backend == 'spm':
+    metaflow.connect([(l1analysis, datasink, [('conestimate.spm_mat_file',
+                                               'contrasts.@spm_mat')]),
+                      ])
+else:
+    metaflow.connect([(l1analysis, datasink, [('glm.design_file',
+                                               'contrasts.@design')]),
+                      ])
 
 
 ###
-# Run Workflow
-metaflow.write_graph(graph2use='colored')
-metaflow.run('MultiProc', plugin_args={'n_procs': 8})
+# Run Workflow - only if run as script, example_fMRI_pipeline.py imports
+#   the workflow
+if __name__ == '__main__':
+    prepare_inputs()
+    metaflow.write_graph(graph2use='colored')
+    # Ready nodes are started in the order of their longest remaining path,
+    #   estimated from the runtimes of earlier runs (see multiproc_plugins.py)
+    metaflow.run(plugin=CriticalPathMultiProcPlugin(
+        plugin_args={'n_procs': 8,
+                     'runtime_history': opj(experiment_dir,
+                                            'runtime_history.json')}))
@@ -1,13 +1,17 @@
 ###
 # Import modules
 from os.path import join as opj
-from nipype.interfaces.ants import Registration, ApplyTransforms
+from nipype.interfaces.ants import ApplyTransforms
 from nipype.interfaces.freesurfer import FSCommand, MRIConvert, BBRegister
 from nipype.interfaces.c3 import C3dAffineTool
-from nipype.interfaces.utility import IdentityInterface, Merge
-from nipype.interfaces.io import SelectFiles, DataSink, FreeSurferSource
-from nipype.pipeline.engine import Workflow, Node, MapNode
+from nipype.interfaces.utility import IdentityInterface, Merge, Function
+from nipype.interfaces.io import DataSink, FreeSurferSource
+from nipype.pipeline.engine import Workflow, Node
 from nipype.interfaces.fsl import Info
+from file_index import build_file_index, IndexedSelectFiles
+from registration_profiles import GatedRegistration
+from multiproc_plugins import ElasticMultiProcPlugin
+from warp_batch import stack_images, split_images
 
 # FreeSurfer - Specify the location of the freesurfer folder
 fs_dir = '~/nipype_tutorial/freesurfer'
@@ -28,42 +32,53 @@ subject_list = ['sub001', 'sub002', 'sub003',
 # location of template file
 template = Info.standard_image('MNI152_T1_1mm_brain.nii.gz')
 
+# location of the transform store, shared by the partial and the complete
+#   normalization, so that each registration is only computed once
+transform_store = opj(experiment_dir, 'transform_store')
+
 
 ###
 # Specify Normalization Nodes
 
 # Registration - computes registration between subject's structural and MNI template.
-antsreg = Node(Registration(args='--float',
-                            collapse_output_transforms=True,
-                            fixed_image=template,
-                            initial_moving_transform_com=True,
-                            num_threads=1,
-                            output_inverse_warped_image=True,
-                            output_warped_image=True,
-                            sigma_units=['vox']*3,
-                            transforms=['Rigid', 'Affine', 'SyN'],
-                            terminal_output='file',
-                            winsorize_lower_quantile=0.005,
-                            winsorize_upper_quantile=0.995,
-                            convergence_threshold=[1e-06],
-                            convergence_window_size=[10],
-                            metric=['MI', 'MI', 'CC'],
-                            metric_weight=[1.0]*3,
-                            number_of_iterations=[[1000, 500, 250, 100],
-                                                  [1000, 500, 250, 100],
-                                                  [100, 70, 50, 20]],
-                            radius_or_number_of_bins=[32, 32, 4],
-                            sampling_percentage=[0.25, 0.25, 1],
-                            sampling_strategy=['Regular',
-                                               'Regular',
-                                               'None'],
-                            shrink_factors=[[8, 4, 2, 1]]*3,
-                            smoothing_sigmas=[[3, 2, 1, 0]]*3,
-                            transform_parameters=[(0.1,),
-                                                  (0.1,),
-                                                  (0.1, 3.0, 0.0)],
-                            use_histogram_matching=True,
-                            write_composite_transform=True),
+#   Registrations that are already in the transform store are reused. The
+#   fast profile is run first, only subjects that fail the quality check
+#   (correlation with the template below min_similarity) are registered
+#   again with the full profile (see registration_profiles.py).
+antsreg = Node(GatedRegistration(args='--float',
+                                 collapse_output_transforms=True,
+                                 fixed_image=template,
+                                 initial_moving_transform_com=True,
+                                 num_threads=1,
+                                 output_inverse_warped_image=True,
+                                 output_warped_image=True,
+                                 sigma_units=['vox']*3,
+                                 transforms=['Rigid', 'Affine', 'SyN'],
+                                 terminal_output='file',
+                                 winsorize_lower_quantile=0.005,
+                                 winsorize_upper_quantile=0.995,
+                                 convergence_threshold=[1e-06],
+                                 convergence_window_size=[10],
+                                 metric=['MI', 'MI', 'CC'],
+                                 metric_weight=[1.0]*3,
+                                 number_of_iterations=[[1000, 500, 250, 100],
+                                                       [1000, 500, 250, 100],
+                                                       [100, 70, 50, 20]],
+                                 radius_or_number_of_bins=[32, 32, 4],
+                                 sampling_percentage=[0.25, 0.25, 1],
+                                 sampling_strategy=['Regular',
+                                                    'Regular',
+                                                    'None'],
+                                 shrink_factors=[[8, 4, 2, 1]]*3,
+                                 smoothing_sigmas=[[3, 2, 1, 0]]*3,
+                                 transform_parameters=[(0.1,),
+                                                       (0.1,),
+                                                       (0.1, 3.0, 0.0)],
+                                 use_histogram_matching=True,
+                                 write_composite_transform=True,
+                                 transform_store=transform_store,
+                                 profile='gated',
+                                 min_similarity=0.8),
                name='antsreg')
 
 # FreeSurferSource - Data grabber specific for FreeSurfer data
@@ -88,25 +103,32 @@ convert2itk = Node(C3dAffineTool(fsl2ras=True,
 # Concatenate BBRegister's and ANTS' transforms into a list
 merge = Node(Merge(2), iterfield=['in2'], name='mergexfm')
 
-# Transform the contrast images. First to anatomical and then to the target
-warpall = MapNode(ApplyTransforms(args='--float',
-                                  input_image_type=3,
-                                  interpolation='Linear',
-                                  invert_transform_flags=[False, False],
-                                  num_threads=1,
-                                  reference_image=template,
-                                  terminal_output='file'),
-                  name='warpall', iterfield=['input_image'])
-
-# Transform the mean image. First to anatomical and then to the target
-warpmean = Node(ApplyTransforms(args='--float',
-                                input_image_type=3,
-                                interpolation='Linear',
-                                invert_transform_flags=[False, False],
-                                num_threads=1,
-                                reference_image=template,
-                                terminal_output='file'),
-                name='warpmean')
+# Concatenate the contrast images and the mean image into a list
+mergeimages = Node(Merge(2), name='mergeimages')
+
+# Stack the contrast and mean images into one 4D image
+stackimages = Node(Function(input_names=['in_files'],
+                            output_names=['stacked_file', 'out_names'],
+                            function=stack_images),
+                   name='stackimages')
+
+# Transform the contrast and mean images. First to anatomical and then to the
+#   target. All images are warped as volumes of one 4D image, so that the
+#   transforms and the template are only read once.
+warpall = Node(ApplyTransforms(args='--float',
+                               input_image_type=3,
+                               interpolation='Linear',
+                               invert_transform_flags=[False, False],
+                               num_threads=1,
+                               reference_image=template,
+                               terminal_output='file'),
+               name='warpall')
+
+# Split the warped 4D image into one image per contrast and the mean image
+splitimages = Node(Function(input_names=['in_file', 'out_names'],
+                            output_names=['out_files'],
+                            function=split_images),
+                   name='splitimages')
 
 
 ###
@@ -124,8 +146,11 @@ normflow.connect([(fssource, convert2nii, [('T1', 'in_file')]),
                   (convert2itk, merge, [('itk_transform', 'in2')]),
                   (antsreg, merge, [('composite_transform',
                                      'in1')]),
-                  (merge, warpmean, [('out', 'transforms')]),
                   (merge, warpall, [('out', 'transforms')]),
+                  (mergeimages, stackimages, [('out', 'in_files')]),
+                  (stackimages, warpall, [('stacked_file', 'input_image')]),
+                  (warpall, splitimages, [('output_image', 'in_file')]),
+                  (stackimages, splitimages, [('out_names', 'out_names')]),
                   ])
 
 
@@ -137,7 +162,9 @@ infosource = Node(IdentityInterface(fields=['subject_id']),
                   name="infosource")
 infosource.iterables = [('subject_id', subject_list)]
 
-# SelectFiles - to grab the data (alternative to DataGrabber)
+# SelectFiles - to grab the data (alternative to DataGrabber), all templates
+#   are looked up in an index of the input folders that is created once
+#   (see prepare_inputs below)
 anat_file = opj('freesurfer', '{subject_id}', 'mri/brain.mgz')
 func_file = opj(input_dir_1st, 'contrasts', '{subject_id}',
                 '_mriconvert*/*_out.nii.gz')
@@ -150,19 +177,26 @@ templates = {'anat': anat_file,
              'mean': mean_file,
              }
 
-selectfiles = Node(SelectFiles(templates,
-                               base_directory=experiment_dir),
+selectfiles = Node(IndexedSelectFiles(templates,
+                                      base_directory=experiment_dir),
                    name="selectfiles")
 
+
+# Prepare Inputs - indexes the input folders of selectfiles. The index is
+#   written into the working directory, so it is only built right before the
+#   workflow runs and not on import.
+def prepare_inputs():
+    selectfiles.inputs.index_file = build_file_index(
+        experiment_dir, templates,
+        opj(experiment_dir, working_dir, 'file_index.json'))
+
 # Datasink - creates output folder for important outputs
 datasink = Node(DataSink(base_directory=experiment_dir,
                          container=output_dir),
                 name="datasink")
 
 # Use the following DataSink output substitutions
-substitutions = [('_subject_id_', ''),
-                 ('_apply2con', 'apply2con'),
-                 ('_warpall', 'warpall')]
+substitutions = [('_subject_id_', '')]
 datasink.inputs.substitutions = substitutions
 
 # Connect SelectFiles and DataSink to the workflow
@@ -172,8 +206,8 @@ normflow.connect([(infosource, selectfiles, [('subject_id', 'subject_id')]),
                   (selectfiles, bbregister, [('mean', 'source_file')]),
                   (selectfiles, antsreg, [('anat', 'moving_image')]),
                   (selectfiles, convert2itk, [('mean', 'source_file')]),
-                  (selectfiles, warpall, [('func_orig', 'input_image')]),
-                  (selectfiles, warpmean, [('mean', 'input_image')]),
+                  (selectfiles, mergeimages, [('func_orig', 'in1'),
+                                              ('mean', 'in2')]),
                   (antsreg, datasink, [('warped_image',
                                         'antsreg.@warped_image'),
                                        ('inverse_warped_image',
@@ -182,12 +216,18 @@ normflow.connect([(infosource, selectfiles, [('subject_id', 'subject_id')]),
                                         'antsreg.@transform'),
                                        ('inverse_composite_transform',
                                         'antsreg.@inverse_transform')]),
-                  (warpall, datasink, [('output_image', 'warp_complete.@warpall')]),
-                  (warpmean, datasink, [('output_image', 'warp_complete.@warpmean')]),
+                  (splitimages, datasink, [('out_files',
+                                            'warp_complete.@warpall')]),
                   ])
 
 
 ###
-# Run Workflow
-normflow.write_graph(graph2use='colored')
-normflow.run('MultiProc', plugin_args={'n_procs': 8})
+# Run Workflow - only if run as script, example_fMRI_pipeline.py imports the
+#   workflow
+if __name__ == '__main__':
+    prepare_inputs()
+    normflow.write_graph(graph2use='colored')
+    # The number of threads of the ANTs nodes (num_threads=1 above) is chosen
+    #   when they are started, so that they use the cores that are idle at
+    #   the end of a batch
+    normflow.run(plugin=ElasticMultiProcPlugin(plugin_args={'n_procs': 8}))
@@ -1,13 +1,16 @@
 ###
 # Import modules
-from opj import join as opj
-from nipype.interfaces.ants import Registration, ApplyTransforms
+from os.path import join as opj
+from nipype.interfaces.ants import ApplyTransforms
 from nipype.interfaces.freesurfer import FSCommand, MRIConvert, BBRegister
 from nipype.interfaces.c3 import C3dAffineTool
 from nipype.interfaces.utility import IdentityInterface, Merge
-from nipype.interfaces.io import SelectFiles, DataSink, FreeSurferSource
+from nipype.interfaces.io import DataSink, FreeSurferSource
 from nipype.pipeline.engine import Workflow, Node, MapNode
 from nipype.interfaces.fsl import Info
+from file_index import build_file_index, IndexedSelectFiles
+from registration_profiles import GatedRegistration
+from multiproc_plugins import ElasticMultiProcPlugin
 
 # FreeSurfer - Specify the location of the freesurfer folder
 fs_dir = '~/nipype_tutorial/freesurfer'
@@ -28,42 +31,53 @@ subject_list = ['sub001', 'sub002', 'sub003',
 # location of template file
 template = Info.standard_image('MNI152_T1_1mm_brain.nii.gz')
 
+# location of the transform store, shared by the partial and the complete
+#   normalization, so that each registration is only computed once
+transform_store = opj(experiment_dir, 'transform_store')
+
 
 ###
 # Specify Normalization Nodes
 
 # Registration - computes registration between subject's structural and MNI template.
-antsreg = Node(Registration(args='--float',
-                            collapse_output_transforms=True,
-                            fixed_image=template,
-                            initial_moving_transform_com=True,
-                            num_threads=1,
-                            output_inverse_warped_image=True,
-                            output_warped_image=True,
-                            sigma_units=['vox']*3,
-                            transforms=['Rigid', 'Affine', 'SyN'],
-                            terminal_output='file',
-                            winsorize_lower_quantile=0.005,
-                            winsorize_upper_quantile=0.995,
-                            convergence_threshold=[1e-06],
-                            convergence_window_size=[10],
-                            metric=['MI', 'MI', 'CC'],
-                            metric_weight=[1.0]*3,
-                            number_of_iterations=[[1000, 500, 250, 100],
-                                                  [1000, 500, 250, 100],
-                                                  [100, 70, 50, 20]],
-                            radius_or_number_of_bins=[32, 32, 4],
-                            sampling_percentage=[0.25, 0.25, 1],
-                            sampling_strategy=['Regular',
-                                               'Regular',
-                                               'None'],
-                            shrink_factors=[[8, 4, 2, 1]]*3,
-                            smoothing_sigmas=[[3, 2, 1, 0]]*3,
-                            transform_parameters=[(0.1,),
-                                                  (0.1,),
-                                                  (0.1, 3.0, 0.0)],
-                            use_histogram_matching=True,
-                            write_composite_transform=True),
+#   Registrations that are already in the transform store are reused. The
+#   fast profile is run first, only subjects that fail the quality check
+#   (correlation with the template below min_similarity) are registered
+#   again with the full profile (see registration_profiles.py).
+antsreg = Node(GatedRegistration(args='--float',
+                                 collapse_output_transforms=True,
+                                 fixed_image=template,
+                                 initial_moving_transform_com=True,
+                                 num_threads=1,
+                                 output_inverse_warped_image=True,
+                                 output_warped_image=True,
+                                 sigma_units=['vox']*3,
+                                 transforms=['Rigid', 'Affine', 'SyN'],
+                                 terminal_output='file',
+                                 winsorize_lower_quantile=0.005,
+                                 winsorize_upper_quantile=0.995,
+                                 convergence_threshold=[1e-06],
+                                 convergence_window_size=[10],
+                                 metric=['MI', 'MI', 'CC'],
+                                 metric_weight=[1.0]*3,
+                                 number_of_iterations=[[1000, 500, 250, 100],
+                                                       [1000, 500, 250, 100],
+                                                       [100, 70, 50, 20]],
+                                 radius_or_number_of_bins=[32, 32, 4],
+                                 sampling_percentage=[0.25, 0.25, 1],
+                                 sampling_strategy=['Regular',
+                                                    'Regular',
+                                                    'None'],
+                                 shrink_factors=[[8, 4, 2, 1]]*3,
+                                 smoothing_sigmas=[[3, 2, 1, 0]]*3,
+                                 transform_parameters=[(0.1,),
+                                                       (0.1,),
+                                                       (0.1, 3.0, 0.0)],
+                                 use_histogram_matching=True,
+                                 write_composite_transform=True,
+                                 transform_store=transform_store,
+                                 profile='gated',
+                                 min_similarity=0.8),
                name='antsreg')
 
 # Apply Transformation - applies the normalization matrix to contrast images
@@ -92,7 +106,7 @@ apply2mean = Node(ApplyTransforms(args='--float',
 
 # Initiation of the ANTS normalization workflow
 normflow = Workflow(name='normflow')
-normflow.base_dir = opj.join(experiment_dir, working_dir)
+normflow.base_dir = opj(experiment_dir, working_dir)
 
 # Connect up ANTS normalization components
 normflow.connect([(antsreg, apply2con, [('composite_transform', 'transforms')]),
@@ -109,7 +123,9 @@ infosource = Node(IdentityInterface(fields=['subject_id']),
                   name="infosource")
 infosource.iterables = [('subject_id', subject_list)]
 
-# SelectFiles - to grab the data (alternative to DataGrabber)
+# SelectFiles - to grab the data (alternative to DataGrabber), all templates
+#   are looked up in an index of the input folders that is created once
+#   right before the run
 anat_file = opj('freesurfer', '{subject_id}', 'mri/brain.mgz')
 func_file = opj(input_dir_1st, 'contrasts', '{subject_id}',
                 '_mriconvert*/*_out.nii.gz')
@@ -122,8 +138,8 @@ templates = {'anat': anat_file,
              'mean': mean_file,
              }
 
-selectfiles = Node(SelectFiles(templates,
-                               base_directory=experiment_dir),
+selectfiles = Node(IndexedSelectFiles(templates,
+                                      base_directory=experiment_dir),
                    name="selectfiles")
 
 # Datasink - creates output folder for important outputs
@@ -159,5 +175,12 @@ normflow.connect([(infosource, selectfiles, [('subject_id', 'subject_id')]),
 
 ###
 # Run Workflow
+# Index the input folders of selectfiles
+selectfiles.inputs.index_file = build_file_index(
+    experiment_dir, templates,
+    opj(experiment_dir, working_dir, 'file_index.json'))
 normflow.write_graph(graph2use='colored')
-normflow.run('MultiProc', plugin_args={'n_procs': 8})
+# The number of threads of the ANTs nodes (num_threads=1 above) is chosen
+#   when they are started, so that they use the cores that are idle at the
+#   end of a batch
+normflow.run(plugin=ElasticMultiProcPlugin(plugin_args={'n_procs': 8}))
@@ -3,14 +3,22 @@
 from os.path import join as opj
 from nipype.interfaces.spm import Normalize12
 from nipype.interfaces.utility import IdentityInterface
-from nipype.interfaces.io import SelectFiles, DataSink
-from nipype.algorithms.misc import Gunzip
+from nipype.interfaces.io import DataSink
 from nipype.pipeline.engine import Workflow, Node, MapNode
+from subject_index import build_index, SubjectFiles
+from file_index import build_file_index, IndexedSelectFiles
+from gunzip_cache import CachedGunzip
 
 # Specification to MATLAB
 from nipype.interfaces.matlab import MatlabCommand
 MatlabCommand.set_default_paths('/usr/local/MATLAB/R2014a/toolbox/spm12')
-MatlabCommand.set_default_matlab_cmd("matlab -nodesktop -nosplash")
+
+# MATLAB - Send the m-code of all SPM nodes to the MATLAB pool if one is
+#   running (see matlab_pool.py), otherwise start MATLAB for every node
+from matlab_pool import pool_matlab_cmd
+MatlabCommand.set_default_matlab_cmd(
+    pool_matlab_cmd('~/nipype_tutorial/matlab_pool',
+                    "matlab -nodesktop -nosplash"))
 
 
 ###
@@ -27,15 +35,20 @@ subject_list = ['sub001', 'sub002', 'sub003',
 # location of template in form of a tissue probability map to normalize to
 template = '/usr/local/MATLAB/R2014a/toolbox/spm12/tpm/TPM.nii'
 
+# location of the gunzip cache, shared by all scripts
+gunzip_cache = opj(experiment_dir, 'gunzip_cache')
+
 
 ###
 # Specify Normalization Nodes
 
-# Gunzip - unzip the structural image
-gunzip_struct = Node(Gunzip(), name="gunzip_struct")
+# Gunzip - unzip the structural image. Files that were unzipped before are
+#   taken from the gunzip cache.
+gunzip_struct = Node(CachedGunzip(cache_dir=gunzip_cache),
+                     name="gunzip_struct")
 
 # Gunzip - unzip the contrast image
-gunzip_con = MapNode(Gunzip(), name="gunzip_con",
+gunzip_con = MapNode(CachedGunzip(cache_dir=gunzip_cache), name="gunzip_con",
                      iterfield=['in_file'])
 
 # Normalize - normalizes functional and structural images to the MNI template
@@ -63,15 +76,24 @@ infosource = Node(IdentityInterface(fields=['subject_id']),
                   name="infosource")
 infosource.iterables = [('subject_id', subject_list)]
 
-# SelectFiles - to grab the data (alternative to DataGrabber)
-anat_file = opj('data', '{subject_id}', 'struct.nii.gz')
+# SubjectFiles - to grab the structural image from the subject index
+index = build_index(opj(experiment_dir, 'data'))
+subjectfiles = Node(SubjectFiles(index_file=index['index_file']),
+                    run_without_submitting=True,
+                    name="subjectfiles")
+
+# SelectFiles - to grab the data (alternative to DataGrabber), all templates
+#   are looked up in an index of the input folders that is created once
 con_file = opj(input_dir_1st, 'contrasts', '{subject_id}',
                         '_mriconvert*/*_out.nii.gz')
-templates = {'anat': anat_file,
-             'con': con_file,
+templates = {'con': con_file,
              }
-selectfiles = Node(SelectFiles(templates,
-                               base_directory=experiment_dir),
+index_file = build_file_index(experiment_dir, templates,
+                              opj(experiment_dir, working_dir,
+                                  'file_index.json'))
+selectfiles = Node(IndexedSelectFiles(templates,
+                                      base_directory=experiment_dir,
+                                      index_file=index_file),
                    name="selectfiles")
 
 # Datasink - creates output folder for important outputs
@@ -85,7 +107,8 @@ datasink.inputs.substitutions = substitutions
 
 # Connect SelectFiles and DataSink to the workflow
 normflow.connect([(infosource, selectfiles, [('subject_id', 'subject_id')]),
-                  (selectfiles, gunzip_struct, [('anat', 'in_file')]),
+                  (infosource, subjectfiles, [('subject_id', 'subject_id')]),
+                  (subjectfiles, gunzip_struct, [('anat', 'in_file')]),
                   (selectfiles, gunzip_con, [('con', 'in_file')]),
                   (normalize, datasink, [('normalized_files',
                                           'normalized.@files'),
@@ -1,16 +1,24 @@
 ###
 # Import modules
 from os.path import join as opj
-from nipype.interfaces.io import SelectFiles, DataSink
+from nipype.interfaces.io import DataSink
 from nipype.interfaces.spm import (OneSampleTTestDesign, EstimateModel,
                                    EstimateContrast, Threshold)
 from nipype.interfaces.utility import IdentityInterface
 from nipype.pipeline.engine import Workflow, Node
+from file_index import build_file_index, IndexedSelectFiles
+from group_stats import StreamingOneSampleTTest
 
 # Specification to MATLAB
 from nipype.interfaces.matlab import MatlabCommand
 MatlabCommand.set_default_paths('/usr/local/MATLAB/R2014a/toolbox/spm12')
-MatlabCommand.set_default_matlab_cmd("matlab -nodesktop -nosplash")
+
+# MATLAB - Send the m-code of all SPM nodes to the MATLAB pool if one is
+#   running (see matlab_pool.py), otherwise start MATLAB for every node
+from matlab_pool import pool_matlab_cmd
+MatlabCommand.set_default_matlab_cmd(
+    pool_matlab_cmd('~/nipype_tutorial/matlab_pool',
+                    "matlab -nodesktop -nosplash"))
 
 
 ###
@@ -25,6 +33,7 @@ subject_list = ['sub001', 'sub002', 'sub003',
                 'sub010']                       # list of subject identifiers
 contrast_list = ['con_0001', 'con_0002', 'con_0003',
                  'con_0004', 'ess_0005', 'ess_0006'] # list of contrast identifiers
+stats_backend = 'spm'                           # 'spm' or 'streaming' (see group_stats.py)
 
 
 ###
@@ -44,6 +53,15 @@ level2conestimate = Node(EstimateContrast(group_contrast=True),
 cont1 = ['Group', 'T', ['mean'], [1]]
 level2conestimate.inputs.contrasts = [cont1]
 
+# Streaming One Sample T-Test - the same test without MATLAB, reading one
+#   subject after the other through a memory map. Also writes the T map
+#   thresholded at p < 0.001 (uncorrected). The accumulators of every
+#   contrast are kept next to the output folder, so that added subjects are
+#   folded in without reading the others again.
+streamttest = Node(StreamingOneSampleTTest(p_threshold=0.001, chunk_mb=256),
+                   name="streamttest")
+streamttest.inputs.state_dir = opj(experiment_dir, output_dir + '_state')
+
 
 ###
 # Specify 2nd-Level Analysis Workflow & Connect Nodes
@@ -51,15 +69,16 @@ l2analysis = Workflow(name='l2analysis')
 l2analysis.base_dir = opj(experiment_dir, working_dir)
 
 # Connect up the 2nd-level analysis components
-l2analysis.connect([(onesamplettestdes, level2estimate, [('spm_mat_file',
-                                                          'spm_mat_file')]),
-                    (level2estimate, level2conestimate, [('spm_mat_file',
-                                                          'spm_mat_file'),
-                                                         ('beta_images',
-                                                          'beta_images'),
-                                                         ('residual_image',
-                                                          'residual_image')]),
-                    ])
+if stats_backend == 'spm':
+    l2analysis.connect([(onesamplettestdes, level2estimate, [('spm_mat_file',
+                                                              'spm_mat_file')]),
+                        (level2estimate, level2conestimate, [('spm_mat_file',
+                                                              'spm_mat_file'),
+                                                             ('beta_images',
+                                                              'beta_images'),
+                                                             ('residual_image',
+                                                              'residual_image')]),
+                        ])
 
 
 ###
@@ -70,14 +89,25 @@ infosource = Node(IdentityInterface(fields=['contrast_id']),
                   name="infosource")
 infosource.iterables = [('contrast_id', contrast_list)]
 
-# SelectFiles - to grab the data (alternative to DataGrabber)
-con_file = opj(input_dir_norm, 'warp_complete', 'sub*', 'warpall*',
+# SelectFiles - to grab the data (alternative to DataGrabber), all templates
+#   are looked up in an index of the input folders that is created once
+#   (see prepare_inputs below)
+con_file = opj(input_dir_norm, 'warp_complete', 'sub*',
                '{contrast_id}_trans.nii')
 templates = {'cons': con_file}
-selectfiles = Node(SelectFiles(templates,
-                               base_directory=experiment_dir),
+selectfiles = Node(IndexedSelectFiles(templates,
+                                      base_directory=experiment_dir),
                    name="selectfiles")
 
+
+# Prepare Inputs - indexes the input folders of selectfiles. The index is
+#   written into the working directory, so it is only built right before the
+#   workflow runs and not on import.
+def prepare_inputs():
+    selectfiles.inputs.index_file = build_file_index(
+        experiment_dir, templates,
+        opj(experiment_dir, working_dir, 'file_index.json'))
+
 # Datasink - creates output folder for important outputs
 datasink = Node(DataSink(base_directory=experiment_dir,
                          container=output_dir),
@@ -90,17 +120,34 @@ datasink.inputs.substitutions = substitutions
 # Connect SelectFiles and DataSink to the workflow
 l2analysis.connect([(infosource, selectfiles, [('contrast_id',
                                                 'contrast_id')]),
-                    (selectfiles, onesamplettestdes, [('cons', 'in_files')]),
-                    (level2conestimate, datasink, [('spm_mat_file',
-                                                    'contrasts.@spm_mat'),
-                                                   ('spmT_images',
-                                                    'contrasts.@T'),
-                                                   ('con_images',
-                                                    'contrasts.@con')]),
                     ])
+if stats_backend == 'spm':
+    l2analysis.connect([(selectfiles, onesamplettestdes, [('cons',
+                                                           'in_files')]),
+                        (level2conestimate, datasink, [('spm_mat_file',
+                                                        'contrasts.@spm_mat'),
+                                                       ('spmT_images',
+                                                        'contrasts.@T'),
+                                                       ('con_images',
+                                                        'contrasts.@con')]),
+                        ])
+else:
+    l2analysis.connect([(infosource, streamttest, [('contrast_id',
+                                                    'contrast_id')]),
+                        (selectfiles, streamttest, [('cons', 'in_files')]),
+                        (streamttest, datasink, [('spmT_image',
+                                                  'contrasts.@T'),
+                                                 ('con_image',
+                                                  'contrasts.@con'),
+                                                 ('thresholded_map',
+                                                  'contrasts.@thresholded')]),
+                        ])
 
 
 ###
-# Run Workflow
-l2analysis.write_graph(graph2use='colored')
-l2analysis.run('MultiProc', plugin_args={'n_procs': 8})
+# Run Workflow - only if run as script, example_fMRI_pipeline.py imports
+#   the workflow
+if __name__ == '__main__':
+    prepare_inputs()
+    l2analysis.write_graph(graph2use='colored')
+    l2analysis.run('MultiProc', plugin_args={'n_procs': 8})
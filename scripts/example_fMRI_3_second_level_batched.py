@@ -0,0 +1,95 @@
+###
+# Import modules
+from os.path import join as opj
+from nipype.interfaces.io import DataSink
+from nipype.interfaces.utility import IdentityInterface
+from nipype.pipeline.engine import Workflow, Node, MapNode
+from file_index import build_file_index, IndexedSelectFiles
+from group_stats import BatchedOneSampleTTest
+from group_permutation import SignFlipPermutationTest
+
+
+###
+# Specify variables
+experiment_dir = '~/nipype_tutorial'            # location of experiment folder
+output_dir = 'output_fMRI_example_2nd_batched'  # name of 2nd-level output folder
+input_dir_norm = 'output_fMRI_example_norm_ants'# name of norm output folder
+working_dir = 'workingdir_fMRI_example_2nd_batched'# name of working directory
+contrast_list = ['con_0001', 'con_0002', 'con_0003',
+                 'con_0004', 'ess_0005', 'ess_0006'] # list of contrast identifiers
+
+
+###
+# Specify 2nd-Level Analysis Nodes
+
+# One Sample T-Tests - stacks the contrast images of all subjects and fits
+#   the one-sample T-Test of all contrasts in one pass, without MATLAB. Every
+#   contrast gets a folder with the images of the SPM path (see
+#   example_fMRI_3_second_level.py and group_stats.py).
+ttest = Node(BatchedOneSampleTTest(contrast_ids=contrast_list,
+                                   chunk_mb=256),
+             name="ttest")
+
+# Sign Flip Permutation Test - nonparametric inference on the stacked contrast
+#   images. The maximum T value and cluster mass of 10000 sign flips give FWE
+#   corrected p values of voxels and clusters (see group_permutation.py).
+permtest = Node(SignFlipPermutationTest(n_permutations=10000,
+                                        seed=0,
+                                        cluster_p=0.001,
+                                        num_threads=8,
+                                        chunk_mb=256),
+                name="permtest")
+
+
+###
+# Specify 2nd-Level Analysis Workflow
+l2analysis = Workflow(name='l2analysis')
+l2analysis.base_dir = opj(experiment_dir, working_dir)
+
+
+###
+# Input & Output Stream
+
+# Infosource - a function free node that provides the list of contrasts
+infosource = Node(IdentityInterface(fields=['contrast_id']),
+                  name="infosource")
+infosource.inputs.contrast_id = contrast_list
+
+# SelectFiles - to grab the data (alternative to DataGrabber), all templates
+#   are looked up in an index of the input folders that is created once
+#   right before the run. The MapNode returns the images of all subjects for
+#   every contrast.
+con_file = opj(input_dir_norm, 'warp_complete', 'sub*',
+               '{contrast_id}_trans.nii')
+templates = {'cons': con_file}
+selectfiles = MapNode(IndexedSelectFiles(templates,
+                                         base_directory=experiment_dir,
+                                         force_lists=True),
+                      name="selectfiles", iterfield=['contrast_id'])
+
+# Datasink - creates output folder for important outputs
+datasink = Node(DataSink(base_directory=experiment_dir,
+                         container=output_dir),
+                name="datasink")
+
+# Connect SelectFiles and DataSink to the workflow
+l2analysis.connect([(infosource, selectfiles, [('contrast_id',
+                                                'contrast_id')]),
+                    (selectfiles, ttest, [('cons', 'contrast_files')]),
+                    (ttest, permtest, [('stack_file', 'stack_file'),
+                                       ('contrast_dirs', 'contrast_dirs')]),
+                    (ttest, datasink, [('contrast_dirs',
+                                        'contrasts.@results')]),
+                    (permtest, datasink, [('out_dirs',
+                                           'permutation.@results')]),
+                    ])
+
+
+###
+# Run Workflow
+# Index the input folders of selectfiles
+selectfiles.inputs.index_file = build_file_index(
+    experiment_dir, templates,
+    opj(experiment_dir, working_dir, 'file_index.json'))
+l2analysis.write_graph(graph2use='colored')
+l2analysis.run('MultiProc', plugin_args={'n_procs': 8})
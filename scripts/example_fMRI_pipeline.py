@@ -0,0 +1,135 @@
+###
+# Pipeline - first-level analysis, ANTs normalization and second-level
+# analysis as one workflow
+#
+# Run one after the other, the three examples hand their results over
+# through the DataSink folders, so the normalization can only start after
+# the first-level analysis of the last subject. This script imports the
+# three workflows and connects them directly: the normalization of a subject
+# starts as soon as its contrasts exist, and a JoinNode collects the warped
+# contrasts of all subjects for the second-level analysis. The DataSinks of
+# the three workflows still write the usual output folders.
+#
+#   python example_fMRI_pipeline.py
+
+
+###
+# Import modules
+from os.path import join as opj
+from nipype.interfaces.utility import IdentityInterface, Function, Merge
+from nipype.pipeline.engine import Workflow, Node, JoinNode
+from multiproc_plugins import ElasticMultiProcPlugin
+import example_fMRI_1_first_level as first_level
+import example_fMRI_2_normalize_ANTS_complete as normalize
+import example_fMRI_3_second_level as second_level
+
+
+###
+# Specify variables
+experiment_dir = first_level.experiment_dir    # location of experiment folder
+working_dir = 'workingdir_fMRI_example_pipeline'  # name of working directory
+
+
+# Function to select the warped image of one contrast from the warped images
+# of every subject
+def select_contrast(contrast_id, warped_files):
+    from os.path import basename
+    return [[f for f in files
+             if basename(f) == '%s_trans.nii' % contrast_id][0]
+            for files in warped_files]
+
+
+###
+# Normalization - takes the subject, the contrasts and the mean image from
+#   the first-level analysis instead of its SelectFiles
+metaflow = first_level.metaflow
+normflow = normalize.normflow
+normflow.disconnect([(normalize.infosource, normalize.selectfiles,
+                      [('subject_id', 'subject_id')]),
+                     (normalize.selectfiles, normalize.bbregister,
+                      [('mean', 'source_file')]),
+                     (normalize.selectfiles, normalize.antsreg,
+                      [('anat', 'moving_image')]),
+                     (normalize.selectfiles, normalize.convert2itk,
+                      [('mean', 'source_file')]),
+                     (normalize.selectfiles, normalize.mergeimages,
+                      [('func_orig', 'in1'),
+                       ('mean', 'in2')]),
+                     ])
+normflow.remove_nodes([normalize.selectfiles])
+normflow.connect([(normalize.fssource, normalize.antsreg, [('brain',
+                                                            'moving_image')]),
+                  ])
+# The subjects come from the iterables of the first-level analysis
+normalize.infosource.iterables = None
+
+# Merge - the con and ess images of the first-level contrasts
+mergecontrasts = Node(Merge(2), name='mergecontrasts')
+
+
+###
+# Second-Level Analysis - gets the warped contrasts of all subjects from a
+#   JoinNode over the subjects instead of its SelectFiles
+l2analysis = second_level.l2analysis
+ttest = second_level.onesamplettestdes \
+    if second_level.stats_backend == 'spm' else second_level.streamttest
+l2analysis.disconnect([(second_level.infosource, second_level.selectfiles,
+                        [('contrast_id', 'contrast_id')]),
+                       (second_level.selectfiles, ttest,
+                        [('cons', 'in_files')]),
+                       ])
+l2analysis.remove_nodes([second_level.selectfiles])
+
+# JoinWarped - waits for the warped contrasts of all subjects
+joinwarped = JoinNode(IdentityInterface(fields=['warped_files']),
+                      joinsource=first_level.infosource,
+                      joinfield=['warped_files'],
+                      name='joinwarped')
+
+# SelectContrast - the warped images of one contrast
+selectcontrast = Node(Function(input_names=['contrast_id', 'warped_files'],
+                               output_names=['in_files'],
+                               function=select_contrast),
+                      name='selectcontrast')
+l2analysis.connect([(second_level.infosource, selectcontrast,
+                     [('contrast_id', 'contrast_id')]),
+                    (selectcontrast, ttest, [('in_files', 'in_files')]),
+                    ])
+
+
+###
+# Specify Pipeline Workflow & Connect Sub-Workflows
+pipeline = Workflow(name='pipeline')
+pipeline.base_dir = opj(experiment_dir, working_dir)
+
+glm_outputs = 'l1analysis.' + first_level.glm_outputs
+pipeline.connect([(metaflow, normflow, [('infosource.subject_id',
+                                         'infosource.subject_id'),
+                                        ('preproc.sliceTimingRealign.mean_image',
+                                         'bbregister.source_file'),
+                                        ('preproc.sliceTimingRealign.mean_image',
+                                         'convert2itk.source_file'),
+                                        ('preproc.sliceTimingRealign.mean_image',
+                                         'mergeimages.in2')]),
+                  (metaflow, mergecontrasts, [(glm_outputs + '.con_images',
+                                               'in1'),
+                                              (glm_outputs + '.ess_images',
+                                               'in2')]),
+                  (mergecontrasts, normflow, [('out', 'mergeimages.in1')]),
+                  (normflow, joinwarped, [('splitimages.out_files',
+                                           'warped_files')]),
+                  (joinwarped, l2analysis, [('warped_files',
+                                             'selectcontrast.warped_files')]),
+                  ])
+
+
+###
+# Run Workflow
+if __name__ == '__main__':
+    # Only the first-level analysis selects its inputs, the other two get
+    #   them from the workflows before them
+    first_level.prepare_inputs()
+    pipeline.write_graph(graph2use='colored')
+    # The ANTs nodes get the cores that are idle when they are started (see
+    #   example_fMRI_2_normalize_ANTS_complete.py)
+    pipeline.run(plugin=ElasticMultiProcPlugin(plugin_args={'n_procs': 8}))
@@ -0,0 +1,282 @@
+###
+# File index - walks the folders used by SelectFiles templates once per run
+# and answers all templates of all iterables from this index
+#
+# On network filesystems every glob of SelectFiles costs many metadata
+# operations, and SelectFiles globs the output tree again for every node
+# instance. IndexedSelectFiles instead looks up the files in a sorted list of
+# all paths, which is created once by build_file_index:
+#
+#   index_file = build_file_index(experiment_dir, templates,
+#                                 opj(experiment_dir, working_dir,
+#                                     'file_index.json'))
+#   selectfiles = Node(IndexedSelectFiles(templates,
+#                                         base_directory=experiment_dir,
+#                                         index_file=index_file),
+#                      name="selectfiles")
+#
+# The matches of the index can be compared with the ones of glob, either for
+# templates in an existing folder or for a temporary test tree:
+#
+#   python file_index.py check ~/nipype_tutorial/data 'sub*/' '*/*.nii.gz'
+#   python file_index.py selftest
+
+import os
+import re
+import json
+import glob
+import shutil
+import tempfile
+import warnings
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+from os.path import join as opj, exists, dirname, abspath, expanduser
+from warnings import warn
+
+from nipype.interfaces.base import File, isdefined
+from nipype.interfaces.io import (SelectFiles, SelectFilesInputSpec,
+                                  human_order_sorted, simplify_list)
+
+
+magic_check = re.compile('[*?[]')
+
+# Index files that were already loaded in this process
+_loaded_indices = {}
+
+
+# Returns the part of a path before the first wildcard or format field
+def literal_prefix(template):
+    match = re.search(r'[*?[{]', template)
+    return template if match is None else template[:match.start()]
+
+
+# Walks the folders of all templates with wildcards and stores the paths of
+# all files and folders (with a trailing '/') in the index file
+def build_file_index(base_directory, templates, index_file):
+    base_directory = abspath(expanduser(base_directory))
+    index_file = abspath(expanduser(index_file))
+
+    # Only the folders in front of the first wildcard have to be walked
+    roots = set()
+    for template in templates.values():
+        if magic_check.search(template):
+            roots.add(dirname(literal_prefix(template)))
+    roots = sorted(roots)
+    roots = [r for i, r in enumerate(roots)
+             if not any(r.startswith(p + os.sep) or p == ''
+                        for p in roots[:i])]
+
+    paths = []
+    for root in roots:
+        for path, dirs, files in os.walk(opj(base_directory, root),
+                                          followlinks=True):
+            rel_path = os.path.relpath(path, base_directory)
+            rel_path = '' if rel_path == '.' else rel_path + os.sep
+            paths.extend(rel_path + d + os.sep for d in dirs)
+            paths.extend(rel_path + f for f in files)
+
+    if not exists(dirname(index_file)):
+        os.makedirs(dirname(index_file))
+    with open(index_file + '.part', 'w') as f:
+        json.dump({'base_directory': base_directory,
+                   'roots': roots,
+                   'paths': sorted(paths)}, f)
+    os.rename(index_file + '.part', index_file)
+    return index_file
+
+
+# Loads an index file, or takes it from memory if it didn't change
+def load_file_index(index_file):
+    mtime = os.stat(index_file).st_mtime
+    if _loaded_indices.get(index_file, (None,))[0] != mtime:
+        with open(index_file) as f:
+            _loaded_indices[index_file] = (mtime, json.load(f))
+    return _loaded_indices[index_file][1]
+
+
+# Returns all paths of the index that match a relative glob pattern, in the
+# same way as glob.glob would (wildcards don't match '/' or hidden files)
+def match_pattern(index, pattern):
+    paths = index['paths']
+    find_dirs = pattern.endswith(os.sep)
+    pattern = pattern.rstrip(os.sep)
+    segments = pattern.split(os.sep)
+
+    prefix = literal_prefix(pattern)
+    matches = []
+    for i in range(bisect_left(paths, prefix), len(paths)):
+        path = paths[i]
+        if not path.startswith(prefix):
+            break
+        is_dir = path.endswith(os.sep)
+        if find_dirs and not is_dir:
+            continue
+        parts = path.rstrip(os.sep).split(os.sep)
+        if len(parts) != len(segments):
+            continue
+        if all(p == s if not magic_check.search(s) else
+               fnmatchcase(p, s) and (s.startswith('.') or
+                                      not p.startswith('.'))
+               for p, s in zip(parts, segments)):
+            matches.append(path)
+    return matches
+
+
+# IndexedSelectFiles - SelectFiles that looks up the files in a file index
+class IndexedSelectFilesInputSpec(SelectFilesInputSpec):
+    index_file = File(exists=True,
+                      desc='index file created by build_file_index')
+
+
+class IndexedSelectFiles(SelectFiles):
+    input_spec = IndexedSelectFilesInputSpec
+
+    def _list_outputs(self):
+        outputs = {}
+        info = dict([(k, v) for k, v in list(self.inputs.__dict__.items())
+                     if k in self._infields])
+
+        force_lists = self.inputs.force_lists
+        if isinstance(force_lists, bool):
+            force_lists = self._outfields if force_lists else []
+        bad_fields = set(force_lists) - set(self._outfields)
+        if bad_fields:
+            raise ValueError("The field(s) '%s' set in 'force_lists' are not "
+                             "in 'templates'." % ', '.join(bad_fields))
+
+        index = None
+        if isdefined(self.inputs.index_file):
+            index = load_file_index(self.inputs.index_file)
+        base_directory = os.getcwd()
+        if isdefined(self.inputs.base_directory):
+            base_directory = abspath(self.inputs.base_directory)
+
+        for field, template in list(self._templates.items()):
+            filled_template = template.format(**info)
+            filled_path = opj(base_directory, filled_template)
+
+            if not magic_check.search(filled_template):
+                # No wildcards, a single stat is enough
+                filelist = [filled_path] if exists(filled_path) else []
+            elif index is not None and \
+                    index['base_directory'] == base_directory and \
+                    not os.path.isabs(filled_template) and \
+                    any(filled_template.startswith(r + os.sep) or r == ''
+                        for r in index['roots']):
+                filelist = [opj(base_directory, p.rstrip(os.sep))
+                            for p in match_pattern(index, filled_template)]
+                if filled_template.endswith(os.sep):
+                    filelist = [f + os.sep for f in filelist]
+            else:
+                # Template isn't covered by the index
+                filelist = glob.glob(filled_path)
+
+            # Handle the case where nothing matched
+            if not filelist:
+                msg = 'No files were found matching %s template: %s' % (
+                    field, filled_path)
+                if self.inputs.raise_on_empty:
+                    raise IOError(msg)
+                else:
+                    warn(msg)
+
+            # Possibly sort the list
+            if self.inputs.sort_filelist:
+                filelist = human_order_sorted(filelist)
+
+            # Handle whether this must be a list or not
+            if field not in force_lists:
+                filelist = simplify_list(filelist)
+
+            outputs[field] = filelist
+
+        return outputs
+
+
+# Compares the files that IndexedSelectFiles and SelectFiles find for every
+# template (without format fields) and returns the templates that differ,
+# with the paths that only the index and only glob found
+def compare_with_glob(base_directory, templates):
+    base_directory = abspath(expanduser(base_directory))
+    templates = dict(('t%d' % i, t) for i, t in enumerate(templates))
+    index_dir = tempfile.mkdtemp()
+    try:
+        index_file = build_file_index(base_directory, templates,
+                                      opj(index_dir, 'file_index.json'))
+        options = dict(base_directory=base_directory, force_lists=True,
+                       raise_on_empty=False)
+        with warnings.catch_warnings():
+            # Templates without matches
+            warnings.simplefilter('ignore')
+            indexed = IndexedSelectFiles(templates, index_file=index_file,
+                                         **options)._list_outputs()
+            globbed = SelectFiles(templates, **options)._list_outputs()
+    finally:
+        shutil.rmtree(index_dir)
+
+    differences = {}
+    for field, template in sorted(templates.items()):
+        # glob returns folders with the trailing '/' of the template
+        found = set(os.path.relpath(f.rstrip(os.sep), base_directory)
+                    for f in indexed[field])
+        expected = set(os.path.relpath(f.rstrip(os.sep), base_directory)
+                       for f in globbed[field])
+        if found != expected:
+            differences[template] = (sorted(found - expected),
+                                     sorted(expected - found))
+    return differences
+
+
+# Creates a temporary test tree with hidden files and folders and compares
+# the index with glob for the templates used in the examples
+def self_check():
+    templates = ['[ce]*.nii', '_mriconvert*/*_out.nii.gz', '*.nii', '.*',
+                 '*', '*/', 'sub*/', '.*/', '*/*', '*/.*', 'sub*/*/*.nii.gz',
+                 'sub001/', 'con_0001.nii', 'missing*']
+    paths = ['con_0001.nii', 'ess_0002.nii', 'beta_0001.nii', 'ess.nii.gz',
+             '.con_hidden.nii', '.hidden', '_mriconvert0/a_out.nii.gz',
+             '_mriconvert1/b_out.nii.gz', '_mriconvert1/.c_out.nii.gz',
+             '_mriconvert1/b_out.nii', '.cache/_mriconvert2/d_out.nii.gz',
+             'sub001/BOLD/run001.nii.gz', 'sub002/BOLD/run001.nii.gz',
+             'sub002/.BOLD/run002.nii.gz', 'subjects/empty/']
+    base_directory = tempfile.mkdtemp()
+    try:
+        for path in paths:
+            if not exists(dirname(opj(base_directory, path))):
+                os.makedirs(dirname(opj(base_directory, path)))
+            if not path.endswith(os.sep):
+                open(opj(base_directory, path), 'w').close()
+        return compare_with_glob(base_directory, templates)
+    finally:
+        shutil.rmtree(base_directory)
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the file index '
+                                                 'with glob')
+    parser.add_argument('action', choices=['check', 'selftest'])
+    parser.add_argument('base_directory', nargs='?',
+                        help='folder to check (used by check)')
+    parser.add_argument('templates', nargs='*',
+                        help='templates relative to the folder (used by '
+                             'check)')
+    args = parser.parse_args()
+
+    if args.action == 'check':
+        if args.base_directory is None or not args.templates:
+            parser.error('check needs a folder and templates')
+        differences = compare_with_glob(args.base_directory, args.templates)
+    else:
+        differences = self_check()
+    for template, (index_only, glob_only) in sorted(differences.items()):
+        print('%s differs' % template)
+        for path in index_only:
+            print('  only in the index: %s' % path)
+        for path in glob_only:
+            print('  only in glob: %s' % path)
+    if differences:
+        sys.exit(1)
+    print('The index finds the same files as glob')
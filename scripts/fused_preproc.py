@@ -0,0 +1,162 @@
+###
+# Fused preprocessing - runs SPM's slice timing, realignment and smoothing
+# as one MATLAB job
+#
+# With separate SliceTiming, Realign and Smooth nodes, every step starts
+# MATLAB, writes a full copy of the functional runs (a*, r*, s*) and the next
+# node reads it again. FusedPreproc runs all steps in one MATLAB session, one
+# after the other, and deletes the intermediate files afterwards. Only the
+# final images, the mean image and the realignment parameters are kept:
+#
+#   preproc = Node(FusedPreproc(num_slices=40, time_repetition=2.0,
+#                               time_acquisition=2.0-2.0/40,
+#                               slice_order=slice_order, ref_slice=2,
+#                               fwhm=8),
+#                  name='preproc')
+#
+# Without fwhm, no smoothing is done and the realigned images are the final
+# product. With keep_realigned=True the realigned images are kept as well,
+# e.g. for the artifact detection.
+
+import os
+from copy import deepcopy
+
+import numpy as np
+from nipype.interfaces.base import (TraitedSpec, InputMultiPath,
+                                    OutputMultiPath, File, traits, isdefined)
+from nipype.interfaces.spm import SliceTiming, Realign, Smooth
+from nipype.interfaces.spm.base import (SPMCommand, SPMCommandInputSpec,
+                                        ImageFileSPM)
+from nipype.utils.filemanip import fname_presuffix, ensure_list
+
+
+# Replaces all references to the given files in SPM job contents (also
+# frame references like 'file.nii,1') with the prefixed file names
+def prefix_files(contents, files, prefix):
+    if isinstance(contents, dict):
+        return dict((k, prefix_files(v, files, prefix))
+                    for k, v in contents.items())
+    if isinstance(contents, np.ndarray) and contents.dtype == object:
+        out = np.empty_like(contents)
+        for i, v in enumerate(contents.flat):
+            out.flat[i] = prefix_files(v, files, prefix)
+        return out
+    if isinstance(contents, list):
+        return [prefix_files(v, files, prefix) for v in contents]
+    if isinstance(contents, tuple):
+        return tuple(prefix_files(v, files, prefix) for v in contents)
+    if isinstance(contents, str):
+        for f in files:
+            if contents == f or contents.startswith(f + ','):
+                return fname_presuffix(f, prefix=prefix) + contents[len(f):]
+    return contents
+
+
+class FusedPreprocInputSpec(SPMCommandInputSpec):
+    in_files = InputMultiPath(ImageFileSPM(exists=True), field='scans',
+                              mandatory=True, copyfile=False,
+                              desc='functional runs (uncompressed)')
+    num_slices = traits.Int(mandatory=True,
+                            desc='number of slices in a volume')
+    time_repetition = traits.Float(mandatory=True,
+                                   desc='time between volume acquisitions')
+    time_acquisition = traits.Float(mandatory=True,
+                                    desc='time of volume acquisition')
+    slice_order = traits.List(traits.Either(traits.Int(), traits.Float()),
+                              mandatory=True,
+                              desc='order in which slices are acquired, or '
+                                   'slice times in ms')
+    ref_slice = traits.Either(traits.Int(), traits.Float(), mandatory=True,
+                              desc='reference slice, or reference time in ms')
+    register_to_mean = traits.Bool(True, usedefault=True,
+                                   desc='realign to the mean image')
+    fwhm = traits.Either(traits.List(traits.Float(), minlen=3, maxlen=3),
+                         traits.Float(),
+                         desc='smoothing kernel, no smoothing if undefined')
+    keep_realigned = traits.Bool(False, usedefault=True,
+                                 desc='keep the realigned images as well')
+
+
+class FusedPreprocOutputSpec(TraitedSpec):
+    realigned_files = OutputMultiPath(File(exists=True),
+                                      desc='realigned images')
+    mean_image = File(exists=True, desc='mean image')
+    realignment_parameters = OutputMultiPath(File(exists=True),
+                                             desc='realignment parameters')
+    smoothed_files = OutputMultiPath(File(exists=True),
+                                     desc='smoothed images')
+
+
+# FusedPreproc - slice timing, realignment and smoothing in one SPM session
+class FusedPreproc(SPMCommand):
+    input_spec = FusedPreprocInputSpec
+    output_spec = FusedPreprocOutputSpec
+
+    # Returns the SPM interfaces of all steps and the prefix of their inputs
+    def _steps(self):
+        in_files = ensure_list(self.inputs.in_files)
+        steps = [(SliceTiming(in_files=in_files,
+                              num_slices=self.inputs.num_slices,
+                              time_repetition=self.inputs.time_repetition,
+                              time_acquisition=self.inputs.time_acquisition,
+                              slice_order=self.inputs.slice_order,
+                              ref_slice=self.inputs.ref_slice), ''),
+                 (Realign(in_files=in_files, jobtype='estwrite',
+                          register_to_mean=self.inputs.register_to_mean),
+                  'a')]
+        if isdefined(self.inputs.fwhm):
+            steps.append((Smooth(in_files=in_files, fwhm=self.inputs.fwhm),
+                          'ra'))
+        return steps
+
+    # Returns the m-code of all steps. The job of each step is created from
+    # the original files, which have the same number of volumes as the
+    # outputs of the previous step, and then pointed to those outputs.
+    def _make_fused_script(self):
+        in_files = ensure_list(self.inputs.in_files)
+        scripts = []
+        for iface, prefix in self._steps():
+            iface.mlab = self.mlab
+            contents = deepcopy(iface._parse_inputs())
+            if prefix:
+                contents = prefix_files(contents, in_files, prefix)
+            scripts.append(iface._make_matlab_command(contents))
+        return '\nclear jobs;\n'.join(scripts)
+
+    def _run_interface(self, runtime):
+        self.mlab.inputs.script = self._make_fused_script()
+        results = self.mlab.run()
+        runtime.returncode = results.runtime.returncode
+        runtime.stdout = results.runtime.stdout
+        runtime.stderr = results.runtime.stderr
+        runtime.merged = results.runtime.merged
+
+        # Delete the intermediate images
+        in_files = ensure_list(self.inputs.in_files)
+        intermediate = ['a']
+        if isdefined(self.inputs.fwhm) and not self.inputs.keep_realigned:
+            intermediate.append('ra')
+        for f in in_files:
+            # SPM stores the motion of 4D images in a .mat file next to them
+            files = [fname_presuffix(f, prefix='a', suffix='.mat',
+                                     use_ext=False)]
+            files += [fname_presuffix(f, prefix=p) for p in intermediate]
+            for filename in files:
+                if os.path.exists(filename):
+                    os.remove(filename)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        in_files = ensure_list(self.inputs.in_files)
+        outputs['mean_image'] = fname_presuffix(in_files[0], prefix='meana')
+        outputs['realignment_parameters'] = [
+            fname_presuffix(f, prefix='rp_a', suffix='.txt', use_ext=False)
+            for f in in_files]
+        if not isdefined(self.inputs.fwhm) or self.inputs.keep_realigned:
+            outputs['realigned_files'] = [fname_presuffix(f, prefix='ra')
+                                          for f in in_files]
+        if isdefined(self.inputs.fwhm):
+            outputs['smoothed_files'] = [fname_presuffix(f, prefix='sra')
+                                         for f in in_files]
+        return outputs
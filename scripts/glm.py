@@ -0,0 +1,526 @@
+###
+# GLM - first-level model estimation with NumPy instead of SPM
+#
+# NumpyGLM replaces the chain Level1Design -> EstimateModel ->
+# EstimateContrast. It takes the session_info of SpecifySPMModel, builds the
+# design the way SPM does (canonical HRF at a microtime resolution of 16,
+# DCT high-pass filter, grand mean scaling of every run to 100, implicit
+# mask at 80% of the global signal), estimates one AR(1) coefficient per run
+# from the pooled residuals, and fits the prewhitened model block of voxels
+# by block of voxels with num_threads threads:
+#
+#   glm = Node(NumpyGLM(interscan_interval=TR,
+#                       model_serial_correlations='AR(1)',
+#                       num_threads=4),
+#              name='glm')
+#   glm.inputs.contrasts = contrast_list
+#
+# The outputs have SPM's names (beta_0001.nii, ResMS.nii, mask.nii,
+# con_0001.nii and spmT_0001.nii for T contrasts, ess_0005.nii and
+# spmF_0005.nii for F contrasts). SPM estimates the serial correlations with
+# ReML, so the T and F values of both backends agree closely, but not
+# exactly. The outputs of both backends can be compared with:
+#
+#   python glm.py compare <SPM output folder> <NumpyGLM output folder>
+#
+# HRF kernels and DCT bases are built once per process. The convolved
+# condition regressors of a run depend only on TR, run length, microtime
+# settings and the events, so they are stored in design_cache under a hash
+# of these. Subjects with the same timing, and reruns with other inputs
+# (e.g. other smoothing kernels), take them from there:
+#
+#   glm.inputs.design_cache = opj(experiment_dir, 'design_cache')
+
+from __future__ import division, print_function
+import os
+import json
+import glob
+import hashlib
+from os.path import join as opj, abspath, exists, expanduser
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nb
+from scipy import stats
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory,
+                                    OutputMultiPath, traits, isdefined)
+
+from chunked_tsnr import voxel_blocks
+from art_stream import volume_blocks, read_volumes
+
+
+###
+# Specify variables
+design_version = 1            # part of the cache key, raise if designs change
+
+# HRF kernels and DCT bases of this process, they are read-only
+hrf_kernels = {}
+dct_bases = {}
+
+
+# Returns SPM's canonical HRF (peak at 6 s, undershoot at 16 s with 1/6 of
+# the peak) sampled every dt seconds, scaled to a sum of 1
+def spm_hrf(dt, time_length=32.):
+    key = (float(dt), float(time_length))
+    if key not in hrf_kernels:
+        t = np.arange(int(np.floor(time_length / dt)) + 1) * dt
+        hrf = stats.gamma.pdf(t, 6) - stats.gamma.pdf(t, 16) / 6.
+        hrf /= hrf.sum()
+        hrf.setflags(write=False)
+        hrf_kernels[key] = hrf
+    return hrf_kernels[key]
+
+
+# Returns the DCT basis of SPM's high-pass filter (without the constant)
+def dct_basis(n_scans, time_repetition, cutoff):
+    key = (int(n_scans), float(time_repetition), float(cutoff))
+    if key not in dct_bases:
+        order = int(np.fix(2 * (n_scans * time_repetition) / cutoff + 1))
+        n = np.arange(n_scans)
+        basis = np.array([np.sqrt(2. / n_scans) *
+                          np.cos(np.pi * (2 * n + 1) * k / (2. * n_scans))
+                          for k in range(1, order)]).T.reshape((n_scans, -1))
+        basis.setflags(write=False)
+        dct_bases[key] = basis
+    return dct_bases[key]
+
+
+# Returns the stimulus function of events with the given onsets and
+# durations (in seconds) on a grid of dt seconds
+def stimulus_function(onsets, durations, amplitudes, n_bins, dt):
+    onsets = np.asarray(onsets, dtype=np.float64).ravel()
+    durations = np.broadcast_to(np.asarray(durations, dtype=np.float64),
+                                onsets.shape)
+    amplitudes = np.broadcast_to(np.asarray(amplitudes, dtype=np.float64),
+                                 onsets.shape)
+    ton = np.round(onsets / dt).astype(int)
+    tof = np.round(durations / dt).astype(int) + ton + 1
+    sf = np.zeros(n_bins + 1)
+    np.add.at(sf, np.clip(ton, 0, n_bins), amplitudes)
+    np.add.at(sf, np.clip(tof, 0, n_bins), -amplitudes)
+    return np.cumsum(sf)[:n_bins]
+
+
+# Returns the key of the convolved conditions of a run: a hash of TR, run
+# length, microtime settings and the events of all conditions
+def timing_key(conds, n_scans, time_repetition, microtime_resolution,
+               microtime_onset):
+    events = [[c['name'],
+               np.ravel(c['onset']).astype(float).tolist(),
+               np.ravel(c['duration']).astype(float).tolist(),
+               np.ravel(c.get('amplitudes', 1.)).astype(float).tolist()]
+              for c in conds]
+    description = json.dumps([design_version, float(time_repetition),
+                              int(n_scans), microtime_resolution,
+                              microtime_onset, events])
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+# Returns the conditions of a run convolved with the HRF and sampled at the
+# scans, as (scans, conditions) array
+def convolve_conditions(conds, n_scans, time_repetition,
+                        microtime_resolution=16, microtime_onset=8):
+    dt = time_repetition / microtime_resolution
+    n_bins = (n_scans + 2) * microtime_resolution
+    hrf = spm_hrf(dt)
+    scans = np.arange(n_scans) * microtime_resolution + microtime_onset - 1
+    columns = np.zeros((n_scans, len(conds)))
+    for i, cond in enumerate(conds):
+        sf = stimulus_function(cond['onset'], cond['duration'],
+                               cond.get('amplitudes', 1.), n_bins, dt)
+        columns[:, i] = np.convolve(sf, hrf)[scans]
+    return columns
+
+
+# Returns the convolved conditions of a run from the cache folder, or
+# computes and stores them there
+def cached_conditions(conds, n_scans, time_repetition, microtime_resolution,
+                      microtime_onset, cache_dir=None):
+    if cache_dir is None:
+        return convolve_conditions(conds, n_scans, time_repetition,
+                                   microtime_resolution, microtime_onset)
+    cache_dir = abspath(expanduser(cache_dir))
+    cache_file = opj(cache_dir, 'design_%s.npy' % timing_key(
+        conds, n_scans, time_repetition, microtime_resolution,
+        microtime_onset))
+    if exists(cache_file):
+        return np.load(cache_file)
+    columns = convolve_conditions(conds, n_scans, time_repetition,
+                                  microtime_resolution, microtime_onset)
+    if not exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Created by another subject at the same time
+            pass
+    # Write to a temporary file first, so that parallel readers never see
+    # a half written entry
+    tmp_file = cache_file[:-4] + '_%d.tmp.npy' % os.getpid()
+    np.save(tmp_file, columns)
+    os.rename(tmp_file, cache_file)
+    return columns
+
+
+# Returns the design of one run (conditions convolved with the HRF,
+# followed by the regressors) and the names of its columns
+def run_design(session, n_scans, time_repetition, microtime_resolution=16,
+               microtime_onset=8, cache_dir=None):
+    conds = session.get('cond', [])
+    for cond in conds:
+        if cond.get('pmod') or cond.get('tmod'):
+            raise ValueError('Parametric and time modulations of %s are not '
+                             'supported' % cond['name'])
+    columns = [cached_conditions(conds, n_scans, time_repetition,
+                                 microtime_resolution, microtime_onset,
+                                 cache_dir)]
+    names = ['%s*bf(1)' % cond['name'] for cond in conds]
+    for regressor in session.get('regress', []):
+        columns.append(np.asarray(regressor['val'],
+                                  dtype=np.float64).reshape((n_scans, 1)))
+        names.append(regressor['name'])
+    return np.hstack(columns), names
+
+
+# Returns the design of all runs (block diagonal, constants at the end) and
+# the names of its columns
+def session_design(session_info, n_scans, time_repetition,
+                   microtime_resolution=16, microtime_onset=8,
+                   cache_dir=None):
+    blocks, names = [], []
+    for i, (session, n) in enumerate(zip(session_info, n_scans)):
+        X, run_names = run_design(session, n, time_repetition,
+                                  microtime_resolution, microtime_onset,
+                                  cache_dir)
+        blocks.append(X)
+        names.extend('Sn(%d) %s' % (i + 1, name) for name in run_names)
+    n_columns = sum(X.shape[1] for X in blocks) + len(blocks)
+    design = np.zeros((sum(n_scans), n_columns))
+    row = col = 0
+    for i, X in enumerate(blocks):
+        design[row:row + X.shape[0], col:col + X.shape[1]] = X
+        design[row:row + X.shape[0], n_columns - len(blocks) + i] = 1
+        row += X.shape[0]
+        col += X.shape[1]
+    names.extend('Sn(%d) constant' % (i + 1) for i in range(len(blocks)))
+    return design, names
+
+
+# Returns the whitening matrix of an AR(1) process with coefficient rho
+def ar1_whitening(n_scans, rho):
+    lags = np.abs(np.subtract.outer(np.arange(n_scans), np.arange(n_scans)))
+    V = rho ** lags / (1 - rho ** 2)
+    values, vectors = np.linalg.eigh(V)
+    return (vectors / np.sqrt(values)).dot(vectors.T)
+
+
+# Returns the contrast weights of every column for a T contrast given as
+# [name, 'T', conditions, weights] (weights apply to all runs, like in
+# EstimateContrast), or the rows of its T contrasts for an F contrast
+def contrast_matrix(contrast, names):
+    if contrast[1] == 'F':
+        return np.vstack([contrast_matrix(c, names) for c in contrast[2]])
+    vector = np.zeros((1, len(names)))
+    for cond, weight in zip(contrast[2], contrast[3]):
+        idx = [i for i, name in enumerate(names)
+               if name.split(' ', 1)[1] == '%s*bf(1)' % cond]
+        if not idx:
+            raise ValueError('Condition %s not found in design' % cond)
+        vector[0, idx] = weight
+    return vector
+
+
+# Returns SPM's global signal of every volume of a run (mean of the voxels
+# above an eighth of the mean)
+def spm_globals(img, max_bytes):
+    globals_ = []
+    for start, stop in volume_blocks(img.shape, max_bytes):
+        vols = read_volumes(img, start, stop).astype(np.float64)
+        above = vols > vols.mean(axis=0) / 8.
+        globals_.extend((vols * above).sum(axis=0) / above.sum(axis=0))
+    return np.array(globals_)
+
+
+# Returns the number of voxels with a different mask and the largest
+# differences (absolute and relative to the largest SPM value) of every beta,
+# con, spmT and spmF image of a NumpyGLM output folder and an SPM one
+def compare_spm(spm_dir, glm_dir):
+    result = {}
+    for pattern in ['beta_*.nii', 'con_*.nii', 'spmT_*.nii', 'spmF_*.nii']:
+        for filename in sorted(glob.glob(opj(glm_dir, pattern))):
+            name = os.path.basename(filename)
+            if not exists(opj(spm_dir, name)):
+                continue
+            spm = nb.load(opj(spm_dir, name)).get_fdata()
+            glm = nb.load(filename).get_fdata()
+            spm_mask = np.isfinite(spm) & (spm != 0)
+            glm_mask = np.isfinite(glm)
+            both = spm_mask & glm_mask
+            difference = np.abs(spm[both] - glm[both]).max() \
+                if both.any() else 0.
+            scale = np.abs(spm[both]).max() if both.any() else 0.
+            result[name] = {
+                'mask_differences': int((spm_mask != glm_mask).sum()),
+                'max_abs_difference': float(difference),
+                'max_rel_difference': float(difference / scale)
+                if scale else 0.}
+    return result
+
+
+# NumpyGLM - Level1Design, EstimateModel and EstimateContrast in NumPy
+class NumpyGLMInputSpec(BaseInterfaceInputSpec):
+    session_info = traits.Any(mandatory=True,
+                              desc='session info of SpecifySPMModel')
+    interscan_interval = traits.Float(mandatory=True,
+                                      desc='repetition time in seconds')
+    contrasts = traits.List(traits.Any(), mandatory=True,
+                            desc='contrasts in the format of '
+                                 'EstimateContrast')
+    mask_image = File(exists=True, desc='explicit mask of the estimation')
+    mask_threshold = traits.Float(0.8, usedefault=True,
+                                  desc='implicit mask at this fraction of '
+                                       'the global signal')
+    model_serial_correlations = traits.Enum('AR(1)', 'none', usedefault=True,
+                                            desc='model of serial '
+                                                 'correlations')
+    microtime_resolution = traits.Int(16, usedefault=True,
+                                      desc='time bins per scan')
+    microtime_onset = traits.Int(8, usedefault=True,
+                                 desc='time bin at which scans are sampled')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='threads that fit blocks of voxels')
+    chunk_mb = traits.Float(256., usedefault=True, nohash=True,
+                            desc='memory per block of voxels in MB')
+    design_cache = Directory(nohash=True,
+                             desc='folder of the convolved conditions of '
+                                  'all timings')
+
+
+class NumpyGLMOutputSpec(TraitedSpec):
+    beta_images = OutputMultiPath(File(exists=True),
+                                  desc='design parameter estimates')
+    mask_image = File(exists=True, desc='mask of the estimation')
+    residual_image = File(exists=True,
+                          desc='mean-squared image of the residuals')
+    con_images = OutputMultiPath(File(exists=True),
+                                 desc='contrast images of T contrasts')
+    spmT_images = OutputMultiPath(File(exists=True),
+                                  desc='T images of T contrasts')
+    ess_images = OutputMultiPath(File(exists=True),
+                                 desc='extra sum of squares of F contrasts')
+    spmF_images = OutputMultiPath(File(exists=True),
+                                  desc='F images of F contrasts')
+    design_file = File(exists=True,
+                       desc='design matrix, column names and AR(1) '
+                            'coefficients (.npz)')
+
+
+class NumpyGLM(BaseInterface):
+    input_spec = NumpyGLMInputSpec
+    output_spec = NumpyGLMOutputSpec
+
+    # Returns the blocks of voxels, each as (voxels, scans) array
+    def _read_block(self, images, scale, ys, zs):
+        data = [np.asarray(img.dataobj[:, ys, zs], dtype=np.float64)
+                for img in images]
+        data = np.concatenate([d.reshape((-1, d.shape[-1]), order='F')
+                               for d in data], axis=1)
+        return data, data * scale
+
+    def _run_interface(self, runtime):
+        session_info = self.inputs.session_info
+        tr = self.inputs.interscan_interval
+        max_bytes = self.inputs.chunk_mb * 1024. ** 2
+        images = [nb.load(np.ravel(s['scans'])[0], mmap=True)
+                  for s in session_info]
+        shape = images[0].shape[:3]
+        n_scans = [img.shape[3] for img in images]
+        runs = np.repeat(np.arange(len(images)), n_scans)
+
+        cache_dir = self.inputs.design_cache \
+            if isdefined(self.inputs.design_cache) else None
+        X, names = session_design(session_info, n_scans, tr,
+                                  self.inputs.microtime_resolution,
+                                  self.inputs.microtime_onset, cache_dir)
+
+        # Grand mean scaling of every run to 100, implicit mask threshold
+        # of every scan
+        g = np.concatenate([spm_globals(img, max_bytes) for img in images])
+        scale = np.concatenate([np.full(n, 100. / g[runs == i].mean())
+                                for i, n in enumerate(n_scans)])
+        threshold = self.inputs.mask_threshold * g
+        explicit = None
+        if isdefined(self.inputs.mask_image):
+            explicit = np.asanyarray(nb.load(
+                self.inputs.mask_image).dataobj).reshape((-1,),
+                                                         order='F') > 0
+
+        # High-pass filter of every run, K y = y - X0 (X0' y)
+        X0 = [dct_basis(n, tr, s.get('hpf', 128.))
+              for s, n in zip(session_info, n_scans)]
+
+        def high_pass(data):
+            out = data.copy()
+            for i, x0 in enumerate(X0):
+                rows = runs == i
+                out[rows] -= x0.dot(x0.T.dot(data[rows]))
+            return out
+
+        blocks = voxel_blocks(shape, sum(n_scans), max_bytes / 4. /
+                              max(self.inputs.num_threads, 1))
+        pool = ThreadPool(max(self.inputs.num_threads, 1))
+
+        def block_voxels(ys, zs):
+            return (np.arange(int(np.prod(shape))).reshape(shape, order='F')
+                    [:, ys, zs].ravel(order='F'))
+
+        def block_mask(raw, voxels):
+            mask = (raw > threshold).all(axis=1) & \
+                np.isfinite(raw).all(axis=1)
+            if explicit is not None:
+                mask &= explicit[voxels]
+            return mask
+
+        # Pass 1 - residual autocorrelation of the unwhitened model, pooled
+        # over all voxels of every run
+        rho = np.zeros(len(images))
+        if self.inputs.model_serial_correlations == 'AR(1)':
+            KX = high_pass(X)
+            pKX = np.linalg.pinv(KX)
+
+            def autocorrelation(block):
+                ys, zs = block
+                raw, Y = self._read_block(images, scale, ys, zs)
+                Y = high_pass(Y[block_mask(raw, block_voxels(ys, zs))].T)
+                res = Y - KX.dot(pKX.dot(Y))
+                sums = np.zeros((len(images), 2))
+                for i in range(len(images)):
+                    r = res[runs == i]
+                    sums[i] = [(r[1:] * r[:-1]).sum(), (r * r).sum()]
+                return sums
+
+            sums = np.sum(pool.map(autocorrelation, blocks), axis=0)
+            rho = np.clip(sums[:, 0] / np.maximum(sums[:, 1], 1e-12),
+                          0., 0.9)
+
+        # Pass 2 - prewhitened, filtered model
+        W = np.zeros((len(runs), len(runs)))
+        for i, n in enumerate(n_scans):
+            rows = np.nonzero(runs == i)[0]
+            W[np.ix_(rows, rows)] = ar1_whitening(n, rho[i]) if rho[i] \
+                else np.eye(n)
+        KWX = high_pass(W.dot(X))
+        pKWX = np.linalg.pinv(KWX)
+        Bcov = pKWX.dot(pKWX.T)
+        trRV = len(runs) - sum(x0.shape[1] for x0 in X0) - \
+            np.linalg.matrix_rank(KWX)
+
+        n_voxels = int(np.prod(shape))
+        mask = np.zeros(n_voxels, dtype=bool)
+        beta = np.full((X.shape[1], n_voxels), np.nan, dtype=np.float32)
+        resms = np.full(n_voxels, np.nan, dtype=np.float32)
+
+        def fit(block):
+            ys, zs = block
+            voxels = block_voxels(ys, zs)
+            raw, Y = self._read_block(images, scale, ys, zs)
+            inside = block_mask(raw, voxels)
+            Y = high_pass(W.dot(Y[inside].T))
+            b = pKWX.dot(Y)
+            res = Y - KWX.dot(b)
+            mask[voxels[inside]] = True
+            beta[:, voxels[inside]] = b
+            resms[voxels[inside]] = (res * res).sum(axis=0) / trRV
+
+        try:
+            pool.map(fit, blocks)
+        finally:
+            pool.close()
+
+        # Contrasts
+        def save(data, filename, descrip):
+            img = nb.Nifti1Image(data.reshape(shape, order='F'),
+                                 images[0].affine)
+            img.header['descrip'] = descrip.encode()
+            img.to_filename(abspath(filename))
+
+        save(mask.astype(np.uint8), 'mask.nii', 'SPM mask')
+        save(resms, 'ResMS.nii', 'SPM residual mean square')
+        for i, name in enumerate(names):
+            save(beta[i], 'beta_%04d.nii' % (i + 1), 'SPM beta - %s' % name)
+        for i, contrast in enumerate(self.inputs.contrasts):
+            C = contrast_matrix(contrast, names)
+            cb = C.dot(beta[:, mask].astype(np.float64))
+            if contrast[1] == 'T':
+                con = np.full(n_voxels, np.nan, dtype=np.float32)
+                tmap = con.copy()
+                con[mask] = cb[0]
+                tmap[mask] = cb[0] / np.sqrt(resms[mask] *
+                                             C.dot(Bcov).dot(C.T)[0, 0])
+                save(con, 'con_%04d.nii' % (i + 1),
+                     'SPM contrast - %d: %s' % (i + 1, contrast[0]))
+                save(tmap, 'spmT_%04d.nii' % (i + 1),
+                     'SPM{T_[%.1f]} - contrast %d: %s'
+                     % (trRV, i + 1, contrast[0]))
+            else:
+                rank = np.linalg.matrix_rank(C)
+                M = np.linalg.pinv(C.dot(Bcov).dot(C.T))
+                ess = np.full(n_voxels, np.nan, dtype=np.float32)
+                fmap = ess.copy()
+                ess[mask] = (cb * M.dot(cb)).sum(axis=0)
+                fmap[mask] = ess[mask] / rank / resms[mask]
+                save(ess, 'ess_%04d.nii' % (i + 1),
+                     'SPM ESS - contrast %d: %s' % (i + 1, contrast[0]))
+                save(fmap, 'spmF_%04d.nii' % (i + 1),
+                     'SPM{F_[%.1f,%.1f]} - contrast %d: %s'
+                     % (rank, trRV, i + 1, contrast[0]))
+
+        np.savez(abspath('design.npz'), X=X, names=np.array(names),
+                 rho=rho, trRV=trRV)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        n_betas = len(np.load(abspath('design.npz'))['names'])
+        outputs['beta_images'] = [abspath('beta_%04d.nii' % (i + 1))
+                                  for i in range(n_betas)]
+        outputs['mask_image'] = abspath('mask.nii')
+        outputs['residual_image'] = abspath('ResMS.nii')
+        outputs['design_file'] = abspath('design.npz')
+        for stat, con, spm in [('T', 'con', 'spmT'), ('F', 'ess', 'spmF')]:
+            idx = [i + 1 for i, c in enumerate(self.inputs.contrasts)
+                   if c[1] == stat]
+            outputs['%s_images' % con] = [abspath('%s_%04d.nii' % (con, i))
+                                          for i in idx]
+            outputs['%s_images' % spm] = [abspath('%s_%04d.nii' % (spm, i))
+                                          for i in idx]
+        return outputs
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare the first-level '
+                                                 'model of NumpyGLM with SPM')
+    parser.add_argument('action', choices=['compare'])
+    parser.add_argument('spm_dir', help='output folder of EstimateContrast')
+    parser.add_argument('glm_dir', help='output folder of NumpyGLM')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='largest accepted difference, relative to the '
+                             'largest value of the SPM image')
+    args = parser.parse_args()
+
+    result = compare_spm(args.spm_dir, args.glm_dir)
+    failed = not result
+    if not result:
+        print('No images of %s found in %s' % (args.glm_dir, args.spm_dir))
+    for name, diff in sorted(result.items()):
+        ok = diff['mask_differences'] == 0 and \
+            diff['max_rel_difference'] <= args.tolerance
+        failed = failed or not ok
+        print('%-14s %s  max. difference %.2g (%.2g relative), %d mask '
+              'differences' % (name, 'ok  ' if ok else 'FAIL',
+                               diff['max_abs_difference'],
+                               diff['max_rel_difference'],
+                               diff['mask_differences']))
+    raise SystemExit(1 if failed else 0)
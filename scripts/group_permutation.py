@@ -0,0 +1,236 @@
+###
+# Group permutation - nonparametric one-sample tests with sign flips
+#
+# Under the null hypothesis of a one-sample test, the contrast images of the
+# subjects are symmetric around zero and may have their sign flipped.
+# SignFlipPermutationTest works on the stack of contrast images that
+# BatchedOneSampleTTest writes (contrasts x subjects x voxels, see
+# group_stats.py) and computes the T map of every sign flip pattern. The
+# maximum T value and the largest cluster mass (sum of the T values of a
+# cluster above the cluster forming threshold) of every permutation give
+# the familywise error corrected p values of voxels and clusters:
+#
+#   permtest = Node(SignFlipPermutationTest(n_permutations=10000, seed=0,
+#                                           num_threads=8),
+#                   name='permtest')
+#   l2analysis.connect([(ttest, permtest, [('stack_file', 'stack_file'),
+#                                          ('contrast_dirs',
+#                                           'contrast_dirs')])])
+#
+# The sum of squares of the data doesn't change with the sign, so a batch of
+# permutations only needs one matrix product of the sign flips with the
+# data. The batches are spread over num_threads processes, which all read
+# the stack through a read-only memory map. The node sets its n_procs from
+# num_threads, so the MultiProc plugin reserves as many cores for it. The
+# sign flips are drawn from seed before the batches are cut, so the results
+# don't depend on num_threads. If there are fewer sign flip patterns than
+# n_permutations, all of them are used.
+
+from __future__ import division, print_function
+import os
+import itertools
+from os.path import join as opj, abspath, basename, exists
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage, stats
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory,
+                                    OutputMultiPath, traits)
+
+from group_stats import stack_blocks
+
+
+# Returns the sign flips (permutations, subjects) as int8, the first one
+# without flips (the observed data)
+def sign_flips(n_permutations, n_subjects, seed=0):
+    if 2 ** n_subjects <= n_permutations:
+        # All patterns, starting with the one without flips
+        return np.array(list(itertools.product([1, -1], repeat=n_subjects)),
+                        dtype=np.int8)
+    rng = np.random.RandomState(seed)
+    flips = rng.randint(0, 2, size=(n_permutations, n_subjects))
+    flips = (1 - 2 * flips).astype(np.int8)
+    flips[0] = 1
+    return flips
+
+
+# Returns the T maps (permutations, mask voxels) of a batch of sign flips
+# for one contrast of the stack
+def flipped_tmaps(stack, contrast, mask, flips, max_bytes):
+    n_subjects = stack.shape[1]
+    F = flips.astype(np.float64)
+    tmaps = np.empty((len(flips), int(mask.sum())), dtype=np.float32)
+    pos = 0
+    for start, stop in stack_blocks(stack.shape, max_bytes):
+        inside = mask[start:stop]
+        n_inside = int(inside.sum())
+        if not n_inside:
+            continue
+        data = np.asarray(stack[contrast, :, start:stop],
+                          dtype=np.float64)[:, inside]
+        mean = F.dot(data) / n_subjects
+        ss = (data * data).sum(axis=0)
+        resms = np.maximum(ss - n_subjects * mean * mean, 1e-30) / \
+            (n_subjects - 1)
+        tmaps[:, pos:pos + n_inside] = mean / np.sqrt(resms / n_subjects)
+        pos += n_inside
+    return tmaps
+
+
+# Returns the mass of every cluster of a T map above cluster_t and the
+# cluster label of every voxel
+def cluster_masses(tmap, mask, shape, cluster_t):
+    volume = np.zeros(mask.shape, dtype=np.float32)
+    volume[mask] = tmap
+    volume = volume.reshape(shape, order='F')
+    labels, n_clusters = ndimage.label(volume > cluster_t)
+    if not n_clusters:
+        return np.zeros(0), labels
+    masses = ndimage.sum(volume, labels, np.arange(1, n_clusters + 1))
+    return np.asarray(masses), labels
+
+
+# Returns the maximum T value and the maximum cluster mass of every
+# permutation of a batch. Runs in the worker processes.
+def permutation_batch(task):
+    stack_file, mask_file, contrast, flips, shape, cluster_t, max_bytes = task
+    stack = np.load(stack_file, mmap_mode='r')
+    mask = np.load(mask_file)
+    tmaps = flipped_tmaps(stack, contrast, mask, flips, max_bytes)
+    max_t = tmaps.max(axis=1)
+    max_mass = np.zeros(len(flips))
+    for i, tmap in enumerate(tmaps):
+        masses, _ = cluster_masses(tmap, mask, shape, cluster_t)
+        if len(masses):
+            max_mass[i] = masses.max()
+    return max_t, max_mass
+
+
+# Returns the familywise error corrected p value of every value, the
+# fraction of permutations whose maximum is at least as large
+def fwe_p_values(values, null_maxima):
+    null_maxima = np.sort(null_maxima)
+    larger = len(null_maxima) - np.searchsorted(null_maxima, values,
+                                                side='left')
+    return larger / len(null_maxima)
+
+
+# SignFlipPermutationTest - nonparametric FWE correction of one-sample tests
+class SignFlipPermutationTestInputSpec(BaseInterfaceInputSpec):
+    stack_file = File(exists=True, mandatory=True,
+                      desc='stacked contrast images of BatchedOneSampleTTest')
+    contrast_dirs = traits.List(Directory(exists=True), mandatory=True,
+                                desc='output folders of BatchedOneSampleTTest '
+                                     '(for mask and grid)')
+    n_permutations = traits.Int(10000, usedefault=True,
+                                desc='number of sign flip permutations')
+    seed = traits.Int(0, usedefault=True, desc='seed of the sign flips')
+    cluster_p = traits.Float(0.001, usedefault=True,
+                             desc='uncorrected p value of the cluster '
+                                  'forming threshold')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='processes that compute the permutations')
+    chunk_mb = traits.Float(256., usedefault=True, nohash=True,
+                            desc='memory per batch of permutations in MB')
+
+
+class SignFlipPermutationTestOutputSpec(TraitedSpec):
+    out_dirs = OutputMultiPath(Directory(exists=True),
+                               desc='output folder of every contrast')
+    voxel_p_images = OutputMultiPath(File(exists=True),
+                                     desc='FWE corrected p of every voxel')
+    cluster_p_images = OutputMultiPath(File(exists=True),
+                                       desc='FWE corrected p of the cluster '
+                                            'of every voxel')
+    null_files = OutputMultiPath(File(exists=True),
+                                 desc='maximum T and cluster mass of every '
+                                      'permutation (.npz)')
+
+
+class SignFlipPermutationTest(BaseInterface):
+    input_spec = SignFlipPermutationTestInputSpec
+    output_spec = SignFlipPermutationTestOutputSpec
+
+    def _run_interface(self, runtime):
+        stack_file = self.inputs.stack_file
+        stack = np.load(stack_file, mmap_mode='r')
+        n_contrasts, n_subjects, _ = stack.shape
+        if len(self.inputs.contrast_dirs) != n_contrasts:
+            raise ValueError('%d contrast folders given for %d contrasts'
+                             % (len(self.inputs.contrast_dirs), n_contrasts))
+        max_bytes = self.inputs.chunk_mb * 1024. ** 2
+        n_procs = max(self.inputs.num_threads, 1)
+        flips = sign_flips(self.inputs.n_permutations, n_subjects,
+                           self.inputs.seed)
+        cluster_t = stats.t.isf(self.inputs.cluster_p, n_subjects - 1)
+
+        tasks, contrasts = [], []
+        for c, contrast_dir in enumerate(self.inputs.contrast_dirs):
+            out_dir = abspath(basename(contrast_dir.rstrip(os.sep)))
+            if not exists(out_dir):
+                os.makedirs(out_dir)
+            mask_img = nb.load(opj(contrast_dir, 'mask.nii'))
+            mask = np.asanyarray(mask_img.dataobj).ravel(order='F') > 0
+            mask_file = opj(out_dir, 'mask.npy')
+            np.save(mask_file, mask)
+            contrasts.append((out_dir, mask_img, mask))
+            # The T maps of a batch are kept in memory, with enough batches
+            # for all processes
+            batch = int(max_bytes // max(mask.sum() * 4 * 3, 1))
+            batch = max(min(batch, -(-len(flips) // n_procs)), 1)
+            tasks.extend((stack_file, mask_file, c,
+                          flips[start:start + batch], mask_img.shape,
+                          cluster_t, max_bytes)
+                         for start in range(0, len(flips), batch))
+
+        pool = Pool(n_procs)
+        try:
+            results = pool.map(permutation_batch, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        for c, (out_dir, mask_img, mask) in enumerate(contrasts):
+            max_t = np.concatenate([r[0] for r, t in zip(results, tasks)
+                                    if t[2] == c])
+            max_mass = np.concatenate([r[1] for r, t in zip(results, tasks)
+                                       if t[2] == c])
+            tmap = flipped_tmaps(stack, c, mask, flips[:1], max_bytes)[0]
+            masses, labels = cluster_masses(tmap, mask, mask_img.shape,
+                                            cluster_t)
+
+            voxel_p = np.full(mask.shape, np.nan, dtype=np.float32)
+            voxel_p[mask] = fwe_p_values(tmap, max_t)
+            cluster_p = np.full(mask_img.shape, np.nan, dtype=np.float32)
+            if len(masses):
+                cluster_p[labels > 0] = fwe_p_values(
+                    masses, max_mass)[labels[labels > 0] - 1]
+            for name, data, descrip in [
+                    ('fwe_p_voxel.nii', voxel_p.reshape(mask_img.shape,
+                                                        order='F'),
+                     'max T FWE p - %d sign flips' % len(flips)),
+                    ('fwe_p_cluster.nii', cluster_p,
+                     'cluster mass FWE p - T > %.2f, %d sign flips'
+                     % (cluster_t, len(flips)))]:
+                img = nb.Nifti1Image(data, mask_img.affine)
+                img.header['descrip'] = descrip.encode()
+                img.to_filename(opj(out_dir, name))
+            np.savez(opj(out_dir, 'null_distribution.npz'), max_t=max_t,
+                     max_mass=max_mass, cluster_t=cluster_t,
+                     seed=self.inputs.seed, n_permutations=len(flips))
+            os.remove(opj(out_dir, 'mask.npy'))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        dirs = [abspath(basename(d.rstrip(os.sep)))
+                for d in self.inputs.contrast_dirs]
+        outputs['out_dirs'] = dirs
+        outputs['voxel_p_images'] = [opj(d, 'fwe_p_voxel.nii') for d in dirs]
+        outputs['cluster_p_images'] = [opj(d, 'fwe_p_cluster.nii')
+                                       for d in dirs]
+        outputs['null_files'] = [opj(d, 'null_distribution.npz')
+                                 for d in dirs]
+        return outputs
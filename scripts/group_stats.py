@@ -0,0 +1,435 @@
+###
+# Group statistics - one-sample t-tests of all contrasts in a single pass
+#
+# The SPM path (OneSampleTTestDesign -> EstimateModel -> EstimateContrast)
+# runs one MATLAB session per contrast, which reads all subjects and the
+# mask again. BatchedOneSampleTTest stacks the contrast images of all
+# subjects into one (contrasts x subjects x voxels) memory-mapped array and
+# fits the one-sample t-tests of all contrasts at once, block of voxels by
+# block of voxels:
+#
+#   ttest = Node(BatchedOneSampleTTest(contrast_ids=contrast_list),
+#                name='ttest')
+#
+# Every contrast gets a folder with the images SPM would write (mask.nii,
+# beta_0001.nii, ResMS.nii, con_0001.nii and spmT_0001.nii), estimated
+# within the same mask as SPM's: voxels that are finite in all images and
+# not the same in all of them. The compare command checks the results
+# against the output of the SPM path:
+#
+#   python group_stats.py compare output_fMRI_example_2nd_ants/contrasts \
+#       output_fMRI_example_2nd_batched/contrasts
+#
+# For very large groups even the stack is too much. StreamingOneSampleTTest
+# reads one subject after the other through a memory map, slab by slab, and
+# accumulates mean and sum of squared deviations with Welford's update. Only
+# the accumulators of one contrast are kept in memory, whatever the number of
+# subjects:
+#
+#   ttest = Node(StreamingOneSampleTTest(p_threshold=0.001), name='ttest')
+#
+# Besides the images of SPM it writes the T map thresholded at p_threshold
+# (uncorrected), restricted to the optional mask_file.
+#
+# With state_dir, the accumulators of every contrast are kept in
+# {state_dir}/{contrast_id}.npz together with the (mtime, size) stamps of
+# the images they contain. If subjects are added, only their images are
+# read and folded into the stored accumulators. If an image of the state
+# changed or was removed, the state of that contrast is rebuilt.
+
+from __future__ import division, print_function
+import os
+from os.path import join as opj, exists, abspath, expanduser, dirname
+
+import numpy as np
+import nibabel as nb
+from scipy import stats
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, Directory,
+                                    OutputMultiPath, traits, isdefined)
+
+from onset_cache import file_stamps
+
+
+# Stacks the contrast images (a list of subject images per contrast) into
+# a (contrasts, subjects, voxels) float32 array in the .npy file stack_file
+def stack_contrasts(contrast_files, stack_file):
+    n_subjects = len(contrast_files[0])
+    if any(len(files) != n_subjects for files in contrast_files):
+        raise ValueError('All contrasts need images of the same subjects')
+    ref = nb.load(contrast_files[0][0])
+    n_voxels = int(np.prod(ref.shape[:3]))
+
+    part_file = stack_file + '.part'
+    stack = np.lib.format.open_memmap(
+        part_file, mode='w+', dtype=np.float32,
+        shape=(len(contrast_files), n_subjects, n_voxels))
+    for c, files in enumerate(contrast_files):
+        for s, f in enumerate(files):
+            img = nb.load(f)
+            if img.shape[:3] != ref.shape[:3] or \
+                    not np.allclose(img.affine, ref.affine):
+                raise ValueError('%s is not on the same grid as %s'
+                                 % (f, contrast_files[0][0]))
+            stack[c, s] = np.asarray(img.dataobj, dtype=np.float32).ravel(
+                order='F')
+    stack.flush()
+    del stack
+    os.rename(part_file, stack_file)
+    return ref.shape[:3], ref.affine
+
+
+# Returns the blocks of voxels (start, stop) of a stack that fit into
+# max_bytes
+def stack_blocks(shape, max_bytes):
+    # The block is kept in float64 together with a few temporary arrays
+    voxel_bytes = shape[0] * shape[1] * 8 * 3
+    n_voxels = max(int(max_bytes // voxel_bytes), 1)
+    return [(v, min(v + n_voxels, shape[2]))
+            for v in range(0, shape[2], n_voxels)]
+
+
+# Fits the one-sample t-test of every contrast of a stack. Returns mask,
+# mean (beta and con), residual mean square and T value as (contrasts,
+# voxels) arrays.
+def one_sample_ttest(stack, max_bytes=256 * 1024. ** 2):
+    n_contrasts, n_subjects, n_voxels = stack.shape
+    mask = np.zeros((n_contrasts, n_voxels), dtype=bool)
+    mean, resms, tmap = [np.full((n_contrasts, n_voxels), np.nan,
+                                 dtype=np.float32) for _ in range(3)]
+    for start, stop in stack_blocks(stack.shape, max_bytes):
+        data = np.asarray(stack[:, :, start:stop], dtype=np.float64)
+        # Same mask as SPM: finite in all images, not equal in all images
+        block_mask = np.isfinite(data).all(axis=1) & \
+            (data != data[:, :1]).any(axis=1)
+        block_mean = data.mean(axis=1)
+        block_resms = data.var(axis=1, ddof=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block_t = block_mean / np.sqrt(block_resms / n_subjects)
+        mask[:, start:stop] = block_mask
+        for out, values in [(mean, block_mean), (resms, block_resms),
+                            (tmap, block_t)]:
+            out[:, start:stop] = np.where(block_mask, values, np.nan)
+    return mask, mean, resms, tmap
+
+
+# Returns the slabs of slices (start, stop) of an image that fit into
+# max_bytes
+def image_slabs(shape, max_bytes):
+    # The slab is kept in float64 together with a few temporary arrays
+    slice_bytes = shape[0] * shape[1] * 8 * 4
+    n_z = max(int(max_bytes // slice_bytes), 1)
+    return [(z, min(z + n_z, shape[2])) for z in range(0, shape[2], n_z)]
+
+
+# Mean and sum of squared deviations of images that are added one at a time
+# (Welford's update). A voxel belongs to the mask if it is finite in all
+# images and not the same in all of them, like in SPM.
+class WelfordStats(object):
+
+    def __init__(self, shape, affine):
+        self.shape = tuple(shape[:3])
+        self.affine = affine
+        n_voxels = int(np.prod(self.shape))
+        self.n = 0
+        self.mean = np.zeros(n_voxels)
+        self.m2 = np.zeros(n_voxels)
+        self.first = np.zeros(n_voxels, dtype=np.float32)
+        self.finite = np.ones(n_voxels, dtype=bool)
+        self.differs = np.zeros(n_voxels, dtype=bool)
+        self.files = []
+        self.stamps = np.zeros((0, 2))
+
+    # Adds the image of one subject, read slab by slab from a memory map
+    def add_image(self, filename, max_bytes=256 * 1024. ** 2):
+        img = nb.load(filename, mmap=True)
+        if img.shape[:3] != self.shape or \
+                not np.allclose(img.affine, self.affine):
+            raise ValueError('%s is not on the grid of the other images'
+                             % filename)
+        self.n += 1
+        self.files.append(abspath(filename))
+        self.stamps = np.vstack([self.stamps, file_stamps([filename])])
+        slice_size = self.shape[0] * self.shape[1]
+        for z0, z1 in image_slabs(self.shape, max_bytes):
+            v = slice(z0 * slice_size, z1 * slice_size)
+            x = np.asarray(img.dataobj[:, :, z0:z1],
+                           dtype=np.float32).ravel(order='F')
+            self.finite[v] &= np.isfinite(x)
+            if self.n == 1:
+                self.first[v] = x
+            else:
+                self.differs[v] |= x != self.first[v]
+            x = x.astype(np.float64)
+            delta = x - self.mean[v]
+            self.mean[v] += delta / self.n
+            self.m2[v] += delta * (x - self.mean[v])
+
+    # Stores the accumulators and the stamps of the added images
+    def save(self, filename):
+        # Write to a temporary file first, so that a crash never leaves a
+        # half written state
+        tmp_file = filename[:-4] + '_%d.tmp.npz' % os.getpid()
+        np.savez(tmp_file, shape=self.shape, affine=self.affine, n=self.n,
+                 mean=self.mean, m2=self.m2, first=self.first,
+                 finite=self.finite, differs=self.differs,
+                 files=np.array(self.files), stamps=self.stamps)
+        os.rename(tmp_file, filename)
+
+    # Returns the accumulators stored by save
+    @classmethod
+    def load(cls, filename):
+        state = np.load(filename)
+        welford = cls(tuple(state['shape']), state['affine'])
+        welford.n = int(state['n'])
+        for key in ['mean', 'm2', 'first', 'finite', 'differs', 'stamps']:
+            setattr(welford, key, state[key])
+        welford.files = [str(f) for f in state['files']]
+        return welford
+
+    # Returns mask, mean, residual mean square and T value, NaN outside of
+    # the mask (or of an additional mask image)
+    def ttest(self, mask_file=None):
+        mask = self.finite & self.differs
+        if mask_file is not None:
+            mask &= np.asanyarray(nb.load(mask_file).dataobj).ravel(
+                order='F') > 0
+        mean, resms, tmap = [np.full(mask.shape, np.nan, dtype=np.float32)
+                             for _ in range(3)]
+        mean[mask] = self.mean[mask]
+        resms[mask] = self.m2[mask] / (self.n - 1)
+        tmap[mask] = self.mean[mask] / np.sqrt(self.m2[mask] /
+                                               (self.n - 1) / self.n)
+        return mask, mean, resms, tmap
+
+
+# Returns the Welford statistics of a list of images
+def streaming_stats(in_files, max_bytes=256 * 1024. ** 2):
+    ref = nb.load(in_files[0], mmap=True)
+    welford = WelfordStats(ref.shape, ref.affine)
+    for f in in_files:
+        welford.add_image(f, max_bytes)
+    return welford
+
+
+# Returns the Welford statistics of a list of images, continuing the ones
+# stored in state_file. Only images that are not yet in the state are read.
+def update_stats(in_files, state_file, max_bytes=256 * 1024. ** 2):
+    in_files = [abspath(f) for f in in_files]
+    state_file = abspath(expanduser(state_file))
+    welford = None
+    if exists(state_file):
+        welford = WelfordStats.load(state_file)
+        # Removed or changed images can't be taken out of the accumulators
+        if any(f not in in_files or not exists(f) for f in welford.files) \
+                or not np.array_equal(file_stamps(welford.files),
+                                      welford.stamps):
+            welford = None
+    if welford is None:
+        ref = nb.load(in_files[0], mmap=True)
+        welford = WelfordStats(ref.shape, ref.affine)
+    new_files = [f for f in in_files if f not in welford.files]
+    for f in new_files:
+        welford.add_image(f, max_bytes)
+    if new_files:
+        if not exists(dirname(state_file)):
+            os.makedirs(dirname(state_file))
+        welford.save(state_file)
+    return welford
+
+
+# Returns a T map with all voxels below the T value of p_threshold
+# (uncorrected, one-sided) set to zero, like SPM's thresholded maps
+def threshold_map(tmap, dof, p_threshold):
+    cutoff = stats.t.isf(p_threshold, dof)
+    thresholded = np.where(tmap >= cutoff, tmap, 0).astype(np.float32)
+    return thresholded, cutoff
+
+
+# Writes the images of a one-sample t-test in SPM's names into out_dir
+def write_spm_images(out_dir, shape, affine, n_subjects, mask, mean, resms,
+                     tmap):
+    if not exists(out_dir):
+        os.makedirs(out_dir)
+    dof = n_subjects - 1
+    images = [('mask.nii', mask.astype(np.uint8), 'SPM mask'),
+              ('beta_0001.nii', mean, 'SPM beta - mean'),
+              ('ResMS.nii', resms, 'SPM residual mean square'),
+              ('con_0001.nii', mean, 'SPM contrast - 1: Group'),
+              # SPM stores the degrees of freedom in the description
+              ('spmT_0001.nii', tmap,
+               'SPM{T_[%.1f]} - contrast 1: Group' % dof)]
+    filenames = []
+    for name, data, descrip in images:
+        img = nb.Nifti1Image(data.reshape(shape, order='F'), affine)
+        img.header['descrip'] = descrip.encode()
+        img.to_filename(opj(out_dir, name))
+        filenames.append(opj(out_dir, name))
+    return filenames
+
+
+# Returns the largest differences of con and spmT images and the number of
+# voxels with a different mask between an SPM and a batched output folder
+def compare_spm(spm_dir, batched_dir):
+    result = {}
+    for name in ['con_0001.nii', 'spmT_0001.nii']:
+        spm = nb.load(opj(spm_dir, name)).get_fdata()
+        batched = nb.load(opj(batched_dir, name)).get_fdata()
+        spm_mask = np.isfinite(spm) & (spm != 0)
+        batched_mask = np.isfinite(batched)
+        both = spm_mask & batched_mask
+        result[name] = {
+            'mask_differences': int((spm_mask != batched_mask).sum()),
+            'max_abs_difference': float(np.abs(spm[both] -
+                                               batched[both]).max())
+            if both.any() else 0.}
+    return result
+
+
+# BatchedOneSampleTTest - one-sample t-tests of all contrasts at once
+class BatchedOneSampleTTestInputSpec(BaseInterfaceInputSpec):
+    contrast_files = traits.List(traits.List(File(exists=True)),
+                                 mandatory=True,
+                                 desc='images of all subjects, per contrast')
+    contrast_ids = traits.List(traits.Str(), mandatory=True,
+                               desc='name of the folder of every contrast')
+    chunk_mb = traits.Float(256., usedefault=True, nohash=True,
+                            desc='memory per block of voxels in MB')
+
+
+class BatchedOneSampleTTestOutputSpec(TraitedSpec):
+    contrast_dirs = OutputMultiPath(Directory(exists=True),
+                                    desc='output folder of every contrast')
+    con_images = OutputMultiPath(File(exists=True), desc='con_0001 images')
+    spmT_images = OutputMultiPath(File(exists=True), desc='spmT_0001 images')
+    stack_file = File(exists=True,
+                      desc='stacked contrast images (contrasts, subjects, '
+                           'voxels)')
+
+
+class BatchedOneSampleTTest(BaseInterface):
+    input_spec = BatchedOneSampleTTestInputSpec
+    output_spec = BatchedOneSampleTTestOutputSpec
+
+    def _run_interface(self, runtime):
+        contrast_files = self.inputs.contrast_files
+        if len(contrast_files) != len(self.inputs.contrast_ids):
+            raise ValueError('%d contrast ids given for %d contrasts'
+                             % (len(self.inputs.contrast_ids),
+                                len(contrast_files)))
+        stack_file = abspath('contrast_stack.npy')
+        shape, affine = stack_contrasts(contrast_files, stack_file)
+        stack = np.load(stack_file, mmap_mode='r')
+        results = one_sample_ttest(stack,
+                                   self.inputs.chunk_mb * 1024. ** 2)
+        for c, contrast_id in enumerate(self.inputs.contrast_ids):
+            write_spm_images(abspath(contrast_id), shape, affine,
+                             stack.shape[1], *[r[c] for r in results])
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        dirs = [abspath(c) for c in self.inputs.contrast_ids]
+        outputs['contrast_dirs'] = dirs
+        outputs['con_images'] = [opj(d, 'con_0001.nii') for d in dirs]
+        outputs['spmT_images'] = [opj(d, 'spmT_0001.nii') for d in dirs]
+        outputs['stack_file'] = abspath('contrast_stack.npy')
+        return outputs
+
+
+# StreamingOneSampleTTest - one-sample t-test of one contrast, subject by
+# subject
+class StreamingOneSampleTTestInputSpec(BaseInterfaceInputSpec):
+    in_files = traits.List(File(exists=True), mandatory=True, minlen=2,
+                           desc='contrast images of all subjects')
+    mask_file = File(exists=True, desc='restricts the test to this mask')
+    p_threshold = traits.Float(0.001, usedefault=True,
+                               desc='uncorrected p value of the thresholded '
+                                    'T map')
+    chunk_mb = traits.Float(256., usedefault=True, nohash=True,
+                            desc='memory per slab in MB')
+    state_dir = Directory(desc='folder of the stored accumulators')
+    contrast_id = traits.Str('contrast', usedefault=True,
+                             desc='name of the stored accumulators')
+
+
+class StreamingOneSampleTTestOutputSpec(TraitedSpec):
+    mask_image = File(exists=True, desc='mask of the test')
+    beta_image = File(exists=True, desc='mean image')
+    residual_image = File(exists=True,
+                          desc='mean-squared image of the residuals')
+    con_image = File(exists=True, desc='contrast image')
+    spmT_image = File(exists=True, desc='T image')
+    thresholded_map = File(exists=True,
+                           desc='T image thresholded at p_threshold')
+    cutoff = traits.Float(desc='T value of p_threshold')
+
+
+class StreamingOneSampleTTest(BaseInterface):
+    input_spec = StreamingOneSampleTTestInputSpec
+    output_spec = StreamingOneSampleTTestOutputSpec
+
+    def _run_interface(self, runtime):
+        max_bytes = self.inputs.chunk_mb * 1024. ** 2
+        if isdefined(self.inputs.state_dir):
+            welford = update_stats(self.inputs.in_files,
+                                   opj(self.inputs.state_dir,
+                                       self.inputs.contrast_id + '.npz'),
+                                   max_bytes)
+        else:
+            welford = streaming_stats(self.inputs.in_files, max_bytes)
+        mask_file = self.inputs.mask_file \
+            if isdefined(self.inputs.mask_file) else None
+        mask, mean, resms, tmap = welford.ttest(mask_file)
+        write_spm_images(os.getcwd(), welford.shape, welford.affine,
+                         welford.n, mask, mean, resms, tmap)
+        thresholded, _ = threshold_map(tmap, welford.n - 1,
+                                       self.inputs.p_threshold)
+        img = nb.Nifti1Image(thresholded.reshape(welford.shape, order='F'),
+                             welford.affine)
+        img.header['descrip'] = ('SPM{T_[%.1f]} - p < %g (unc.)'
+                                 % (welford.n - 1,
+                                    self.inputs.p_threshold)).encode()
+        img.to_filename(abspath('spmT_0001_thr.nii'))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['mask_image'] = abspath('mask.nii')
+        outputs['beta_image'] = abspath('beta_0001.nii')
+        outputs['residual_image'] = abspath('ResMS.nii')
+        outputs['con_image'] = abspath('con_0001.nii')
+        outputs['spmT_image'] = abspath('spmT_0001.nii')
+        outputs['thresholded_map'] = abspath('spmT_0001_thr.nii')
+        outputs['cutoff'] = float(stats.t.isf(self.inputs.p_threshold,
+                                              len(self.inputs.in_files) - 1))
+        return outputs
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare batched group '
+                                                 't-tests with SPM')
+    parser.add_argument('action', choices=['compare'])
+    parser.add_argument('spm_dir', help='contrast folders of the SPM path')
+    parser.add_argument('batched_dir',
+                        help='contrast folders of the batched path')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='largest accepted difference')
+    args = parser.parse_args()
+
+    failed = False
+    for contrast_id in sorted(os.listdir(args.batched_dir)):
+        if not exists(opj(args.spm_dir, contrast_id, 'spmT_0001.nii')):
+            continue
+        result = compare_spm(opj(args.spm_dir, contrast_id),
+                             opj(args.batched_dir, contrast_id))
+        for name, diff in sorted(result.items()):
+            ok = diff['mask_differences'] == 0 and \
+                diff['max_abs_difference'] <= args.tolerance
+            failed = failed or not ok
+            print('%s %-14s %s  max. difference %.2g, %d mask differences'
+                  % (contrast_id, name, 'ok  ' if ok else 'FAIL',
+                     diff['max_abs_difference'], diff['mask_differences']))
+    raise SystemExit(1 if failed else 0)
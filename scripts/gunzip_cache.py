@@ -0,0 +1,164 @@
+###
+# Gunzip cache - decompresses every .gz file only once
+#
+# CachedGunzip is a Gunzip node that keeps the decompressed files in a cache
+# folder, under the SHA-1 of the compressed file. If the same file (e.g. the
+# same struct.nii.gz in a rerun of the normalization) is decompressed again,
+# the cached file is hard-linked into the node folder instead. Cached files
+# are read-only, so that no node can change them through the hard link. The
+# least recently used files are removed when the cache grows above
+# cache_size_gb. The last use of a cached file is recorded in its access
+# time, its modification time stays the same for the hard-linked node
+# outputs:
+#
+#   gunzip = Node(CachedGunzip(cache_dir=opj(experiment_dir, 'gunzip_cache')),
+#                 name='gunzip')
+#
+# Files in BGZF format (gzip files made of many independent members, e.g.
+# written by bgzip) are decompressed by num_threads threads in parallel.
+# Usual gzip files consist of one member and are decompressed sequentially.
+
+import os
+import stat
+import mmap
+import struct
+import zlib
+import time
+from multiprocessing.pool import ThreadPool
+from os.path import join as opj, exists, expanduser
+
+from nipype.algorithms.misc import Gunzip, GunzipInputSpec
+from nipype.interfaces.base import Directory, traits, isdefined
+
+from transform_cache import file_hash, link_or_copy
+
+
+# Returns (offset, size) of every member of a BGZF file, or None if the file
+# isn't in BGZF format. The size of a BGZF member is stored in its header.
+def bgzf_blocks(data):
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        header = data[offset:offset + 18]
+        if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or \
+                header[12:14] != b'BC':
+            return None
+        size = struct.unpack('<H', header[16:18])[0] + 1
+        blocks.append((offset, size))
+        offset += size
+    return blocks if len(blocks) > 1 else None
+
+
+# Decompresses a gzip file, BGZF members in parallel
+def decompress(in_file, out_file, num_threads=1):
+    with open(in_file, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            data = b''
+        blocks = bgzf_blocks(data) if num_threads > 1 else None
+        with open(out_file, 'wb') as out:
+            if blocks is None:
+                decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                for i in range(0, len(data), 1 << 24):
+                    out.write(decoder.decompress(data[i:i + (1 << 24)]))
+                    # Files may consist of several members
+                    while decoder.eof and decoder.unused_data:
+                        rest = decoder.unused_data
+                        decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                        out.write(decoder.decompress(rest))
+                out.write(decoder.flush())
+            else:
+                pool = ThreadPool(num_threads)
+                try:
+                    # zlib releases the GIL, so the threads run in parallel
+                    for chunk in pool.imap(
+                            lambda b: zlib.decompress(data[b[0]:b[0] + b[1]],
+                                                      zlib.MAX_WBITS | 16),
+                            blocks, chunksize=16):
+                        out.write(chunk)
+                finally:
+                    pool.close()
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+# Removes the least recently used files until the cache fits into size_gb
+def evict(cache_dir, size_gb, keep=None):
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith('.part'):
+            continue
+        info = os.stat(opj(cache_dir, f))
+        entries.append((info.st_atime, info.st_size, opj(cache_dir, f)))
+    total = sum(e[1] for e in entries)
+    for atime, size, filename in sorted(entries):
+        if total <= size_gb * 1024. ** 3:
+            break
+        if filename == keep:
+            continue
+        try:
+            os.remove(filename)
+            total -= size
+        except OSError:
+            # Another node removed it already
+            pass
+
+
+class CachedGunzipInputSpec(GunzipInputSpec):
+    cache_dir = Directory(desc='folder of the decompression cache')
+    cache_size_gb = traits.Float(20., usedefault=True,
+                                 desc='size of the cache in GB')
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc='threads to decompress BGZF files')
+
+
+# CachedGunzip - Gunzip with a decompression cache
+class CachedGunzip(Gunzip):
+    input_spec = CachedGunzipInputSpec
+
+    def _run_interface(self, runtime):
+        out_file = self._gen_output_file_name()
+        if exists(out_file):
+            os.remove(out_file)
+
+        if not isdefined(self.inputs.cache_dir):
+            decompress(self.inputs.in_file, out_file, self.inputs.num_threads)
+            return runtime
+
+        cache_dir = expanduser(self.inputs.cache_dir)
+        if not exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Another node created it in the meantime
+                pass
+        ext = out_file[len(os.path.splitext(out_file)[0]):]
+        entry = opj(cache_dir, file_hash(self.inputs.in_file) + ext)
+
+        if exists(entry):
+            try:
+                info = os.stat(entry)
+                os.utime(entry, (time.time(), info.st_mtime))
+            except OSError:
+                # Removed from the cache in the meantime, see below
+                pass
+        else:
+            part = '%s.%d.part' % (entry, os.getpid())
+            decompress(self.inputs.in_file, part, self.inputs.num_threads)
+            os.chmod(part, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(part, entry)
+            evict(cache_dir, self.inputs.cache_size_gb, keep=entry)
+
+        try:
+            link_or_copy(entry, out_file)
+        except OSError:
+            # The file was removed from the cache in the meantime
+            decompress(self.inputs.in_file, out_file, self.inputs.num_threads)
+            return runtime
+        if not os.path.samefile(entry, out_file):
+            # A copy can be writable again
+            os.chmod(out_file, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP |
+                     stat.S_IROTH)
+        return runtime
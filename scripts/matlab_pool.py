@@ -0,0 +1,424 @@
+###
+# MATLAB pool - keeps a few MATLAB sessions running and sends the m-code of
+# all SPM nodes to them, instead of starting MATLAB for every node
+#
+# The pool is a spool folder. A node submits its m-code as a file to
+# pool_dir/jobs, a worker claims it by moving it to pool_dir/claimed (under a
+# name that contains the worker's name), runs it and writes its output and
+# status to pool_dir/done. Every worker writes its process id into
+# pool_dir/workers/{name}.ready. If the worker of a claimed job dies, the
+# node puts the job back into pool_dir/jobs, or runs it without the pool if
+# no worker is left. Start the pool before running the workflows and stop it
+# afterwards:
+#
+#   python matlab_pool.py start --pool_dir ~/nipype_tutorial/matlab_pool \
+#                               --n_workers 4
+#   python example_fMRI_1_first_level.py
+#   python matlab_pool.py report --pool_dir ~/nipype_tutorial/matlab_pool
+#   python matlab_pool.py stop --pool_dir ~/nipype_tutorial/matlab_pool
+#
+# The scripts use the pool through pool_matlab_cmd, which returns the command
+# of the pool client if a pool is running, and the usual MATLAB command
+# otherwise:
+#
+#   MatlabCommand.set_default_matlab_cmd(
+#       pool_matlab_cmd(pool_dir, "matlab -nodesktop -nosplash"))
+#
+# For testing without MATLAB, 'start --standin' starts Python workers that
+# follow the same protocol. They only log the m-code, or run it with another
+# command (e.g. 'octave-cli --eval') if --exec_cmd is given.
+
+from __future__ import division, print_function
+import os
+import sys
+import glob
+import errno
+import json
+import time
+import shlex
+import subprocess
+import uuid
+from os.path import join as opj, exists, abspath, expanduser
+
+
+###
+# Specify variables
+poll_interval = 0.2         # seconds between two looks into the spool folders
+claim_timeout = 600         # seconds until an unclaimed job runs without pool
+exception_marker = 'MATLAB code threw an exception'
+
+# Worker that runs in each MATLAB session. Every job runs in its own function
+# workspace, so that variables (e.g. 'jobs') don't leak into the next job.
+worker_code = r"""function matlab_pool_worker(pool_dir, name)
+%% Runs the jobs of a MATLAB pool until pool_dir/stop exists
+home_dir = pwd;
+ready = fullfile(pool_dir, 'workers', [name '.ready']);
+fid = fopen([ready '.part'], 'w');
+fprintf(fid, '%%d\n', feature('getpid'));
+fclose(fid);
+movefile([ready '.part'], ready);
+while ~exist(fullfile(pool_dir, 'stop'), 'file')
+    files = dir(fullfile(pool_dir, 'jobs', '*.job'));
+    if isempty(files)
+        pause(%(poll_interval)s);
+        continue;
+    end
+    job_id = files(1).name(1:end-4);
+    claimed = fullfile(pool_dir, 'claimed', [job_id '.' name '.job']);
+    if ~movefile(fullfile(pool_dir, 'jobs', files(1).name), claimed)
+        continue;
+    end
+    job = fileread(claimed);
+    line_end = find(job == sprintf('\n'), 1);
+    start_time = tic;
+    status = run_job(job(1:line_end-1), job(line_end+1:end), ...
+                     fullfile(pool_dir, 'done', [job_id '.log']));
+    cd(home_dir);
+    fid = fopen(fullfile(pool_dir, 'done', [job_id '.part']), 'w');
+    fprintf(fid, '%%s %%.3f\n', status, toc(start_time));
+    fclose(fid);
+    movefile(fullfile(pool_dir, 'done', [job_id '.part']), ...
+             fullfile(pool_dir, 'done', [job_id '.status']));
+    delete(claimed);
+end
+exit;
+
+function pool_status = run_job(pool_cwd, pool_script, pool_log)
+pool_path = path;
+diary(pool_log);
+try
+    cd(pool_cwd);
+    eval(pool_script);
+    pool_status = 'ok';
+catch ME
+    fprintf(2, '%(exception_marker)s:\n%%s\n', ME.message);
+    pool_status = 'error';
+end
+diary off;
+path(pool_path);
+""" % {'poll_interval': poll_interval, 'exception_marker': exception_marker}
+
+
+# Creates the spool folders of a pool
+def make_pool_dirs(pool_dir):
+    for folder in ['jobs', 'claimed', 'done', 'workers']:
+        if not exists(opj(pool_dir, folder)):
+            os.makedirs(opj(pool_dir, folder))
+
+
+# Writes the ready file of a worker with its process id
+def write_ready(pool_dir, name):
+    ready = opj(pool_dir, 'workers', name + '.ready')
+    with open(ready + '.part', 'w') as f:
+        f.write('%d\n' % os.getpid())
+    os.rename(ready + '.part', ready)
+
+
+# Returns True if the process with the given id is running
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # The process exists, but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+# Returns True if the worker wrote its ready file and is still running
+def worker_alive(pool_dir, name):
+    try:
+        with open(opj(pool_dir, 'workers', name + '.ready')) as f:
+            pid = int(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return False
+    return pid_running(pid)
+
+
+# Returns True if a pool with at least one started worker is running.
+# Ready files of dead workers (e.g. after a crash of the pool) are removed.
+def pool_running(pool_dir):
+    pool_dir = abspath(expanduser(pool_dir))
+    if not exists(opj(pool_dir, 'pool.json')) or \
+            exists(opj(pool_dir, 'stop')):
+        return False
+    running = False
+    for f in os.listdir(opj(pool_dir, 'workers')):
+        if not f.endswith('.ready'):
+            continue
+        if worker_alive(pool_dir, f[:-6]):
+            running = True
+        else:
+            try:
+                os.remove(opj(pool_dir, 'workers', f))
+            except OSError:
+                pass
+    return running
+
+
+# Returns the MATLAB command that the SPM interfaces should use: the pool
+# client if a pool is running, matlab_cmd otherwise
+def pool_matlab_cmd(pool_dir, matlab_cmd):
+    if not pool_running(pool_dir):
+        return matlab_cmd
+    return '%s %s submit --pool_dir %s' % (
+        sys.executable, abspath(__file__), abspath(expanduser(pool_dir)))
+
+
+# Starts the workers of a pool and returns their startup times
+def start_pool(pool_dir, n_workers, matlab_cmd, standin=False,
+               exec_cmd=None, startup_delay=0.):
+    pool_dir = abspath(expanduser(pool_dir))
+    make_pool_dirs(pool_dir)
+    if exists(opj(pool_dir, 'stop')):
+        os.remove(opj(pool_dir, 'stop'))
+    with open(opj(pool_dir, 'matlab_pool_worker.m'), 'w') as f:
+        f.write(worker_code)
+    with open(opj(pool_dir, 'pool.json'), 'w') as f:
+        json.dump({'matlab_cmd': matlab_cmd}, f)
+
+    started = {}
+    for i in range(n_workers):
+        name = 'worker%02d_%d' % (i, os.getpid())
+        if standin:
+            cmd = [sys.executable, abspath(__file__), 'worker',
+                   '--pool_dir', pool_dir, '--name', name,
+                   '--startup_delay', str(startup_delay)]
+            if exec_cmd:
+                cmd += ['--exec_cmd', exec_cmd]
+        else:
+            cmd = shlex.split(matlab_cmd) + [
+                '-r', "addpath('%s');matlab_pool_worker('%s','%s')"
+                % (pool_dir, pool_dir, name)]
+        with open(opj(pool_dir, 'workers', name + '.out'), 'w') as out:
+            subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT,
+                             cwd=pool_dir)
+        started[name] = time.time()
+
+    # Wait until all workers are ready and store their startup times
+    startup = {}
+    while len(startup) < len(started):
+        for name, t in started.items():
+            ready = opj(pool_dir, 'workers', name + '.ready')
+            if name not in startup and exists(ready):
+                startup[name] = os.stat(ready).st_mtime - t
+                with open(opj(pool_dir, 'workers', name + '.json'), 'w') as f:
+                    json.dump({'startup': startup[name]}, f)
+        time.sleep(poll_interval)
+    return startup
+
+
+# Tells all workers of a pool to stop after their current job
+def stop_pool(pool_dir):
+    pool_dir = abspath(expanduser(pool_dir))
+    open(opj(pool_dir, 'stop'), 'w').close()
+    if exists(opj(pool_dir, 'pool.json')):
+        os.remove(opj(pool_dir, 'pool.json'))
+    for f in os.listdir(opj(pool_dir, 'workers')):
+        if f.endswith('.ready'):
+            os.remove(opj(pool_dir, 'workers', f))
+
+
+# Returns the value of a MATLAB command line option, e.g. '-r'
+def matlab_option(args, option):
+    if option in args and args.index(option) + 1 < len(args):
+        return args[args.index(option) + 1]
+    return None
+
+
+# Runs a MATLAB command line without the pool and returns the exit code
+def run_without_pool(pool_dir, matlab_args):
+    with open(opj(pool_dir, 'pool.json')) as f:
+        matlab_cmd = json.load(f)['matlab_cmd']
+    return subprocess.call(shlex.split(matlab_cmd) + matlab_args)
+
+
+# Returns the claimed file of a job and the name of the worker that claimed
+# it, or (None, None) if no worker claimed it
+def job_claim(pool_dir, job_id):
+    for claimed in glob.glob(opj(pool_dir, 'claimed', job_id + '.*.job')):
+        return claimed, os.path.basename(claimed)[len(job_id) + 1:-4]
+    return None, None
+
+
+# Runs the m-code of a MATLAB command line (matlab_args) in the pool and
+# returns the exit code. Output of the m-code goes to stdout, exceptions also
+# to stderr, in the same way as with a MATLAB process started for the node.
+def submit(pool_dir, matlab_args):
+    pool_dir = abspath(expanduser(pool_dir))
+    script = matlab_option(matlab_args, '-r')
+    if script is None:
+        raise ValueError('No m-code (-r) in %s' % ' '.join(matlab_args))
+    # The workers keep running, so they must not exit after the job
+    for suffix in [';exit', ',exit', ';exit;']:
+        if script.rstrip().endswith(suffix):
+            script = script.rstrip()[:-len(suffix)]
+
+    job_id = '%d_%s' % (time.time() * 1e6, uuid.uuid4().hex)
+    job_file = opj(pool_dir, 'jobs', job_id + '.job')
+    with open(job_file + '.part', 'w') as f:
+        f.write(os.getcwd() + '\n' + script)
+    os.rename(job_file + '.part', job_file)
+
+    # Wait for a worker. If no worker claims the job in time, take it back
+    # and start MATLAB for it as usual. If the worker that claimed the job
+    # dies, put the job back for the other workers, or run it without the
+    # pool if none is left.
+    status_file = opj(pool_dir, 'done', job_id + '.status')
+    log_file = opj(pool_dir, 'done', job_id + '.log')
+    submitted = time.time()
+    while not exists(status_file):
+        if exists(job_file):
+            if time.time() - submitted > claim_timeout:
+                try:
+                    os.rename(job_file, job_file + '.timeout')
+                except OSError:
+                    continue
+                os.remove(job_file + '.timeout')
+                return run_without_pool(pool_dir, matlab_args)
+        else:
+            claimed, worker = job_claim(pool_dir, job_id)
+            if claimed is None:
+                # The worker writes the status before it removes the claim
+                if not exists(status_file) and not exists(job_file) and \
+                        job_claim(pool_dir, job_id)[0] is None:
+                    return run_without_pool(pool_dir, matlab_args)
+                continue
+            if not worker_alive(pool_dir, worker):
+                try:
+                    os.rename(claimed, job_file + '.dead')
+                except OSError:
+                    continue
+                if exists(log_file):
+                    os.remove(log_file)
+                if not pool_running(pool_dir):
+                    os.remove(job_file + '.dead')
+                    return run_without_pool(pool_dir, matlab_args)
+                os.rename(job_file + '.dead', job_file)
+                submitted = time.time()
+        time.sleep(poll_interval)
+
+    with open(status_file) as f:
+        status, seconds = f.read().split()
+    log = open(log_file).read() if exists(log_file) else ''
+    for f in [status_file, log_file]:
+        if exists(f):
+            os.remove(f)
+    with open(opj(pool_dir, 'history.log'), 'a') as f:
+        f.write('%s %s %s\n' % (job_id, status, seconds))
+
+    sys.stdout.write(log)
+    if exception_marker in log:
+        sys.stderr.write(log[log.index(exception_marker):])
+    logfile = matlab_option(matlab_args, '-logfile')
+    if logfile:
+        with open(logfile, 'w') as f:
+            f.write(log)
+    return 0 if status == 'ok' else 1
+
+
+# Stand-in worker for testing without MATLAB. It follows the protocol of
+# matlab_pool_worker.m and either logs the m-code or runs it with exec_cmd.
+def run_standin_worker(pool_dir, name, exec_cmd=None, startup_delay=0.):
+    pool_dir = abspath(expanduser(pool_dir))
+    time.sleep(startup_delay)
+    write_ready(pool_dir, name)
+    while not exists(opj(pool_dir, 'stop')):
+        jobs = sorted(f for f in os.listdir(opj(pool_dir, 'jobs'))
+                      if f.endswith('.job'))
+        if not jobs:
+            time.sleep(poll_interval)
+            continue
+        job_id = jobs[0][:-4]
+        claimed = opj(pool_dir, 'claimed', '%s.%s.job' % (job_id, name))
+        try:
+            os.rename(opj(pool_dir, 'jobs', jobs[0]), claimed)
+        except OSError:
+            continue
+        with open(claimed) as f:
+            job_cwd, script = f.read().split('\n', 1)
+
+        start = time.time()
+        log_file = opj(pool_dir, 'done', job_id + '.log')
+        with open(log_file, 'w') as log:
+            if exec_cmd:
+                returncode = subprocess.call(shlex.split(exec_cmd) + [script],
+                                             cwd=job_cwd, stdout=log,
+                                             stderr=subprocess.STDOUT)
+            else:
+                log.write('Stand-in worker %s ran in %s:\n%s\n'
+                          % (name, job_cwd, script))
+                returncode = 0
+        status = 'ok' if returncode == 0 else 'error'
+
+        status_file = opj(pool_dir, 'done', job_id + '.status')
+        with open(status_file + '.part', 'w') as f:
+            f.write('%s %.3f\n' % (status, time.time() - start))
+        os.rename(status_file + '.part', status_file)
+        os.remove(claimed)
+
+
+# Prints how many jobs the pool ran and how much MATLAB startup time it saved
+def pool_report(pool_dir):
+    pool_dir = abspath(expanduser(pool_dir))
+    startup = []
+    for f in os.listdir(opj(pool_dir, 'workers')):
+        if f.endswith('.json'):
+            with open(opj(pool_dir, 'workers', f)) as info:
+                startup.append(json.load(info)['startup'])
+    jobs = []
+    if exists(opj(pool_dir, 'history.log')):
+        with open(opj(pool_dir, 'history.log')) as f:
+            jobs = [line.split() for line in f if line.strip()]
+
+    mean_startup = sum(startup) / max(len(startup), 1)
+    saved = (len(jobs) - len(startup)) * mean_startup
+    print('Jobs run by the pool:      %d (%d failed)'
+          % (len(jobs), sum(1 for j in jobs if j[1] != 'ok')))
+    print('Workers started:           %d' % len(startup))
+    print('MATLAB startup per worker: %.1f s' % mean_startup)
+    print('Startup time saved:        %.1f s' % max(saved, 0.))
+    return saved
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # The pool client is called with MATLAB's command line options
+    if len(sys.argv) > 1 and sys.argv[1] == 'submit':
+        args = sys.argv[2:]
+        i = args.index('--pool_dir')
+        sys.exit(submit(args[i + 1], args[:i] + args[i + 2:]))
+
+    parser = argparse.ArgumentParser(description='Pool of running MATLAB '
+                                                 'sessions for SPM nodes')
+    parser.add_argument('action', choices=['start', 'stop', 'report',
+                                           'worker'])
+    parser.add_argument('--pool_dir', required=True,
+                        help='spool folder of the pool')
+    parser.add_argument('--n_workers', type=int, default=2,
+                        help='number of MATLAB sessions')
+    parser.add_argument('--matlab_cmd', default='matlab -nodesktop -nosplash',
+                        help='command to start MATLAB')
+    parser.add_argument('--standin', action='store_true',
+                        help='start Python stand-in workers instead of MATLAB')
+    parser.add_argument('--exec_cmd', default=None,
+                        help='command that stand-in workers run m-code with')
+    parser.add_argument('--startup_delay', type=float, default=0.,
+                        help='startup time that stand-in workers simulate')
+    parser.add_argument('--name', default='worker',
+                        help='name of the worker (used by start)')
+    args = parser.parse_args()
+
+    if args.action == 'start':
+        startup = start_pool(args.pool_dir, args.n_workers, args.matlab_cmd,
+                             args.standin, args.exec_cmd, args.startup_delay)
+        print('Started %d workers in %s (startup %.1f s each)'
+              % (len(startup), args.pool_dir,
+                 sum(startup.values()) / max(len(startup), 1)))
+    elif args.action == 'stop':
+        stop_pool(args.pool_dir)
+    elif args.action == 'report':
+        pool_report(args.pool_dir)
+    else:
+        run_standin_worker(args.pool_dir, args.name, args.exec_cmd,
+                           args.startup_delay)
@@ -0,0 +1,394 @@
+###
+# MultiProc plugins - execution plugins that share the cores of a machine
+# better between the nodes of a workflow
+#
+# ElasticMultiProcPlugin is the MultiProc plugin, except that the number of
+# threads of multi-threaded nodes (by default ANTs Registration and
+# ApplyTransforms) is chosen at the moment they are started. At the beginning
+# of a batch all cores are busy and every registration gets one thread. Late
+# in a batch, when only a few subjects remain, the remaining registrations and
+# warps get the idle cores instead:
+#
+#   normflow.run(plugin=ElasticMultiProcPlugin(plugin_args={'n_procs': 8}))
+#
+# CriticalPathMultiProcPlugin starts the ready nodes in the order of their
+# longest remaining path to the end of the workflow (the upward rank of HEFT)
+# instead of the order of the graph. The path lengths are the runtimes of
+# earlier runs, which the plugin keeps per node in runtime_history. Long
+# chains, like BBRegister -> ApplyVolTransform -> Binarize -> Level1Design,
+# then start before cheap nodes that nothing waits for:
+#
+#   metaflow.run(plugin=CriticalPathMultiProcPlugin(
+#       plugin_args={'n_procs': 8,
+#                    'runtime_history': opj(experiment_dir,
+#                                           'runtime_history.json')}))
+#
+# Running this file simulates a batch of 10 subjects and compares the
+# makespan with fixed single-threaded nodes against elastic thread counts,
+# or of the first-level workflow with FIFO against critical path order:
+#
+#   python multiproc_plugins.py --subjects 10 --n_procs 8
+#   python multiproc_plugins.py --compare critical_path
+
+from __future__ import division, print_function
+import os
+import json
+from os.path import exists, dirname, abspath, expanduser
+
+import numpy as np
+
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.plugins import MultiProcPlugin
+from nipype.interfaces.ants import Registration, ApplyTransforms
+
+
+# Interfaces whose number of threads is chosen at dispatch time
+elastic_interfaces = (Registration, ApplyTransforms)
+
+
+# Returns how many threads each of n_jobs elastic jobs gets if they share
+# free_processors cores, at least one and at most max_threads
+def elastic_threads(free_processors, n_jobs, max_threads=None):
+    threads = free_processors // max(n_jobs, 1)
+    if max_threads:
+        threads = min(threads, max_threads)
+    return max(threads, 1)
+
+
+# ElasticMultiProcPlugin - MultiProc with thread counts chosen at dispatch
+class ElasticMultiProcPlugin(MultiProcPlugin):
+    # Additional plugin_args:
+    #   max_threads        - most threads a single elastic node gets
+    #                        (default: n_procs)
+    #   elastic_interfaces - interface classes to treat as elastic
+    #                        (default: ANTs Registration and ApplyTransforms)
+
+    def __init__(self, plugin_args=None):
+        super(ElasticMultiProcPlugin, self).__init__(plugin_args=plugin_args)
+        self.max_threads = self.plugin_args.get('max_threads',
+                                                self.processors)
+        self.elastic_interfaces = tuple(self.plugin_args.get(
+            'elastic_interfaces', elastic_interfaces))
+
+    # Returns True if the number of threads of a node may be changed
+    def _is_elastic(self, jobid):
+        node = self.procs[jobid]
+        return isinstance(node.interface, self.elastic_interfaces) and \
+            hasattr(node.interface.inputs, 'num_threads')
+
+    # Sets the number of threads of the ready elastic nodes to their share of
+    # the cores that are free after all ready non-elastic nodes are started.
+    # num_threads isn't part of the node hash, so cached results stay valid.
+    def _balance_threads(self):
+        jobids = np.flatnonzero(
+            ~self.proc_done & (self.depidx.sum(axis=0) == 0).__array__())
+        if len(jobids) == 0:
+            return
+
+        free_processors = self._check_resources(self.pending_tasks)[1]
+        elastic = [j for j in jobids if self._is_elastic(j)]
+        for jobid in jobids:
+            if jobid not in elastic:
+                free_processors -= min(self.procs[jobid].n_procs,
+                                       self.processors)
+        if not elastic or free_processors <= 0:
+            return
+
+        threads = elastic_threads(free_processors, len(elastic),
+                                  self.max_threads)
+        for jobid in elastic:
+            self.procs[jobid].n_procs = threads
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        self._balance_threads()
+        return super(ElasticMultiProcPlugin, self)._send_procs_to_workers(
+            updatehash=updatehash, graph=graph)
+
+
+# Returns the upward rank of every job: its own runtime plus the largest
+# upward rank of the jobs that depend on it. depidx[i, j] != 0 if job j
+# depends on job i, the jobs are in topological order.
+def upward_ranks(runtimes, depidx):
+    depidx = depidx.tocsr()
+    ranks = np.array(runtimes, dtype=np.float64)
+    for i in range(len(ranks) - 1, -1, -1):
+        successors = depidx.indices[depidx.indptr[i]:depidx.indptr[i + 1]]
+        if len(successors):
+            ranks[i] += ranks[successors].max()
+    return ranks
+
+
+# Returns the name under which the runtime of a node is kept
+def runtime_key(node):
+    return '%s.%s' % (type(node.interface).__name__, node.name)
+
+
+# CriticalPathMultiProcPlugin - MultiProc that starts the ready nodes with
+# the longest remaining path first
+class CriticalPathMultiProcPlugin(MultiProcPlugin):
+    # Additional plugin_args:
+    #   runtime_history - JSON file with the runtime of every node type
+    #                     (default: runtime_history.json)
+    #   default_runtime - runtime of nodes without history in s (default: 60)
+    #   runtime_weight  - weight of the newest runtime in the running
+    #                     average of the history (default: 0.5)
+
+    def __init__(self, plugin_args=None):
+        super(CriticalPathMultiProcPlugin, self).__init__(
+            plugin_args=plugin_args)
+        self.history_file = abspath(expanduser(self.plugin_args.get(
+            'runtime_history', 'runtime_history.json')))
+        self.default_runtime = self.plugin_args.get('default_runtime', 60.)
+        self.runtime_weight = self.plugin_args.get('runtime_weight', 0.5)
+        self.history = {}
+        if exists(self.history_file):
+            with open(self.history_file) as f:
+                self.history = json.load(f)
+        self.priorities = np.zeros(0)
+
+    # Returns the estimated runtime of a node
+    def _runtime(self, node):
+        return self.history.get(runtime_key(node), self.default_runtime)
+
+    def _generate_dependency_list(self, graph):
+        super(CriticalPathMultiProcPlugin, self)._generate_dependency_list(
+            graph)
+        self.priorities = upward_ranks([self._runtime(node)
+                                        for node in self.procs],
+                                       self.depidx)
+
+    # Orders the ready jobs by priority. MapNode subnodes, which are added
+    # while the workflow runs, get the priority of their MapNode.
+    def _sort_jobs(self, jobids, scheduler='tsort'):
+        def priority(jobid):
+            if jobid >= len(self.priorities):
+                jobid = self.mapnodesubids[jobid]
+            return self.priorities[jobid]
+        return sorted(jobids, key=lambda jobid: -priority(jobid))
+
+    # Returns the runtime that the result of a node records, or None
+    def _result_runtime(self, node):
+        try:
+            duration = node.result.runtime.duration
+        except Exception:
+            return None
+        return float(duration) if duration is not None else None
+
+    # Adds the runtime of a finished node to the history. MapNode subnodes
+    # are kept under the name of their MapNode, the MapNode itself only
+    # collects their results.
+    def _task_finished_cb(self, jobid, cached=False):
+        node = self.procs[jobid]
+        runtime = None
+        if not cached and not isinstance(node, MapNode):
+            runtime = self._result_runtime(node)
+        if runtime is not None:
+            key = runtime_key(self.procs[self.mapnodesubids.get(jobid,
+                                                                jobid)])
+            if key in self.history:
+                runtime = self.runtime_weight * runtime + \
+                    (1 - self.runtime_weight) * self.history[key]
+            self.history[key] = runtime
+            self._save_history()
+        return super(CriticalPathMultiProcPlugin, self)._task_finished_cb(
+            jobid, cached=cached)
+
+    # Writes the history to a temporary file first, so that parallel runs
+    # never read a half written history
+    def _save_history(self):
+        if not exists(dirname(self.history_file)):
+            os.makedirs(dirname(self.history_file))
+        tmp_file = '%s.%d.tmp' % (self.history_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(self.history, f, indent=1, sort_keys=True)
+        os.rename(tmp_file, self.history_file)
+
+
+###
+# Simulation of a batch of subjects
+
+# Returns the speedup of a job with the given parallel fraction on n threads
+def amdahl_speedup(threads, parallel_fraction):
+    return 1. / ((1. - parallel_fraction) + parallel_fraction / threads)
+
+
+# Simulates the scheduling of one chain of jobs per subject (e.g.
+# registration -> warp) on n_procs cores and returns the finish time of every
+# subject. With elastic=False every job uses one thread, otherwise the free
+# cores are shared between the ready jobs at the moment they are started.
+def simulate_batch(chains, n_procs, elastic=True, parallel_fraction=0.9):
+    ready = [(s, 0) for s in range(len(chains))]
+    running = []    # (end time, subject, step, threads)
+    finished = [0.] * len(chains)
+    now = 0.
+    free = n_procs
+    while ready or running:
+        if ready and free > 0:
+            threads = elastic_threads(free, len(ready), n_procs) \
+                if elastic else 1
+            while ready and free >= threads:
+                s, step = ready.pop(0)
+                duration = chains[s][step] / amdahl_speedup(
+                    threads, parallel_fraction)
+                running.append((now + duration, s, step, threads))
+                free -= threads
+            continue
+
+        # Wait for the next job to finish
+        running.sort()
+        now, s, step, threads = running.pop(0)
+        free += threads
+        if step + 1 < len(chains[s]):
+            ready.append((s, step + 1))
+        else:
+            finished[s] = now
+    return finished
+
+
+# Nodes of the first-level workflow of one subject: name, runtime in s,
+# threads and the nodes it depends on (see example_fMRI_1_first_level.py)
+first_level_nodes = [
+    ('selectfiles', 1., 1, []),
+    ('getsubjectinfo', 1., 1, []),
+    ('fssource', 1., 1, []),
+    ('despike', 240., 4, ['selectfiles']),
+    ('sliceTimingRealign', 600., 1, ['despike']),
+    ('tsnr', 60., 1, ['sliceTimingRealign']),
+    ('smooth', 180., 1, ['tsnr']),
+    ('art', 30., 1, ['tsnr', 'sliceTimingRealign']),
+    ('bbregister', 900., 1, ['sliceTimingRealign']),
+    ('applyVolTrans', 20., 1, ['bbregister', 'fssource',
+                               'sliceTimingRealign']),
+    ('binarize', 10., 1, ['applyVolTrans']),
+    ('modelspec', 5., 1, ['sliceTimingRealign', 'smooth', 'art',
+                          'getsubjectinfo']),
+    ('level1design', 60., 1, ['modelspec', 'binarize']),
+    ('level1estimate', 300., 1, ['level1design']),
+    ('conestimate', 60., 1, ['level1estimate']),
+    ('applyVolReg', 30., 1, ['conestimate', 'bbregister']),
+    ('mriconvert', 10., 1, ['applyVolReg']),
+    ('datasink', 2., 1, ['mriconvert', 'conestimate', 'art', 'binarize',
+                         'bbregister']),
+]
+
+
+# Returns runtimes, threads and parents of the jobs of a batch of subjects,
+# in the order in which MultiProc finds them ready (node by node, subject by
+# subject)
+def batch_dag(n_subjects, nodes=first_level_nodes):
+    index = dict((name, i) for i, (name, _, _, _) in enumerate(nodes))
+    runtimes, threads, parents = [], [], []
+    for name, runtime, n_threads, deps in nodes:
+        for s in range(n_subjects):
+            runtimes.append(runtime)
+            threads.append(n_threads)
+            parents.append([index[d] * n_subjects + s for d in deps])
+    return np.array(runtimes), np.array(threads), parents
+
+
+# Simulates MultiProc on a graph of jobs with n_procs cores and returns the
+# makespan. The ready jobs that fit into the free cores are started in the
+# order of their priority (highest first), or in the order of the jobs
+# without priorities.
+def simulate_dag(runtimes, threads, parents, n_procs, priorities=None):
+    n_jobs = len(runtimes)
+    order = np.arange(n_jobs) if priorities is None else \
+        np.argsort(-np.asarray(priorities), kind='mergesort')
+    waiting = np.array([len(p) for p in parents])
+    children = [[] for _ in range(n_jobs)]
+    for j, p in enumerate(parents):
+        for i in p:
+            children[i].append(j)
+    started = np.zeros(n_jobs, dtype=bool)
+    running = []    # (end time, job)
+    now = 0.
+    free = n_procs
+    while not started.all() or running:
+        for j in order:
+            if not started[j] and waiting[j] == 0 and \
+                    min(threads[j], n_procs) <= free:
+                started[j] = True
+                free -= min(threads[j], n_procs)
+                running.append((now + runtimes[j], j))
+        running.sort()
+        now, j = running.pop(0)
+        free += min(threads[j], n_procs)
+        for c in children[j]:
+            waiting[c] -= 1
+    return now
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Simulates the makespan of a batch of ANTs normalizations '
+                    'with single-threaded and with elastic nodes, or of the '
+                    'first-level workflow with FIFO and critical path order')
+    parser.add_argument('--compare', choices=['elastic', 'critical_path'],
+                        default='elastic', help='what to simulate')
+    parser.add_argument('--subjects', type=int, default=10,
+                        help='number of subjects in the batch')
+    parser.add_argument('--n_procs', type=int, default=8,
+                        help='number of cores')
+    parser.add_argument('--runtime_noise', type=float, default=0.2,
+                        help='relative deviation of the runtimes from the '
+                             'history (critical_path)')
+    parser.add_argument('--parallel_fraction', type=float, default=0.9,
+                        help='parallel fraction of an ANTs job (Amdahl)')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='number of simulated batches')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random job durations')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    if args.compare == 'critical_path':
+        import scipy.sparse as ssp
+
+        runtimes, threads, parents = batch_dag(args.subjects)
+        depidx = ssp.lil_matrix((len(runtimes), len(runtimes)))
+        for j, p in enumerate(parents):
+            for i in p:
+                depidx[i, j] = 1
+        # The priorities come from the history, the simulated runtimes
+        #   deviate from it
+        priorities = upward_ranks(runtimes, depidx)
+        makespans = []
+        for _ in range(args.repeats):
+            actual = runtimes * np.maximum(
+                rng.normal(1., args.runtime_noise, len(runtimes)), 0.1)
+            makespans.append([simulate_dag(actual, threads, parents,
+                                           args.n_procs, p)
+                              for p in [None, priorities]])
+        fifo, critical = np.mean(makespans, axis=0) / 60.
+        print('First-level workflow, %d subjects on %d cores (runtime noise '
+              '%.2f, %d batches)' % (args.subjects, args.n_procs,
+                                     args.runtime_noise, args.repeats))
+        print('%-16s %14s' % ('', 'makespan [min]'))
+        print('%-16s %14.1f' % ('FIFO', fifo))
+        print('%-16s %14.1f' % ('critical path', critical))
+        print('Speedup: %.2fx' % (fifo / critical))
+        raise SystemExit(0)
+
+    # Registration takes about 1h per subject, warping a few minutes
+    results = {False: [], True: []}
+    for _ in range(args.repeats):
+        chains = [[rng.normal(3600., 600.), rng.normal(240., 40.)]
+                  for _ in range(args.subjects)]
+        for elastic in results:
+            finished = simulate_batch(chains, args.n_procs, elastic,
+                                      args.parallel_fraction)
+            # Makespan and tail (first to last finished subject)
+            results[elastic].append((max(finished),
+                                     max(finished) - min(finished)))
+
+    print('%d subjects on %d cores (parallel fraction %.2f, %d batches)'
+          % (args.subjects, args.n_procs, args.parallel_fraction,
+             args.repeats))
+    print('%-16s %14s %14s' % ('', 'makespan [min]', 'tail [min]'))
+    for elastic, name in [(False, 'num_threads=1'), (True, 'elastic')]:
+        makespan, tail = np.mean(results[elastic], axis=0) / 60.
+        print('%-16s %14.1f %14.1f' % (name, makespan, tail))
+    fixed, elastic = [np.mean(results[e], axis=0)[0] for e in [False, True]]
+    print('Speedup: %.2fx' % (fixed / elastic))
@@ -0,0 +1,166 @@
+###
+# Onset cache - parses the onset files of all subjects in one bulk pass and
+# keeps the result in a single compressed file next to the data folder.
+#
+# Usage (see example_fMRI_1_first_level.py):
+#
+#   from onset_cache import load_onsets, get_subject_info
+#   onset_cache = load_onsets(data_dir, subject_list)
+#   getsubjectinfo = Node(Function(input_names=['subject_id', 'onset_cache'],
+#                                  output_names=['subject_info'],
+#                                  function=get_subject_info),
+#                         name='getsubjectinfo')
+#   getsubjectinfo.inputs.onset_cache = onset_cache
+
+import os
+from io import StringIO
+from os.path import join as opj, exists, expanduser, abspath
+
+import numpy as np
+
+
+###
+# Specify variables
+run_list = ['run001', 'run002']                        # run identifiers
+cond_list = ['cond001', 'cond002', 'cond003', 'cond004']  # condition identifiers
+onset_template = 'onset_%s_%s.txt'                     # onset file name
+cache_name = 'onset_cache.npz'                         # name of cache file
+
+
+# Returns the onset files of one subject in the order (run, cond)
+def onset_files(data_dir, subject_id):
+    return [opj(data_dir, subject_id, onset_template % (run, cond))
+            for run in run_list for cond in cond_list]
+
+
+# Returns the (mtime, size) stamp of every given file
+def file_stamps(filenames):
+    stamps = np.zeros((len(filenames), 2))
+    for i, filename in enumerate(filenames):
+        st = os.stat(filename)
+        stamps[i] = [st.st_mtime, st.st_size]
+    return stamps
+
+
+# Parses the onset files of the given subjects in one numpy call. Returns
+# the subject, run and condition index as well as onset and duration of
+# every event that has a non-zero duration.
+def parse_onsets(data_dir, subject_list):
+    lines = []
+    counts = []
+    for subject_id in subject_list:
+        for onset_file in onset_files(data_dir, subject_id):
+            with open(onset_file, 'rt') as f:
+                content = [l for l in f.read().splitlines() if l.strip()]
+            lines.extend(content)
+            counts.append(len(content))
+
+    counts = np.array(counts, dtype=int)
+    n_files = len(run_list) * len(cond_list)
+    file_idx = np.repeat(np.arange(counts.size), counts)
+    if lines:
+        values = np.loadtxt(StringIO(u'\n'.join(lines)), usecols=(0, 1),
+                            ndmin=2)
+    else:
+        values = np.zeros((0, 2))
+
+    # Only keep events with a duration (same as the '0.00' check before)
+    keep = values[:, 1] != 0
+    file_idx = file_idx[keep]
+    return {'subject': file_idx // n_files,
+            'run': (file_idx % n_files) // len(cond_list),
+            'cond': file_idx % len(cond_list),
+            'onset': values[keep, 0]}
+
+
+# Loads the onsets of all subjects into the cache file and returns its path.
+# Subjects whose onset files didn't change since the last call (same mtime
+# and size) are taken from the cache, all others are parsed again.
+def load_onsets(data_dir, subject_list, cache_file=None):
+    data_dir = abspath(expanduser(data_dir))
+    if cache_file is None:
+        cache_file = opj(data_dir, cache_name)
+    cache_file = abspath(expanduser(cache_file))
+
+    stamps = np.array([file_stamps(onset_files(data_dir, s))
+                       for s in subject_list]).reshape(len(subject_list), -1, 2)
+
+    # Find out which subjects can be reused from the cache
+    cached = {}
+    if exists(cache_file):
+        cache = np.load(cache_file)
+        for i, subject_id in enumerate(cache['subjects']):
+            cached[str(subject_id)] = i
+        cache = dict((k, cache[k]) for k in cache.files)
+    reuse = [s for i, s in enumerate(subject_list)
+             if s in cached and
+             np.array_equal(cache['stamps'][cached[s]], stamps[i])]
+    parse = [s for s in subject_list if s not in reuse]
+
+    if not parse and len(reuse) == len(cached):
+        return cache_file
+
+    # Combine cached events with the events of the newly parsed subjects
+    events = {'subject': [], 'run': [], 'cond': [], 'onset': []}
+    if reuse:
+        old_idx = np.array([cached[s] for s in reuse])
+        new_idx = np.array([subject_list.index(s) for s in reuse])
+        lookup = np.full(len(cached), -1, dtype=int)
+        lookup[old_idx] = new_idx
+        rows = lookup[cache['subject']] >= 0
+        events['subject'].append(lookup[cache['subject'][rows]])
+        for key in ['run', 'cond', 'onset']:
+            events[key].append(cache[key][rows])
+    if parse:
+        parsed = parse_onsets(data_dir, parse)
+        new_idx = np.array([subject_list.index(s) for s in parse])
+        events['subject'].append(new_idx[parsed['subject']])
+        for key in ['run', 'cond', 'onset']:
+            events[key].append(parsed[key])
+
+    # Write to a temporary file first, so that parallel readers never see
+    # a half written cache
+    tmp_file = cache_file[:-4] + '_%d.tmp.npz' % os.getpid()
+    np.savez_compressed(tmp_file,
+                        subjects=np.array(subject_list),
+                        stamps=stamps,
+                        runs=np.array(run_list),
+                        conds=np.array(cond_list),
+                        subject=np.concatenate(events['subject']).astype(int),
+                        run=np.concatenate(events['run']).astype(np.int8),
+                        cond=np.concatenate(events['cond']).astype(np.int8),
+                        onset=np.concatenate(events['onset']))
+    os.rename(tmp_file, cache_file)
+    return cache_file
+
+
+# Function to get Subject specific condition information from the onset
+# cache. This function runs inside a Function node and therefore has to
+# import everything it needs itself.
+def get_subject_info(subject_id, onset_cache):
+    import numpy as np
+    from nipype.interfaces.base import Bunch
+
+    cache = np.load(onset_cache)
+    subject_idx = list(cache['subjects']).index(subject_id)
+    rows = cache['subject'] == subject_idx
+    run, cond, onset = cache['run'][rows], cache['cond'][rows], cache['onset'][rows]
+
+    # cond001 & cond002 are congruent, cond003 & cond004 are incongruent
+    condition_names = ['congruent', 'incongruent']
+    condition_idx = cond // 2
+
+    subjectinfo = []
+    for r in range(len(cache['runs'])):
+        onsets = [sorted(onset[(run == r) & (condition_idx == c)].tolist())
+                  for c in range(len(condition_names))]
+        subjectinfo.insert(r,
+                           Bunch(conditions=condition_names,
+                                 onsets=onsets,
+                                 durations=[[0], [0]],
+                                 amplitudes=None,
+                                 tmod=None,
+                                 pmod=None,
+                                 regressor_names=None,
+                                 regressors=None))
+    return subjectinfo
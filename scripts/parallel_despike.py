@@ -0,0 +1,134 @@
+###
+# Parallel Despike - runs AFNI's 3dDespike on several slabs of a run at once
+#
+# 3dDespike cleans every voxel time series on its own, with one core.
+# ParallelDespike cuts the run into slabs of slices (or parts of slices for
+# very long runs) of at most chunk_mb, despikes num_threads slabs at the same
+# time and writes every despiked slab straight into its place in the
+# preallocated, memory-mapped output file:
+#
+#   despike = MapNode(ParallelDespike(outputtype='NIFTI', num_threads=4,
+#                                     chunk_mb=256),
+#                     name="despike", iterfield=['in_file'])
+#
+# 3dDespike only despikes the voxels inside the mask of '3dAutomask -dilate 4'
+# and copies all others. A slab on its own would get a different automask, so
+# the mask is computed once for the whole run, the slabs are despiked with
+# -nomask and the voxels outside of the mask are copied from the input. The
+# output is stored as float32.
+
+import os
+import gzip
+import shutil
+import subprocess
+from os.path import join as opj, exists
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nb
+from nipype.interfaces.afni import Despike
+from nipype.interfaces.afni.preprocess import DespikeInputSpec
+from nipype.interfaces.base import traits, isdefined
+
+from chunked_tsnr import voxel_blocks, create_memmap
+from gunzip_cache import decompress
+
+
+# Runs an AFNI command line in the given folder. Interfaces can't be run
+# from threads, since running them changes the working directory.
+def run_afni(cmdline, cwd, environ):
+    env = dict(os.environ)
+    env.update(environ)
+    env['OMP_NUM_THREADS'] = '1'
+    proc = subprocess.Popen(cmdline, shell=True, cwd=cwd, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    if proc.returncode:
+        raise RuntimeError('%s failed:\n%s' % (cmdline, output.decode()))
+    return output.decode()
+
+
+class ParallelDespikeInputSpec(DespikeInputSpec):
+    chunk_mb = traits.Float(256., usedefault=True, nohash=True,
+                            desc='maximal size of a slab in MB')
+
+
+# ParallelDespike - Despike of slabs in parallel
+class ParallelDespike(Despike):
+    input_spec = ParallelDespikeInputSpec
+
+    def _run_interface(self, runtime):
+        out_file = self._list_outputs()['out_file']
+        if not out_file.endswith(('.nii', '.nii.gz')):
+            # AFNI datasets can't be memory-mapped
+            return super(ParallelDespike, self)._run_interface(runtime)
+        num_threads = self.inputs.num_threads
+        slab_dir = os.path.abspath('slabs')
+        if not exists(slab_dir):
+            os.makedirs(slab_dir)
+
+        in_file = self.inputs.in_file
+        if in_file.endswith('.gz'):
+            # The slabs are read from an uncompressed copy
+            in_file = opj(slab_dir, 'in.nii')
+            decompress(self.inputs.in_file, in_file, num_threads)
+        img = nb.load(in_file, mmap=True)
+        shape = img.shape[:3]
+        timepoints = img.shape[3]
+        header = img.header.copy()
+        header.set_data_dtype(np.float32)
+
+        # Same mask as the one of 3dDespike for the whole run
+        mask_file = opj(slab_dir, 'automask.nii')
+        run_afni('3dAutomask -dilate 4 -prefix %s %s' % (mask_file, in_file),
+                 slab_dir, self.inputs.environ)
+        mask = np.asanyarray(nb.load(mask_file).dataobj) > 0
+
+        compress = out_file.endswith('.gz')
+        map_file = out_file[:-3] if compress else out_file
+        despiked = create_memmap(map_file, shape + (timepoints,), img.affine,
+                                 header)
+
+        args = self.inputs.args if isdefined(self.inputs.args) else ''
+        total_bytes = np.prod(shape) * timepoints * 4 * 3
+        blocks = voxel_blocks(shape, timepoints,
+                              min(self.inputs.chunk_mb * 1024. ** 2,
+                                  total_bytes / max(num_threads, 1)))
+
+        def despike_slab(block):
+            index, (ys, zs) = block
+            data = np.asarray(img.dataobj[:, ys, zs], dtype=np.float32)
+            slab_file = opj(slab_dir, 'slab%04d.nii' % index)
+            nb.save(nb.Nifti1Image(data, img.affine, header), slab_file)
+            slab_out_file = opj(slab_dir, 'slab%04d_despike.nii' % index)
+            slab = Despike(in_file=slab_file, out_file=slab_out_file,
+                           outputtype='NIFTI',
+                           args=(args + ' -nomask').strip())
+            run_afni(slab.cmdline, slab_dir, self.inputs.environ)
+            slab_out = nb.load(slab_out_file, mmap=True)
+            slab_data = np.asarray(slab_out.dataobj, dtype=np.float32)
+            outside = ~mask[:, ys, zs]
+            slab_data[outside] = data[outside]
+            despiked[:, ys, zs] = slab_data
+            del slab_out
+            os.remove(slab_file)
+            os.remove(slab_out_file)
+
+        pool = ThreadPool(max(num_threads, 1))
+        try:
+            # The slabs are despiked by 3dDespike processes, the threads only
+            # cut the run and put the slabs back
+            pool.map(despike_slab, list(enumerate(blocks)), chunksize=1)
+        finally:
+            pool.close()
+
+        despiked.flush()
+        del despiked
+        if compress:
+            with open(map_file, 'rb') as f_in:
+                with gzip.open(out_file, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1 << 24)
+            os.remove(map_file)
+        shutil.rmtree(slab_dir)
+        runtime.returncode = 0
+        return runtime
@@ -0,0 +1,154 @@
+###
+# Registration profiles - fast coarse-to-fine registration with a quality
+# gate that reruns only failing subjects with the full profile
+#
+# The 'full' profile is the registration as configured in the node's inputs.
+# The 'fast' profile is derived from it: it uses the same multi-resolution
+# schedule, but stops each level as soon as the similarity metric plateaus
+# (a larger convergence threshold over a shorter window) and skips the last
+# level (the full resolution), which is the most expensive one.
+#
+# GatedRegistration runs the fast profile first and computes the correlation
+# between the warped image and the template inside the template's brain.
+# Only if it is below min_similarity, the registration is computed again with
+# the full profile:
+#
+#   antsreg = Node(GatedRegistration(profile='gated', min_similarity=0.8,
+#                                    transforms=['Rigid', 'Affine', 'SyN'],
+#                                    shrink_factors=[[8, 4, 2, 1]]*3, ...),
+#                  name='antsreg')
+#
+# The fast profile overrides number_of_iterations, convergence_threshold and
+# convergence_window_size of every stage while the registration runs.
+
+from nipype import logging
+from nipype.interfaces.base import traits, isdefined
+from nipype.interfaces.ants.registration import RegistrationOutputSpec
+
+from transform_cache import (CachedRegistration, CachedRegistrationInputSpec,
+                             ignored_inputs)
+
+iflogger = logging.getLogger('nipype.interface')
+
+
+###
+# Specify the fast profile, relative to the node's inputs
+fast_threshold_factor = 10.   # convergence threshold x 10
+fast_window_factor = 0.5      # convergence window / 2
+min_window_size = 2           # shortest convergence window
+
+
+# Returns the registration inputs that a profile overrides, for the
+# configured iterations, thresholds and windows of every stage. Like ANTs,
+# single thresholds and windows apply to all stages.
+def profile_inputs(profile, number_of_iterations, convergence_threshold,
+                   convergence_window_size):
+    if profile == 'full':
+        return {}
+    if not isdefined(number_of_iterations):
+        raise ValueError('The fast profile needs number_of_iterations')
+    n_stages = len(number_of_iterations)
+    thresholds = [convergence_threshold[min(i, len(convergence_threshold) - 1)]
+                  for i in range(n_stages)]
+    windows = [convergence_window_size[min(i,
+                                           len(convergence_window_size) - 1)]
+               for i in range(n_stages)]
+    # Skip the last level, unless it is the only one
+    iterations = [list(levels[:-1]) + [0] if len(levels) > 1 else list(levels)
+                  for levels in number_of_iterations]
+    return {'number_of_iterations': iterations,
+            'convergence_threshold': [t * fast_threshold_factor
+                                      for t in thresholds],
+            'convergence_window_size': [max(int(w * fast_window_factor),
+                                            min_window_size)
+                                        for w in windows]}
+
+
+# Returns the correlation between an image and a reference image inside the
+# voxels where the reference is not zero
+def image_similarity(in_file, reference_file):
+    import numpy as np
+    import nibabel as nb
+
+    data = nb.load(in_file).get_fdata(dtype=np.float32)
+    reference = nb.load(reference_file).get_fdata(dtype=np.float32)
+    if data.shape[:3] != reference.shape[:3]:
+        raise ValueError('%s and %s have different shapes'
+                         % (in_file, reference_file))
+    mask = reference.reshape(reference.shape[:3]) != 0
+    x = data.reshape(data.shape[:3])[mask].astype(np.float64)
+    y = reference.reshape(reference.shape[:3])[mask].astype(np.float64)
+    x -= x.mean()
+    y -= y.mean()
+    norm = np.sqrt((x ** 2).sum() * (y ** 2).sum())
+    return float((x * y).sum() / norm) if norm else 0.
+
+
+class GatedRegistrationInputSpec(CachedRegistrationInputSpec):
+    profile = traits.Enum('gated', 'fast', 'full', usedefault=True,
+                          desc='registration profile, gated runs the fast '
+                               'profile and the full one only if the quality '
+                               'check fails')
+    min_similarity = traits.Float(0.8, usedefault=True,
+                                  desc='lowest correlation between warped '
+                                       'image and template that passes the '
+                                       'quality check')
+
+
+class GatedRegistrationOutputSpec(RegistrationOutputSpec):
+    similarity = traits.Float(desc='correlation between warped image and '
+                                   'template')
+    profile = traits.Str(desc='profile of the returned registration')
+
+
+# GatedRegistration - Registration with fast and full profiles and a
+# quality gate between them
+class GatedRegistration(CachedRegistration):
+    input_spec = GatedRegistrationInputSpec
+    output_spec = GatedRegistrationOutputSpec
+    _ignored_inputs = ignored_inputs + ['profile', 'min_similarity']
+
+    # Runs the registration with the parameters of a profile. The inputs are
+    # reset afterwards, so that the hash of the node doesn't change.
+    def _run_profile(self, runtime, profile, correct_return_codes):
+        original = dict((k, getattr(self.inputs, k)) for k in
+                        ['number_of_iterations', 'convergence_threshold',
+                         'convergence_window_size'])
+        try:
+            for k, v in profile_inputs(profile, **original).items():
+                setattr(self.inputs, k, v)
+            runtime = super(GatedRegistration, self)._run_interface(
+                runtime, correct_return_codes)
+        finally:
+            for k, v in original.items():
+                setattr(self.inputs, k, v)
+        self._profile = profile
+        self._similarity = image_similarity(
+            self._list_outputs()['warped_image'], self.inputs.fixed_image[0])
+        return runtime
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        if not (isdefined(self.inputs.output_warped_image) and
+                self.inputs.output_warped_image):
+            raise ValueError('GatedRegistration needs output_warped_image '
+                             'for the quality check')
+
+        if self.inputs.profile == 'full':
+            return self._run_profile(runtime, 'full', correct_return_codes)
+
+        runtime = self._run_profile(runtime, 'fast', correct_return_codes)
+        if self.inputs.profile == 'gated' and \
+                self._similarity < self.inputs.min_similarity:
+            iflogger.info('Registration of %s failed the quality check '
+                          '(similarity %.3f < %.3f), running the full profile',
+                          self.inputs.moving_image[0], self._similarity,
+                          self.inputs.min_similarity)
+            runtime = self._run_profile(runtime, 'full', correct_return_codes)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = super(GatedRegistration, self)._list_outputs()
+        if hasattr(self, '_similarity'):
+            outputs['similarity'] = self._similarity
+            outputs['profile'] = self._profile
+        return outputs
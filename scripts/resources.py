@@ -0,0 +1,100 @@
+###
+# Resources - helper functions to find out how many jobs fit on this machine
+
+from __future__ import division, print_function
+import os
+import json
+import multiprocessing
+
+
+# Returns the number of cores and the total memory (in GB) of this machine
+def available_resources():
+    n_procs = multiprocessing.cpu_count()
+    try:
+        memory_gb = (os.sysconf('SC_PAGE_SIZE') *
+                     os.sysconf('SC_PHYS_PAGES')) / 1024. ** 3
+    except (ValueError, OSError, AttributeError):
+        # sysconf isn't available on this platform, only count the cores
+        memory_gb = None
+    return n_procs, memory_gb
+
+
+# Returns how many jobs with the given thread and memory demand can run at
+# the same time without oversubscribing the cores or the memory. If n_procs
+# or memory_gb are not specified, the resources of this machine are used.
+def max_parallel_jobs(threads_per_job=1, mem_gb_per_job=0,
+                      n_procs=None, memory_gb=None):
+    machine_procs, machine_memory = available_resources()
+    if n_procs is None:
+        n_procs = machine_procs
+    if memory_gb is None:
+        memory_gb = machine_memory
+
+    n_jobs = n_procs // max(threads_per_job, 1)
+    if memory_gb and mem_gb_per_job:
+        n_jobs = min(n_jobs, int(memory_gb // mem_gb_per_job))
+    return max(n_jobs, 1)
+
+
+# Returns start, end (as timestamps) and duration (in seconds) of every
+# finished run of a node, read from the result files in a working directory
+def node_runtimes(working_dir, node_name):
+    from datetime import datetime
+    from nipype.utils.filemanip import loadpkl
+
+    runtimes = []
+    result_name = 'result_%s.pklz' % node_name
+    for root, dirs, files in os.walk(os.path.expanduser(working_dir)):
+        if result_name not in files:
+            continue
+        runtime = loadpkl(os.path.join(root, result_name)).runtime
+        if isinstance(runtime, list):
+            runtime = runtime[0]
+        if getattr(runtime, 'startTime', None) is None:
+            continue
+        start, end = [(datetime.strptime(t[:26], '%Y-%m-%dT%H:%M:%S.%f'
+                                         if '.' in t else '%Y-%m-%dT%H:%M:%S') -
+                       datetime(1970, 1, 1)).total_seconds()
+                      for t in [runtime.startTime, runtime.endTime]]
+        runtimes.append((start, end, end - start))
+    return runtimes
+
+
+# Stores the runtimes of a run, e.g. as the baseline of later runs
+def save_runtimes(filename, runtimes):
+    filename = os.path.expanduser(filename)
+    with open(filename + '.part', 'w') as f:
+        json.dump([list(r) for r in runtimes], f, indent=1)
+    os.rename(filename + '.part', filename)
+
+
+# Returns the runtimes stored by save_runtimes, or None if there are none
+def load_runtimes(filename):
+    filename = os.path.expanduser(filename)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return [tuple(r) for r in json.load(f)]
+
+
+# Returns the number of finished jobs per hour over the whole run
+def throughput(runtimes):
+    if not runtimes:
+        return 0.
+    makespan = max(r[1] for r in runtimes) - min(r[0] for r in runtimes)
+    return len(runtimes) / max(makespan, 1.) * 3600.
+
+
+# Prints the throughput of a run and compares it with a baseline run
+def throughput_report(runtimes, baseline=None, name='subjects'):
+    achieved = throughput(runtimes)
+    print('Achieved throughput: %.2f %s/hour (%d %s, %.1f h per job)'
+          % (achieved, name, len(runtimes), name,
+             sum(r[2] for r in runtimes) / max(len(runtimes), 1) / 3600.))
+    if baseline:
+        naive = throughput(baseline)
+        print('Baseline throughput: %.2f %s/hour (%d %s, %.1f h per job)'
+              % (naive, name, len(baseline), name,
+                 sum(r[2] for r in baseline) / len(baseline) / 3600.))
+        if naive:
+            print('Speedup: %.2fx' % (achieved / naive))
@@ -0,0 +1,157 @@
+###
+# Slice timing - slice order and slice time tables of an acquisition
+# protocol, built from the acquisition scheme or read from a BIDS sidecar
+#
+# The table of every protocol is validated once and stored in a cache file,
+# so that all subjects and runs of the protocol use the same table:
+#
+#   from slice_timing import timing_table, slice_timing_inputs
+#   table = timing_table('stroop_ep2d', cache_file, num_slices=40,
+#                        time_repetition=2.0, scheme='interleaved')
+#   preproc = Node(FusedPreproc(fwhm=8,
+#                               **slice_timing_inputs(table, ref_slice=2)),
+#                  name='preproc')
+#
+# Without multiband, SPM gets the slice order and the number of the reference
+# slice. With multiband, several slices are acquired at the same time, which
+# a slice order can't express. SPM then gets the acquisition time (in ms) of
+# every slice and the time of the reference slice instead.
+
+import os
+import json
+from os.path import exists, expanduser, abspath, dirname
+
+import numpy as np
+
+
+###
+# Specify variables
+schemes = ['sequential', 'interleaved', 'interleaved_even']
+cache_name = 'slice_timing_cache.json'                 # name of cache file
+
+
+# Returns the slices (0-based) in the order of their acquisition.
+# 'interleaved' starts with slice 1, 3, 5, ..., 'interleaved_even' (Siemens
+# with an even number of slices) with 2, 4, 6, ...
+def acquisition_order(num_slices, scheme='interleaved', descending=False):
+    if scheme not in schemes:
+        raise ValueError('Unknown slice scheme %s, use one of %s'
+                         % (scheme, ', '.join(schemes)))
+    slices = list(range(num_slices))
+    if descending:
+        slices = slices[::-1]
+    if scheme == 'interleaved':
+        return slices[0::2] + slices[1::2]
+    if scheme == 'interleaved_even':
+        return slices[1::2] + slices[0::2]
+    return slices
+
+
+# Returns the acquisition time (ms) of every slice. With multiband, the
+# slices s, s + num_slices / multiband, ... are acquired at the same time.
+def scheme_slice_times(num_slices, time_repetition, scheme='interleaved',
+                       multiband=1, descending=False):
+    if num_slices % multiband:
+        raise ValueError('%d slices can not be acquired with multiband '
+                         'factor %d' % (num_slices, multiband))
+    n_shots = num_slices // multiband
+    shot_times = np.zeros(n_shots)
+    shot_times[acquisition_order(n_shots, scheme, descending)] = (
+        np.arange(n_shots) * time_repetition * 1000. / n_shots)
+    return np.tile(shot_times, multiband).tolist()
+
+
+# Returns the slice times (ms), repetition time (s) and multiband factor of
+# a BIDS sidecar file
+def read_sidecar(sidecar_file):
+    with open(sidecar_file) as f:
+        meta = json.load(f)
+    if 'SliceTiming' not in meta:
+        raise ValueError('%s contains no SliceTiming' % sidecar_file)
+    slice_times = (np.array(meta['SliceTiming']) * 1000.).tolist()
+    multiband = meta.get('MultibandAccelerationFactor',
+                         max(slice_times.count(t) for t in slice_times))
+    return slice_times, meta.get('RepetitionTime'), int(multiband)
+
+
+# Raises a ValueError if the table doesn't describe a valid acquisition
+def validate(table):
+    times = np.array(table['slice_times'])
+    if len(times) != table['num_slices']:
+        raise ValueError('%d slice times given for %d slices'
+                         % (len(times), table['num_slices']))
+    if times.min() < 0 or times.max() >= table['time_repetition'] * 1000.:
+        raise ValueError('Slice times must lie within the TR of %g s'
+                         % table['time_repetition'])
+    _, counts = np.unique(times, return_counts=True)
+    if np.any(counts != table['multiband']):
+        raise ValueError('Slices are not acquired in groups of %d '
+                         '(multiband factor)' % table['multiband'])
+
+
+# Returns the timing table of a protocol. The table is built from the given
+# scheme or sidecar file and stored in the cache file. Later calls with the
+# same protocol return the cached table, as long as the given parameters
+# agree with it.
+def timing_table(protocol, cache_file=cache_name, num_slices=None,
+                 time_repetition=None, scheme='interleaved', multiband=1,
+                 descending=False, sidecar_file=None):
+    cache_file = abspath(expanduser(cache_file))
+    cache = {}
+    if exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+
+    if sidecar_file is not None:
+        slice_times, sidecar_tr, multiband = read_sidecar(sidecar_file)
+        time_repetition = time_repetition or sidecar_tr
+        num_slices = num_slices or len(slice_times)
+    elif protocol in cache and num_slices is None:
+        return cache[protocol]
+    else:
+        slice_times = scheme_slice_times(num_slices, time_repetition, scheme,
+                                         multiband, descending)
+    table = {'num_slices': num_slices,
+             'time_repetition': time_repetition,
+             'multiband': multiband,
+             'slice_times': slice_times,
+             # SPM's slice order, only defined without multiband
+             'slice_order': (np.argsort(slice_times, kind='mergesort') +
+                             1).tolist() if multiband == 1 else None}
+    validate(table)
+
+    if protocol in cache:
+        if cache[protocol] != table:
+            raise ValueError('The timing of protocol %s differs from the one '
+                             'in %s' % (protocol, cache_file))
+        return cache[protocol]
+
+    # Write to a temporary file first, so that parallel readers never see
+    # a half written cache
+    cache[protocol] = table
+    if not exists(dirname(cache_file)):
+        os.makedirs(dirname(cache_file))
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, cache_file)
+    return table
+
+
+# Returns the slice timing inputs of SliceTiming (or FusedPreproc) for a
+# table and a reference slice (1-based)
+def slice_timing_inputs(table, ref_slice):
+    num_slices = table['num_slices']
+    tr = table['time_repetition']
+    if table['multiband'] == 1:
+        return {'num_slices': num_slices,
+                'time_repetition': tr,
+                'time_acquisition': tr - tr / num_slices,
+                'slice_order': table['slice_order'],
+                'ref_slice': ref_slice}
+    # SPM ignores the acquisition time if slice times are given
+    return {'num_slices': num_slices,
+            'time_repetition': tr,
+            'time_acquisition': 0.,
+            'slice_order': [float(t) for t in table['slice_times']],
+            'ref_slice': float(table['slice_times'][ref_slice - 1])}
@@ -0,0 +1,142 @@
+###
+# Subject index - scans the data folder once and keeps a map of
+# subject -> modality -> files in memory and in data/subject_index.json
+#
+# Only subject folders whose modification time changed since the last scan
+# are listed again, so building the index for thousands of subjects is fast.
+# The example scripts use the index either directly, e.g. to set iterables:
+#
+#   index = build_index(data_dir)
+#   T1_list = [subject_files(index, s, 'anat')[0] for s in subject_list]
+#
+# or through the SubjectFiles interface, which reads the files of a subject
+# out of the index file instead of globbing the data folder:
+#
+#   subjectfiles = Node(SubjectFiles(index_file=index['index_file']),
+#                       name='subjectfiles')
+
+import os
+import re
+import json
+from os.path import join as opj, exists, isdir, abspath, expanduser
+
+from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
+                                    TraitedSpec, File, traits, isdefined,
+                                    Undefined)
+
+
+###
+# Specify variables
+index_name = 'subject_index.json'           # name of the index file
+subject_pattern = re.compile(r'sub\d+$')    # name of subject folders
+
+# Which file belongs to which modality, all other files are 'other'
+modality_patterns = [('anat', re.compile(r'struct\.nii(\.gz)?$')),
+                     ('func', re.compile(r'run\d+\.nii(\.gz)?$')),
+                     ('behav', re.compile(r'behavdata_.+\.txt$')),
+                     ('onsets', re.compile(r'onset_.+\.txt$'))]
+modality_list = [m for m, _ in modality_patterns] + ['other']
+
+
+# Returns the modality of a file in a subject folder
+def file_modality(filename):
+    for modality, pattern in modality_patterns:
+        if pattern.match(filename):
+            return modality
+    return 'other'
+
+
+# Lists the files of one subject folder, sorted by modality
+def scan_subject(subject_dir):
+    files = dict((m, []) for m in modality_list)
+    for filename in sorted(os.listdir(subject_dir)):
+        files[file_modality(filename)].append(filename)
+    return files
+
+
+# Scans the data folder and returns the index. Subject folders that didn't
+# change since the last scan are taken from the index file.
+def build_index(data_dir, index_file=None):
+    data_dir = abspath(expanduser(data_dir))
+    if index_file is None:
+        index_file = opj(data_dir, index_name)
+
+    old_subjects = {}
+    if exists(index_file):
+        with open(index_file) as f:
+            old_subjects = json.load(f).get('subjects', {})
+
+    subjects = {}
+    changed = False
+    for subject_id in sorted(os.listdir(data_dir)):
+        subject_dir = opj(data_dir, subject_id)
+        if not subject_pattern.match(subject_id) or not isdir(subject_dir):
+            continue
+        mtime = os.stat(subject_dir).st_mtime
+        old = old_subjects.get(subject_id)
+        if old is not None and old['mtime'] == mtime:
+            subjects[subject_id] = old
+        else:
+            subjects[subject_id] = {'mtime': mtime,
+                                    'files': scan_subject(subject_dir)}
+            changed = True
+
+    index = {'data_dir': data_dir, 'subjects': subjects}
+    if changed or set(subjects) != set(old_subjects):
+        with open(index_file + '.part', 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.rename(index_file + '.part', index_file)
+    index['index_file'] = index_file
+    return index
+
+
+# Returns the absolute paths of a subject's files of one modality
+def subject_files(index, subject_id, modality):
+    if subject_id not in index['subjects']:
+        raise KeyError('Subject %s not found in %s'
+                       % (subject_id, index['data_dir']))
+    return [opj(index['data_dir'], subject_id, f)
+            for f in index['subjects'][subject_id]['files'][modality]]
+
+
+class SubjectFilesInputSpec(BaseInterfaceInputSpec):
+    index_file = File(exists=True, mandatory=True,
+                      desc='index file created by build_index')
+    subject_id = traits.Str(mandatory=True, desc='subject identifier')
+    session_id = traits.Str(desc='only return functional runs of this session')
+
+
+class SubjectFilesOutputSpec(TraitedSpec):
+    anat = traits.Any(desc='structural image')
+    func = traits.Any(desc='functional runs')
+    behav = traits.List(File(exists=True), desc='behavioral data')
+    onsets = traits.List(File(exists=True), desc='onset files')
+
+
+# SubjectFiles - returns the files of a subject from the subject index
+class SubjectFiles(BaseInterface):
+    input_spec = SubjectFilesInputSpec
+    output_spec = SubjectFilesOutputSpec
+    _always_run = True
+
+    def _run_interface(self, runtime):
+        return runtime
+
+    def _list_outputs(self):
+        with open(self.inputs.index_file) as f:
+            index = json.load(f)
+        subject_id = self.inputs.subject_id
+        func = subject_files(index, subject_id, 'func')
+        if isdefined(self.inputs.session_id):
+            func = [f for f in func if os.path.basename(f).startswith(
+                self.inputs.session_id + '.')]
+
+        # Single files are returned as a file, several files as a list
+        def simplify(files):
+            if not files:
+                return Undefined
+            return files[0] if len(files) == 1 else files
+        return {'anat': simplify(subject_files(index, subject_id, 'anat')),
+                'func': simplify(func),
+                'behav': subject_files(index, subject_id, 'behav'),
+                'onsets': subject_files(index, subject_id, 'onsets')}
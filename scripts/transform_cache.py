@@ -0,0 +1,135 @@
+###
+# Transform cache - content-addressed store for ANTs registrations
+#
+# The partial and the complete ANTs normalization compute the same
+# registration of freesurfer/{subject_id}/mri/brain.mgz to the MNI template.
+# CachedRegistration is a Registration node that stores its outputs in a
+# shared folder, under a key built from the content of the moving image, the
+# content of the fixed image and all registration parameters. If any
+# workflow asks for a registration that is already in the store, the stored
+# transforms are linked into the node folder instead of being recomputed.
+#
+#   antsreg = Node(CachedRegistration(transform_store=transform_store, ...),
+#                  name='antsreg')
+
+import os
+import json
+import shutil
+import hashlib
+from os.path import join as opj, exists, isfile, basename, expanduser
+
+from nipype.interfaces.base import Directory, isdefined
+from nipype.interfaces.ants import Registration
+from nipype.interfaces.ants.registration import RegistrationInputSpec
+
+
+# Inputs that don't change the result of a registration
+ignored_inputs = ['num_threads', 'environ', 'terminal_output',
+                  'transform_store']
+entry_name = 'entry.json'
+
+
+# Returns the SHA-1 of a file's content
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# Replaces all paths to existing files in an input value with their hash
+def hash_value(value):
+    if isinstance(value, (list, tuple)):
+        return [hash_value(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, hash_value(v)) for k, v in value.items())
+    if isinstance(value, str) and isfile(value):
+        return 'sha1:' + file_hash(value)
+    return value
+
+
+# Links a file into a folder, or copies it if linking isn't possible
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class CachedRegistrationInputSpec(RegistrationInputSpec):
+    transform_store = Directory(desc='folder of the shared transform store')
+
+
+class CachedRegistration(Registration):
+    input_spec = CachedRegistrationInputSpec
+    _ignored_inputs = ignored_inputs
+
+    # Returns the store key of the registration defined by the inputs
+    def _store_key(self):
+        inputs = dict((k, v) for k, v in self.inputs.get().items()
+                      if k not in self._ignored_inputs)
+        description = json.dumps(hash_value(inputs), sort_keys=True,
+                                 default=str)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    # Returns all output files that the registration wrote into cwd
+    def _output_files(self, cwd):
+        files = []
+        for value in self._list_outputs().values():
+            for f in (value if isinstance(value, list) else [value]):
+                if isdefined(f) and isinstance(f, str) and \
+                   os.path.dirname(os.path.abspath(f)) == cwd and isfile(f):
+                    files.append(f)
+        return sorted(set(files))
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        if not isdefined(self.inputs.transform_store):
+            return super(CachedRegistration, self)._run_interface(
+                runtime, correct_return_codes)
+
+        store = expanduser(self.inputs.transform_store)
+        entry_dir = opj(store, self._store_key())
+        cwd = os.getcwd()
+
+        # Reuse the stored registration
+        if exists(opj(entry_dir, entry_name)):
+            with open(opj(entry_dir, entry_name)) as f:
+                entry = json.load(f)
+            for filename in entry['files']:
+                if exists(opj(cwd, filename)):
+                    os.remove(opj(cwd, filename))
+                link_or_copy(opj(entry_dir, filename), opj(cwd, filename))
+            self._elapsed_time = entry['elapsed_time']
+            self._metric_value = entry['metric_value']
+            runtime.returncode = 0
+            runtime.stdout = 'Registration taken from %s' % entry_dir
+            return runtime
+
+        # Files linked from the store (e.g. a registration of the fast
+        # profile that failed the quality check) would be overwritten in
+        # place by antsRegistration, together with the stored entry
+        for f in self._output_files(cwd):
+            if os.stat(f).st_nlink > 1:
+                os.remove(f)
+
+        runtime = super(CachedRegistration, self)._run_interface(
+            runtime, correct_return_codes)
+
+        # Store the registration, in a temporary folder first so that other
+        # workflows never see an incomplete entry
+        files = self._output_files(cwd)
+        tmp_dir = '%s.%d.tmp' % (entry_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        for f in files:
+            shutil.copy2(f, opj(tmp_dir, basename(f)))
+        with open(opj(tmp_dir, entry_name), 'w') as f:
+            json.dump({'files': [basename(f) for f in files],
+                       'elapsed_time': self._elapsed_time,
+                       'metric_value': self._metric_value}, f, indent=1)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another workflow stored the same registration in the meantime
+            shutil.rmtree(tmp_dir)
+        return runtime
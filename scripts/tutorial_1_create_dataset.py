@@ -0,0 +1,177 @@
+###
+# Stage the tutorial dataset - Python version of tutorial_1_create_dataset.sh
+#
+# Instead of extracting the whole ds102 tarball into a temporary folder and
+# copying the files afterwards, the needed members (highres, bold, behav and
+# onsets) are streamed directly out of the tarball into the data/subXXX/
+# layout. Every member is written chunk by chunk into a .part file and
+# checksummed while it is written, so every file is read and written only
+# once. Every staged file is recorded with its checksum in data/manifest.json
+# and subjects that are already completely staged are skipped on the next
+# call.
+#
+# Usage:
+#   python tutorial_1_create_dataset.py
+#   python tutorial_1_create_dataset.py --subjects sub001 sub002
+
+from __future__ import print_function
+import os
+import re
+import json
+import hashlib
+import tarfile
+import argparse
+from os.path import join as opj, exists, getsize, dirname, expanduser
+
+
+###
+# Specify important variables
+zip_file = '~/Downloads/ds102_raw.tgz'       # location of download file
+tutorial_dir = '~/nipype_tutorial'           # location of experiment folder
+data_dir = opj(tutorial_dir, 'data')         # location of data folder
+subject_list = ['sub%03d' % i for i in range(1, 11)]  # first ten subjects
+session_list = ['run001', 'run002']          # list of session identifiers
+condition_list = ['cond001', 'cond002', 'cond003', 'cond004']
+
+## To download the dataset to the Download folder use the following code:
+#wget https://openfmri.s3.amazonaws.com/tarballs/ds102_raw.tgz ~/Downloads
+
+# Mapping of tarball members to their location in the data folder
+member_layout = [
+    (r'ds102/(sub\d+)/anatomy/highres001\.nii\.gz$',
+     r'\1/struct.nii.gz'),
+    (r'ds102/(sub\d+)/BOLD/task001_(run\d+)/bold\.nii\.gz$',
+     r'\1/\2.nii.gz'),
+    (r'ds102/(sub\d+)/behav/task001_(run\d+)/behavdata\.txt$',
+     r'\1/behavdata_\2.txt'),
+    (r'ds102/(sub\d+)/model/model001/onsets/task001_(run\d+)/(cond\d+)\.txt$',
+     r'\1/onset_\2_\3.txt'),
+    (r'ds102/demographics\.txt$',
+     r'demographics.txt'),
+    (r'ds102/models/model001/([^/]+)$',
+     r'\1'),
+]
+member_layout = [(re.compile(p), d) for p, d in member_layout]
+
+manifest_name = 'manifest.json'              # name of the manifest file
+chunk_size = 1 << 20                         # read members in 1MB chunks
+
+
+# Returns the files that have to exist in a completely staged subject folder
+def subject_files(subject_id):
+    files = [opj(subject_id, 'struct.nii.gz')]
+    for session in session_list:
+        files.append(opj(subject_id, '%s.nii.gz' % session))
+        files.append(opj(subject_id, 'behavdata_%s.txt' % session))
+        for cond in condition_list:
+            files.append(opj(subject_id, 'onset_%s_%s.txt' % (session, cond)))
+    return files
+
+
+# Returns the location of a tarball member in the data folder (or None)
+def member_destination(member_name):
+    for pattern, destination in member_layout:
+        match = pattern.search(member_name)
+        if match:
+            return match.expand(destination)
+    return None
+
+
+# Checks if all files of a subject are listed in the manifest and on disk
+def is_staged(data_dir, subject_id, manifest):
+    for filename in subject_files(subject_id):
+        entry = manifest.get(filename)
+        if entry is None or not exists(opj(data_dir, filename)) or \
+           getsize(opj(data_dir, filename)) != entry['size']:
+            return False
+    return True
+
+
+# Writes the content of a member chunk by chunk to its destination and
+# returns its manifest entry
+def write_member(data_dir, destination, fileobj):
+    out_file = opj(data_dir, destination)
+    if not exists(dirname(out_file)):
+        os.makedirs(dirname(out_file))
+    sha1 = hashlib.sha1()
+    size = 0
+    with open(out_file + '.part', 'wb') as f:
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            sha1.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    os.rename(out_file + '.part', out_file)
+    return {'sha1': sha1.hexdigest(), 'size': size}
+
+
+# Streams the needed members of the tarball into the data folder
+def stage_dataset(zip_file, data_dir, subject_list, force=False):
+    zip_file = expanduser(zip_file)
+    data_dir = expanduser(data_dir)
+    manifest_file = opj(data_dir, manifest_name)
+    manifest = {}
+    if exists(manifest_file) and not force:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    # Skip subjects that are already staged
+    todo = [s for s in subject_list if not is_staged(data_dir, s, manifest)]
+    for subject_id in sorted(set(subject_list) - set(todo)):
+        print('%s already staged.' % subject_id)
+    shared_files = ['demographics.txt']
+    if not todo and all(f in manifest for f in shared_files):
+        return manifest
+    for subject_id in todo:
+        print('Creating dataset for subject: %s' % subject_id)
+
+    # The tarball can only be decompressed in order, so the members are
+    # written one after another. Only one chunk is held in memory at a time.
+    remaining = dict((s, len(subject_files(s))) for s in todo)
+
+    tar = tarfile.open(zip_file, mode='r|*')
+    try:
+        for member in tar:
+            if not member.isfile():
+                continue
+            destination = member_destination(member.name)
+            if destination is None:
+                continue
+            subject_id = destination.split(os.sep)[0]
+            if subject_id in subject_list and subject_id not in todo:
+                continue
+            if subject_id.startswith('sub') and subject_id not in subject_list:
+                continue
+
+            # Write the member while it is read out of the stream (tar
+            # streams can't seek back)
+            manifest[destination] = write_member(data_dir, destination,
+                                                 tar.extractfile(member))
+            if subject_id in remaining:
+                remaining[subject_id] -= 1
+                if remaining[subject_id] == 0:
+                    print('%s done.' % subject_id)
+    finally:
+        tar.close()
+
+    tmp_file = manifest_file + '.part'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, manifest_file)
+
+    missing = [s for s in todo if not is_staged(data_dir, s, manifest)]
+    if missing:
+        raise IOError('Tarball %s is missing files of: %s'
+                      % (zip_file, ', '.join(missing)))
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stage the ds102 dataset.')
+    parser.add_argument('--zip_file', default=zip_file)
+    parser.add_argument('--data_dir', default=data_dir)
+    parser.add_argument('--subjects', nargs='+', default=subject_list)
+    parser.add_argument('--force', action='store_true',
+                        help='restage all subjects, ignore the manifest')
+    args = parser.parse_args()
+    stage_dataset(args.zip_file, args.data_dir, args.subjects,
+                  force=args.force)
@@ -0,0 +1,212 @@
+###
+# Parallel recon-all - Python version of tutorial_2_recon_shell.sh
+#
+# Runs mri_convert and the three recon-all stages (autorecon1, autorecon2 and
+# autorecon3, which together are the same as 'recon-all -all') for several
+# subjects at the same time. The number of subjects that run concurrently is
+# limited by the number of cores and the memory of the machine.
+#
+# Every finished stage is recorded, together with its wall time, in the
+# checkpoint file freesurfer/subXXX/scripts/recon_checkpoints.json. If the
+# script is started again (e.g. after a crash), finished stages are skipped
+# and only the failed and the remaining stages are run. The IsRunning files
+# that a killed recon-all leaves behind are removed before a stage is rerun,
+# if the process recorded in them no longer runs on this host. A recon-all
+# that still runs on the same subject (e.g. started by another script) keeps
+# its lock, and the stage fails with 'already running'.
+#
+# Usage:
+#   python tutorial_2_recon_parallel.py
+#   python tutorial_2_recon_parallel.py --subjects sub001 sub002 --mem_gb 4
+
+from __future__ import print_function
+import os
+import re
+import glob
+import json
+import time
+import socket
+import argparse
+import subprocess
+from os.path import join as opj, exists, expanduser
+from multiprocessing.pool import ThreadPool
+
+from resources import max_parallel_jobs
+from matlab_pool import pid_running
+
+
+###
+# Specify important variables
+tutorial_dir = '~/nipype_tutorial'            # location of experiment folder
+data_dir = opj(tutorial_dir, 'data')          # location of data folder
+subjects_dir = opj(tutorial_dir, 'freesurfer')  # location of freesurfer folder
+subject_list = ['sub%03d' % i for i in range(1, 11)]  # subject identifier
+T1_identifier = 'struct.nii.gz'               # Name of T1-weighted image
+
+mem_gb_per_subject = 3                        # peak memory of one recon-all
+threads_per_subject = 1                       # threads of one recon-all
+recon_flags = []                              # e.g. ['-nuintensitycor-3T']
+
+# The stages of 'recon-all -all' in the order they have to run
+stage_list = ['convert', 'autorecon1', 'autorecon2', 'autorecon3']
+checkpoint_name = 'recon_checkpoints.json'
+
+
+# Returns the command line of a stage
+def stage_command(stage, subject_id, data_dir, subjects_dir, threads=1):
+    if stage == 'convert':
+        return ['mri_convert', opj(data_dir, subject_id, T1_identifier),
+                opj(subjects_dir, subject_id, 'mri', 'orig', '001.mgz')]
+    cmd = ['recon-all', '-%s' % stage, '-subjid', subject_id,
+           '-sd', subjects_dir] + recon_flags
+    if threads > 1:
+        cmd += ['-openmp', str(threads)]
+    return cmd
+
+
+# Returns the checkpoints of a subject, i.e. the status of every stage
+def load_checkpoints(subjects_dir, subject_id):
+    checkpoint_file = opj(subjects_dir, subject_id, 'scripts', checkpoint_name)
+    if not exists(checkpoint_file):
+        return {}
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+
+# Stores the checkpoints of a subject
+def save_checkpoints(subjects_dir, subject_id, checkpoints):
+    checkpoint_file = opj(subjects_dir, subject_id, 'scripts', checkpoint_name)
+    with open(checkpoint_file + '.part', 'w') as f:
+        json.dump(checkpoints, f, indent=1, sort_keys=True)
+    os.rename(checkpoint_file + '.part', checkpoint_file)
+
+
+# Returns True if the recon-all that wrote an IsRunning file is gone, i.e.
+# if the file records a process of this host that no longer runs
+def is_stale(running_file):
+    try:
+        with open(running_file) as f:
+            content = f.read()
+    except IOError:
+        # Removed in the meantime
+        return False
+    host = re.search(r'^HOST\s+(\S+)', content, re.M)
+    pid = re.search(r'^PROCESSID\s+(\d+)', content, re.M)
+    if host is None or pid is None:
+        return False
+    if host.group(1).split('.')[0] != socket.gethostname().split('.')[0]:
+        # Can't check processes of other hosts
+        return False
+    return not pid_running(int(pid.group(1)))
+
+
+# Runs all unfinished stages of one subject, one after another
+def recon_subject(subject_id, data_dir, subjects_dir, threads=1):
+    script_dir = opj(subjects_dir, subject_id, 'scripts')
+    for folder in [opj(subjects_dir, subject_id, 'mri', 'orig'), script_dir]:
+        if not exists(folder):
+            os.makedirs(folder)
+
+    checkpoints = load_checkpoints(subjects_dir, subject_id)
+    for stage in stage_list:
+        if checkpoints.get(stage, {}).get('status') == 'done':
+            continue
+        print('%s: running %s' % (subject_id, stage))
+        # Remove the IsRunning files of a recon-all that was killed
+        for running_file in glob.glob(opj(script_dir, 'IsRunning.*')):
+            if is_stale(running_file):
+                print('%s: removing stale %s' % (subject_id, running_file))
+                os.remove(running_file)
+        cmd = stage_command(stage, subject_id, data_dir, subjects_dir, threads)
+        start = time.time()
+        with open(opj(script_dir, 'recon_%s.log' % stage), 'w') as log:
+            try:
+                returncode = subprocess.call(cmd, stdout=log,
+                                             stderr=subprocess.STDOUT)
+            except OSError as e:
+                # e.g. recon-all isn't on the PATH
+                log.write('%s\n' % e)
+                returncode = None
+        checkpoints[stage] = {'status': 'done' if returncode == 0 else 'failed',
+                              'seconds': round(time.time() - start, 1),
+                              'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+        save_checkpoints(subjects_dir, subject_id, checkpoints)
+        if returncode != 0:
+            # The next stages depend on this one, rerun it on the next call
+            print('%s: %s failed (see %s)' % (subject_id, stage,
+                                              opj(script_dir,
+                                                  'recon_%s.log' % stage)))
+            return subject_id, checkpoints
+    print('%s finished' % subject_id)
+    return subject_id, checkpoints
+
+
+# Runs recon-all for all subjects, as many at the same time as fit
+def recon_all(subject_list, data_dir, subjects_dir, threads=1,
+              mem_gb=mem_gb_per_subject, n_procs=None, memory_gb=None):
+    data_dir = expanduser(data_dir)
+    subjects_dir = expanduser(subjects_dir)
+    n_jobs = max_parallel_jobs(threads, mem_gb, n_procs, memory_gb)
+    n_jobs = min(n_jobs, len(subject_list))
+    print('Running %d subjects at the same time' % n_jobs)
+
+    pool = ThreadPool(n_jobs)
+    results = [pool.apply_async(recon_subject,
+                                (s, data_dir, subjects_dir, threads))
+               for s in subject_list]
+    pool.close()
+    pool.join()
+
+    # An error in one subject doesn't stop the report of the others
+    checkpoints = {}
+    for subject_id, r in zip(subject_list, results):
+        try:
+            checkpoints[subject_id] = r.get()[1]
+        except Exception as e:
+            print('%s: error %s' % (subject_id, e))
+            try:
+                checkpoints[subject_id] = load_checkpoints(subjects_dir,
+                                                           subject_id)
+            except (IOError, ValueError):
+                checkpoints[subject_id] = {}
+            # Mark the first unfinished stage as failed
+            for stage in stage_list:
+                if checkpoints[subject_id].get(stage, {}).get('status') \
+                        != 'done':
+                    checkpoints[subject_id][stage] = {'status': 'failed',
+                                                      'error': str(e)}
+                    break
+
+    # Print the wall time of every stage
+    print('\n%-10s' % 'subject' + ''.join('%12s' % s for s in stage_list))
+    for subject_id in subject_list:
+        row = []
+        for stage in stage_list:
+            info = checkpoints[subject_id].get(stage)
+            if info is None:
+                row.append('%12s' % '-')
+            elif info['status'] != 'done':
+                row.append('%12s' % info['status'])
+            else:
+                row.append('%11.1fm' % (info['seconds'] / 60.))
+        print('%-10s' % subject_id + ''.join(row))
+    return checkpoints
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run recon-all in parallel.')
+    parser.add_argument('--subjects', nargs='+', default=subject_list)
+    parser.add_argument('--data_dir', default=data_dir)
+    parser.add_argument('--subjects_dir', default=subjects_dir)
+    parser.add_argument('--threads', type=int, default=threads_per_subject,
+                        help='threads per subject (recon-all -openmp)')
+    parser.add_argument('--mem_gb', type=float, default=mem_gb_per_subject,
+                        help='memory per subject in GB')
+    parser.add_argument('--n_procs', type=int, default=None,
+                        help='number of cores to use (default: all)')
+    parser.add_argument('--memory_gb', type=float, default=None,
+                        help='memory to use in GB (default: all)')
+    args = parser.parse_args()
+    recon_all(args.subjects, args.data_dir, args.subjects_dir,
+              threads=args.threads, mem_gb=args.mem_gb,
+              n_procs=args.n_procs, memory_gb=args.memory_gb)
@@ -4,6 +4,9 @@ from os.path import join as opj
 from nipype.interfaces.freesurfer import ReconAll
 from nipype.interfaces.utility import IdentityInterface
 from nipype.pipeline.engine import Workflow, Node
+from resources import (available_resources, node_runtimes, save_runtimes,
+                       load_runtimes, throughput_report)
+from subject_index import build_index, subject_files
 
 # Specify important variables
 experiment_dir = '~/nipype_tutorial'           # location of experiment folder
@@ -13,37 +16,71 @@ subject_list = ['sub001', 'sub002', 'sub003',
                 'sub004', 'sub005', 'sub006',
                 'sub007', 'sub008', 'sub009',
                 'sub010']                        # subject identifier
-T1_identifier = 'struct.nii.gz'                  # Name of T1-weighted image
+
+# Look up the T1-weighted image (struct.nii.gz) of every subject in the index
+index = build_index(data_dir)
+T1_list = []
+for subject_id in subject_list:
+    T1_files = subject_files(index, subject_id, 'anat')
+    if not T1_files:
+        raise ValueError('No structural image of subject %s found in %s'
+                         % (subject_id, data_dir))
+    T1_list.append(T1_files[0])
+
+# Resources - recon-all runs with 'openmp_threads' threads and needs about
+#   'recon_mem_gb' GB of memory. MultiProc uses these estimates to run as many
+#   subjects at the same time as fit on this machine.
+n_procs, _ = available_resources()
+openmp_threads = 2                               # threads per recon-all
+recon_mem_gb = 3                                 # memory per recon-all in GB
 
 # Create the output folder - FreeSurfer can only run if this folder exists
-os.system('mkdir -p %s' % fs_folder)
+if not os.path.exists(os.path.expanduser(fs_folder)):
+    os.makedirs(os.path.expanduser(fs_folder))
 
 # Create the pipeline that runs the recon-all command
 reconflow = Workflow(name="reconflow")
 reconflow.base_dir = opj(experiment_dir, 'workingdir_reconflow')
 
+# Timings of the naive run (e.g. 8 single threaded subjects at once) to
+#   compare the throughput with. They are stored once, from the first run
+#   that finds no baseline file, because later runs reuse the cached nodes.
+baseline_file = opj(experiment_dir, 'reconflow_baseline.json')
+baseline = load_runtimes(baseline_file)
+if baseline is None:
+    # The working directory may still have the timings of the naive run
+    baseline = node_runtimes(reconflow.base_dir, 'reconall') or None
+    if baseline:
+        save_runtimes(baseline_file, baseline)
+
 # Some magical stuff happens here (not important for now)
-infosource = Node(IdentityInterface(fields=['subject_id']),
+infosource = Node(IdentityInterface(fields=['subject_id', 'T1_files']),
                   name="infosource")
-infosource.iterables = ('subject_id', subject_list)
+infosource.iterables = [('subject_id', subject_list),
+                        ('T1_files', T1_list)]
+infosource.synchronize = True
 # This node represents the actual recon-all command
 reconall = Node(ReconAll(directive='all',
                         #flags='-nuintensitycor- 3T',
+                         openmp=openmp_threads,
                          subjects_dir=fs_folder),
+                n_procs=openmp_threads,
+                mem_gb=recon_mem_gb,
                 name="reconall")
 
-# This function returns for each subject the path to struct.nii.gz
-def pathfinder(subject, foldername, filename):
-    from os.path import join as opj
-    struct_path = opj(foldername, subject, filename)
-    return struct_path
-
 # This section connects all the nodes of the pipeline to each other
-reconflow.connect([(infosource, reconall, [('subject_id', 'subject_id')]),
-                   (infosource, reconall, [(('subject_id', pathfinder,
-                                             data_dir, T1_identifier),
-                                            'T1_files')]),
+reconflow.connect([(infosource, reconall, [('subject_id', 'subject_id'),
+                                           ('T1_files', 'T1_files')]),
                    ])
 
-# This command runs the recon-all pipeline in parallel (using 8 cores)
-reconflow.run('MultiProc', plugin_args={'n_procs': 8})
+# This command runs the recon-all pipeline in parallel (using all cores and
+#   by default 90% of the memory, MultiProc only starts another recon-all if
+#   its threads and memory estimate are still free)
+reconflow.run('MultiProc', plugin_args={'n_procs': n_procs})
+
+# Compare the throughput of this run with the naive run, or store this run
+#   as the naive run
+runtimes = node_runtimes(reconflow.base_dir, 'reconall')
+if baseline is None:
+    save_runtimes(baseline_file, runtimes)
+throughput_report(runtimes, baseline)
@@ -1,12 +1,14 @@
 ###
 # Import modules
 from os.path import join as opj
-from nipype.interfaces.spm import SliceTiming, Realign, Smooth
 from nipype.interfaces.utility import IdentityInterface
-from nipype.interfaces.io import SelectFiles, DataSink
-from nipype.algorithms.rapidart import ArtifactDetect
-from nipype.algorithms.misc import Gunzip
+from nipype.interfaces.io import DataSink
 from nipype.pipeline.engine import Workflow, Node
+from subject_index import build_index, SubjectFiles
+from fused_preproc import FusedPreproc
+from slice_timing import timing_table, slice_timing_inputs
+from gunzip_cache import CachedGunzip
+from art_stream import FastArtifactDetect
 
 
 ###
@@ -23,40 +25,46 @@ working_dir = 'workingdir_firstSteps'     # name of working directory
 
 number_of_slices = 40                     # number of slices in volume
 TR = 2.0                                  # time repetition of volume
+slice_scheme = 'interleaved'              # order of slice acquisition
+multiband_factor = 1                      # slices acquired at the same time
 smoothing_size = 8                        # size of FWHM in mm
 
 
 ###
 # Specify Nodes
 
-# Gunzip - unzip functional
-gunzip = Node(Gunzip(), name="gunzip")
-
-# Slicetiming - correct for slice wise acquisition
-interleaved_order = range(1,number_of_slices+1,2) + range(2,number_of_slices+1,2)
-sliceTiming = Node(SliceTiming(num_slices=number_of_slices,
-                               time_repetition=TR,
-                               time_acquisition=TR-TR/number_of_slices,
-                               slice_order=interleaved_order,
-                               ref_slice=2),
-                   name="sliceTiming")
-
-# Realign - correct for motion
-realign = Node(Realign(register_to_mean=True),
-               name="realign")
+# Gunzip - unzip functional. Files that were unzipped before are taken from
+#   the gunzip cache.
+gunzip = Node(CachedGunzip(cache_dir=opj(experiment_dir, 'gunzip_cache')),
+              name="gunzip")
+
+# Slicetiming, Realign & Smooth - correct for slice wise acquisition and for
+#   motion and smooth the images with a given kernel, in one MATLAB session.
+#   Only the realigned images (for the artifact detection), the smoothed
+#   images, the mean image and the realignment parameters are kept.
+#   The slice order (slice times with multiband) comes from the cached
+#   timing table of the protocol (see slice_timing.py).
+slice_timing = timing_table('stroop',
+                            opj(experiment_dir, 'slice_timing_cache.json'),
+                            num_slices=number_of_slices, time_repetition=TR,
+                            scheme=slice_scheme, multiband=multiband_factor)
+fusedPreproc = Node(FusedPreproc(register_to_mean=True,
+                                 fwhm=smoothing_size,
+                                 keep_realigned=True,
+                                 **slice_timing_inputs(slice_timing, ref_slice=2)),
+                    name="fusedPreproc")
 
 # Artifact Detection - determine which of the images in the functional series
 #   are outliers. This is based on deviation in intensity or movement.
-art = Node(ArtifactDetect(norm_threshold=1,
-                          zintensity_threshold=3,
-                          mask_type='spm_global',
-                          parameter_source='SPM'),
+#   The volumes are read in blocks of chunk_mb through a memory map and
+#   scored with array operations (see art_stream.py)
+art = Node(FastArtifactDetect(norm_threshold=1,
+                              zintensity_threshold=3,
+                              mask_type='spm_global',
+                              parameter_source='SPM',
+                              chunk_mb=256),
            name="art")
 
-# Smooth - to smooth the images with a given kernel
-smooth = Node(Smooth(fwhm=smoothing_size),
-              name="smooth")
-
 
 ###
 # Specify Workflows & Connect Nodes
@@ -66,13 +74,11 @@ preproc = Workflow(name='preproc')
 preproc.base_dir = opj(experiment_dir, working_dir)
 
 # Connect all components of the preprocessing workflow
-preproc.connect([(gunzip, sliceTiming, [('out_file', 'in_files')]),
-                 (sliceTiming, realign, [('timecorrected_files', 'in_files')]),
-                 (realign, art, [('realigned_files', 'realigned_files'),
-                                 ('mean_image', 'mask_file'),
-                                 ('realignment_parameters',
-                                  'realignment_parameters')]),
-                 (realign, smooth, [('realigned_files', 'in_files')]),
+preproc.connect([(gunzip, fusedPreproc, [('out_file', 'in_files')]),
+                 (fusedPreproc, art, [('realigned_files', 'realigned_files'),
+                                      ('mean_image', 'mask_file'),
+                                      ('realignment_parameters',
+                                       'realignment_parameters')]),
                  ])
 
 
@@ -86,10 +92,10 @@ infosource = Node(IdentityInterface(fields=['subject_id',
 infosource.iterables = [('subject_id', subject_list),
                         ('session_id', session_list)]
 
-# SelectFiles
-templates = {'func': 'data/{subject_id}/{session_id}.nii.gz'}
-selectfiles = Node(SelectFiles(templates,
-                               base_directory=experiment_dir),
+# SubjectFiles - reads the functional run out of the subject index
+index = build_index(opj(experiment_dir, 'data'))
+selectfiles = Node(SubjectFiles(index_file=index['index_file']),
+                   run_without_submitting=True,
                    name="selectfiles")
 
 # Datasink
@@ -106,11 +112,11 @@ datasink.inputs.substitutions = substitutions
 preproc.connect([(infosource, selectfiles, [('subject_id', 'subject_id'),
                                             ('session_id', 'session_id')]),
                  (selectfiles, gunzip, [('func', 'in_file')]),
-                 (realign, datasink, [('mean_image', 'realign.@mean'),
-                                      ('realignment_parameters',
-                                       'realign.@parameters'),
-                                      ]),
-                 (smooth, datasink, [('smoothed_files', 'smooth')]),
+                 (fusedPreproc, datasink, [('mean_image', 'realign.@mean'),
+                                           ('realignment_parameters',
+                                            'realign.@parameters'),
+                                           ('smoothed_files', 'smooth'),
+                                           ]),
                  (art, datasink, [('outlier_files', 'art.@outliers'),
                                   ('plot_files', 'art.@plot'),
                                   ]),
@@ -0,0 +1,64 @@
+###
+# Warp batch - helper functions to warp several images with one
+# antsApplyTransforms call
+#
+# stack_images combines all 3D images of a subject (e.g. contrasts and mean
+# image) into one 4D image, which is warped by a single ApplyTransforms node
+# with input_image_type=3. This way the transforms and the reference image
+# are read only once. split_images writes the warped volumes back into
+# separate files with the usual '_trans' suffix.
+#
+# Both functions run inside Function nodes and therefore import everything
+# they need themselves.
+
+
+# Stacks 3D images with the same grid into one 4D image
+def stack_images(in_files):
+    import os
+    import numpy as np
+    import nibabel as nb
+
+    images = [nb.load(f) for f in in_files]
+    for f, img in zip(in_files, images):
+        if img.shape[:3] != images[0].shape[:3] or \
+           not np.allclose(img.affine, images[0].affine):
+            raise ValueError('%s is not on the same grid as %s'
+                             % (f, in_files[0]))
+
+    data = np.stack([np.asanyarray(img.dataobj, dtype=np.float32).reshape(
+        img.shape[:3]) for img in images], axis=-1)
+    stacked_img = nb.Nifti1Image(data, images[0].affine)
+    stacked_img.header.set_xyzt_units(*images[0].header.get_xyzt_units())
+    stacked_file = os.path.abspath('stacked.nii')
+    nb.save(stacked_img, stacked_file)
+
+    # Name of every image after the warp, e.g. con_0001_trans.nii
+    out_names = []
+    for f in in_files:
+        name = os.path.basename(f)
+        for ext in ['.nii.gz', '.nii']:
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+                break
+        out_names.append(name + '_trans.nii')
+    return stacked_file, out_names
+
+
+# Splits a 4D image into one 3D image per volume, with the given names
+def split_images(in_file, out_names):
+    import os
+    import numpy as np
+    import nibabel as nb
+
+    img = nb.load(in_file)
+    if img.shape[-1] != len(out_names) or len(img.shape) != 4:
+        raise ValueError('%s has %s volumes, but %d names were given'
+                         % (in_file, img.shape[3:], len(out_names)))
+
+    out_files = []
+    for i, name in enumerate(out_names):
+        out_file = os.path.abspath(name)
+        data = np.asanyarray(img.dataobj[..., i])
+        nb.save(nb.Nifti1Image(data, img.affine, img.header), out_file)
+        out_files.append(out_file)
+    return out_files